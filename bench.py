@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import asyncio
+import coffee
+import datetime
+import json
+import modular
+import os
+import platform
+import pycat
+import random
+import statistics
+import stats
+import subprocess
+import sys
+import time
+from modules import mapper
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAPFNAME = os.path.join(HERE, 'coffee.map')
+BASELINE = 'bench-baseline.json'
+REPEAT = 5
+MAX_SECONDS = 5.0  # stop repeating a benchmark once its runs have taken this long
+THRESHOLD = 0.1  # how much slower or faster counts as a change
+CORPUS_LINES = 5000
+DRAW_SIZES = [(20, 10), (60, 100), (200, 200)]
+NAME_QUERIES = [('Temple', None), ('road', None), ('Forest', None), ('a', None), ('The Temple of Paran', None),
+        ('no such room', None), ('Street', 'Midgaard')]
+COMMANDS = ['look', 'rt wgate', 'kill orc;get all from corpse', '#3 n', 'say hello there', 'newcharsetup',
+        'cast fireball orc', 'open w;w']
+
+
+class BenchSession(object):
+    strip_ansi = pycat.Session.strip_ansi
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.stats = stats.Stats()
+        self.sent = 0
+
+    def send(self, line):
+        self.sent += 1
+
+    send_paced = send
+
+    def log(self, *args, **kwargs):
+        pass
+
+    def show(self, line):
+        pass
+
+
+# coffee's triggers and aliases, with the mapper on coffee.map
+class BenchWorld(modular.ModularClient):
+    def __init__(self, mud):
+        self.modules = {'mapper': mapper.Mapper(mud, False, MAPFNAME)}
+        super().__init__(mud)
+        self.aliases.update(coffee.ALIASES)
+        self.triggers.update(coffee.TRIGGERS)
+
+    def enter(self, room):
+        self.gmcp['room'] = {'info': {'num': int(room)}}
+
+
+# What the benchmarks work on, set up once
+class Context(object):
+    def __init__(self):
+        with open(MAPFNAME) as f:
+            self.serialized = f.read()
+        self.map = mapper.Map(self.serialized)
+        self.world = BenchWorld(BenchSession())
+        self.mapper = self.world.modules['mapper']
+        bookmarks = self.map.getBookmarks()
+        self.bookmarks = [bookmarks[name] for name in sorted(bookmarks)]
+        self.starts = sorted(set(self.bookmarks))[:5]
+        self.router = mapper.ZoneRouter(self.map, mapper.Costs())
+        self.paths = [path for path in (self.map.findPath(bookmarks['recall'], there) for there in self.bookmarks) if path]
+        self.corpus = self.makeCorpus()
+
+    # Room names, combat and chatter, and now and then a line that fires one of coffee's plain triggers
+    def makeCorpus(self):
+        rnd = random.Random(1)
+        names = [name for name in map(self.map.getRoomName, self.map.rooms()) if name]
+        fires = [key for key, value in coffee.TRIGGERS.items() if isinstance(value, str) and key.replace('.', '').replace(' ', '').isalnum()]
+        corpus = []
+        while len(corpus) < CORPUS_LINES:
+            kind = rnd.random()
+            if kind < 0.3:
+                line = rnd.choice(names)
+            elif kind < 0.6:
+                line = "{} {} you with a {} blow! [{}]".format(rnd.choice(['An orc', 'The guard', 'A rat']),
+                    rnd.choice(['hits', 'slashes', 'crushes']), rnd.choice(['weak', 'solid']), rnd.randint(1, 30))
+            elif kind < 0.95:
+                line = "{} chats 'anyone up for {}?'".format(rnd.choice(['Bob', 'Alice', 'Zed']), rnd.choice(names))
+            else:
+                line = rnd.choice(fires)
+            trigger, match = self.world.triggers.match(line)
+            if trigger is None or isinstance(self.world.triggers[trigger], str):
+                corpus.append(line)
+        return corpus
+
+
+BENCHMARKS = []  # (name, function taking the Context, doing the work and returning how many operations it did)
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return register
+
+
+@benchmark('map load')
+def mapLoad(ctx):
+    mapper.Map(ctx.serialized)
+    return 1
+
+
+@benchmark('map serialize')
+def mapSerialize(ctx):
+    ctx.map.serialize()
+    return 1
+
+
+@benchmark('findPath bookmark pairs')
+def findPathPairs(ctx):
+    n = 0
+    for here in ctx.bookmarks:
+        for there in ctx.bookmarks:
+            if here != there:
+                ctx.map.findPath(here, there)
+                n += 1
+    return n
+
+
+# the first run also sets up the zones
+@benchmark('routed bookmark pairs')
+def routedPairs(ctx):
+    n = 0
+    for here in ctx.bookmarks:
+        for there in ctx.bookmarks:
+            if here != there:
+                ctx.router.findPath(here, there)
+                n += 1
+    return n
+
+
+# the first run builds the trees, the best is all lookups
+@benchmark('cached paths to bookmarks')
+def cachedPaths(ctx):
+    cache = ctx.mapper.pathCache()
+    n = 0
+    for here in ctx.bookmarks:
+        for there in ctx.starts:
+            if here != there:
+                cache.findPath(here, there)
+                n += 1
+    return n
+
+
+@benchmark('findRoomsByName')
+def findRoomsByName(ctx):
+    for name, zone in NAME_QUERIES:
+        ctx.map.findRoomsByName(name, zone)
+    return len(NAME_QUERIES)
+
+
+def drawBenchmark(columns, lines):
+    def draw(ctx):
+        for start in ctx.starts:
+            ctx.world.enter(start)
+            ctx.mapper.draw(columns, lines)
+        return len(ctx.starts)
+    return draw
+
+
+for columns, lines in DRAW_SIZES:
+    benchmark('draw {}x{}'.format(columns, lines))(drawBenchmark(columns, lines))
+
+
+@benchmark('unmapped in area')
+def unmappedArea(ctx):
+    for start in ctx.starts:
+        ctx.world.enter(start)
+        ctx.mapper.unmapped(False, True, False)
+    return len(ctx.starts)
+
+
+@benchmark('unmapped everywhere')
+def unmappedAll(ctx):
+    for start in ctx.starts:
+        ctx.world.enter(start)
+        ctx.mapper.unmapped(False, False, False)
+    return len(ctx.starts)
+
+
+@benchmark('assemble')
+def assemble(ctx):
+    for i in range(20):
+        for path in ctx.paths:
+            mapper.assemble(path, 'run')
+    return 20 * len(ctx.paths)
+
+
+@benchmark('trigger')
+def trigger(ctx):
+    for line in ctx.corpus:
+        ctx.world.trigger(line)
+    return len(ctx.corpus)
+
+
+@benchmark('triggerLines')
+def triggerLines(ctx):
+    for i in range(0, len(ctx.corpus), 20):
+        ctx.world.triggerLines(ctx.corpus[i:i + 20])
+    return len(ctx.corpus)
+
+
+@benchmark('alias')
+def alias(ctx):
+    for i in range(200):
+        for command in COMMANDS:
+            ctx.world.alias(command)
+    return 200 * len(COMMANDS)
+
+
+def measure(fn, ctx, repeat):
+    times = []
+    while len(times) < repeat and sum(times) < MAX_SECONDS:
+        start = time.perf_counter()
+        ops = fn(ctx)
+        times.append(time.perf_counter() - start)
+    # the best run is the one least disturbed by everything else on the machine
+    best = min(times)
+    return {'ops': ops, 'runs': len(times), 'best': best, 'median': statistics.median(times), 'us_per_op': best * 1e6 / ops}
+
+
+def run(names=None, repeat=REPEAT):
+    ctx = Context()
+    results = {}
+    for name, fn in BENCHMARKS:
+        if names and not any(part in name for part in names):
+            continue
+        results[name] = measure(fn, ctx, repeat)
+        print("{:<28} {:>12.1f} us/op".format(name, results[name]['us_per_op']), file=sys.stderr)
+    return {'meta': meta(repeat), 'results': results}
+
+
+def meta(repeat):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': repeat,
+            }
+
+
+# Returns {name: (baseline us/op, us/op, ratio, verdict)} for the benchmarks in both
+def compare(results, baseline, threshold=THRESHOLD):
+    out = {}
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        before, after = baseline['results'][name]['us_per_op'], result['us_per_op']
+        ratio = after / before if before else float('inf')
+        verdict = 'slower' if ratio > 1 + threshold else 'faster' if ratio < 1 / (1 + threshold) else ''
+        out[name] = (before, after, ratio, verdict)
+    return out
+
+
+def report(comparison):
+    out = ["{:<28} {:>12} {:>12} {:>8}".format('benchmark', 'before us', 'after us', 'ratio')]
+    for name, (before, after, ratio, verdict) in comparison.items():
+        out.append("{:<28} {:>12.1f} {:>12.1f} {:>7.2f}x {}".format(name, before, after, ratio, verdict))
+    return '\n'.join(out)
+
+
+def main():
+    args = sys.argv[1:]
+    options = {'--repeat': str(REPEAT), '--out': 'bench-results.json', '--baseline': BASELINE,
+            '--threshold': str(THRESHOLD)}
+    flags = {'--save-baseline': False, '--check': False}
+    names = []
+    while args:
+        if args[0] in options and len(args) > 1:
+            options[args[0]] = args[1]
+            args = args[2:]
+        elif args[0] in flags:
+            flags[args[0]] = True
+            args = args[1:]
+        elif args[0] == '-k' and len(args) > 1:
+            names.append(args[1])
+            args = args[2:]
+        else:
+            print("Usage: {} [-k name]... [--repeat n] [--out file] [--baseline file] [--threshold fraction] "
+                  "[--save-baseline] [--check]".format(sys.argv[0]))
+            exit(1)
+
+    results = run(names, int(options['--repeat']))
+    with open(options['--out'], 'w') as f:
+        json.dump(results, f, indent=1)
+    if flags['--save-baseline']:
+        with open(options['--baseline'], 'w') as f:
+            json.dump(results, f, indent=1)
+        print("Saved the baseline to", options['--baseline'])
+        return
+    if not os.path.exists(options['--baseline']):
+        print("No baseline to compare with; save one with --save-baseline")
+        return
+    with open(options['--baseline']) as f:
+        baseline = json.load(f)
+    comparison = compare(results, baseline, float(options['--threshold']))
+    print("Compared with {} (commit {}, {})".format(options['--baseline'], baseline['meta']['commit'], baseline['meta']['date']))
+    print(report(comparison))
+    if flags['--check'] and any(verdict == 'slower' for before, after, ratio, verdict in comparison.values()):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -823,8 +823,11 @@ TRIGGERS = {
         "The mayor says 'Hello .*. Hope you are enjoying your stay.'": 'drop box\nThese obligations have been met.',
         '^\[(\d  |\d\d |\d\d\d)%\] ([^[]+)$': setSkillLevel,
         }
-with open('passwords.json', 'rb') as pws:
-    TRIGGERS.update(json.load(pws))
+try:
+    with open('passwords.json', 'rb') as pws:
+        TRIGGERS.update(json.load(pws))
+except FileNotFoundError:
+    print("No passwords.json, won't log in by itself")
 
 
 class Coffee(modular.ModularClient):
@@ -926,18 +929,18 @@ class Coffee(modular.ModularClient):
                     })
 
     def stackToLag(self, cmds, target):
-        lag = 0
-        cmd = cmds.split('\n')[0]
+        cmds = cmds.split('\n')
         if target:
-            cmd = cmd + target
-        self.send(cmd)
-        for cmd in cmds.split('\n')[1:]:
-            self.timers["stackToLag" + cmd] = self.mkdelay(lag, lambda m, cmd=cmd: self.mud.send(cmd))
-            lag += 2.6
+            cmds[0] = cmds[0] + target
+        for cmd in cmds:
+            self.send_paced(cmd)
 
     def getHostPort(self):
         return 'coffeemud.net', 2324
 
+    def getPacing(self):
+        return 1, 0, 2.6  # combat lag is at most a couple of seconds
+
     def level(self):
         return self.gmcp['char']['status']['level']
 
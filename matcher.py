@@ -0,0 +1,323 @@
+import bisect
+import itertools
+import re
+import traceback
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+
+# Returns (literal, anchored): the longest run of plain characters that every match of the pattern contains, and
+# whether that run sits at the very start of the match. (None, False) if there's no such run.
+def requiredLiteral(pattern):
+    parsed = sre_parse.parse(pattern)
+    if parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return None, False
+
+    runs = []  # (start of run is start of match, chars)
+    current = []
+    state = {'atStart': True, 'currentAtStart': True}
+
+    def cut():
+        if current:
+            runs.append((state['currentAtStart'], ''.join(current)))
+            current.clear()
+        state['atStart'] = False
+
+    def walk(items):
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                if not current:
+                    state['currentAtStart'] = state['atStart']
+                current.append(chr(av))
+            elif op == sre_constants.AT:
+                continue  # zero-width, doesn't break a run
+            elif op == sre_constants.SUBPATTERN and not (av[1] & sre_constants.SRE_FLAG_IGNORECASE):
+                walk(av[-1])
+            else:
+                cut()
+
+    walk(parsed)
+    cut()
+    if not runs:
+        return None, False
+    anchored, literal = max(runs, key=lambda run: (len(run[1]), run[0]))
+    return literal, anchored
+
+
+# A regex matching any of the literals, longest first, shaped like a trie so the engine never tries more than a
+# handful of alternatives at any position
+def trieRegex(literals):
+    trie = {}
+    for literal in literals:
+        node = trie
+        for ch in literal:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def emit(node):
+        alts = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ''
+        body = alts[0] if len(alts) == 1 else '(?:' + '|'.join(alts) + ')'
+        if '' in node:
+            body = '(?:' + body + ')?'
+        return body
+
+    return '(?=(' + emit(trie) + '))'
+
+
+# Matches lines against an ordered list of regexes with re.match() semantics, first match wins. Only the patterns
+# whose required literal shows up in the line (plus those without one) are actually run.
+# Patterns are ordered by rank, which defaults to their position in the list.
+class Matcher(object):
+    def __init__(self, patterns, ranks=None):
+        self.entries = {}  # rank -> (pattern, compiled regex)
+        always = []
+        anchoredBy = {}  # literal -> ranks of patterns needing it at the start of the line
+        floatingBy = {}  # literal -> ranks of patterns needing it anywhere
+        for rank, pattern in zip(ranks if ranks is not None else itertools.count(), patterns):
+            try:
+                compiled = re.compile(pattern)
+                literal, anchored = requiredLiteral(pattern)
+            except Exception:
+                traceback.print_exc()
+                continue
+            self.entries[rank] = (pattern, compiled)
+            if not literal:
+                always.append(rank)
+            elif anchored:
+                anchoredBy.setdefault(literal, []).append(rank)
+            else:
+                floatingBy.setdefault(literal, []).append(rank)
+
+        self.always = frozenset(always)
+        literals = set(anchoredBy) | set(floatingBy)
+        # The prefilter reports the longest literal at each position; every shorter literal matching there is a
+        # prefix of it, so each literal stands for all of its prefixes too.
+        self.atStart = {}
+        self.anywhere = {}
+        for literal in literals:
+            start = set()
+            anywhere = set()
+            for i in range(1, len(literal) + 1):
+                prefix = literal[:i]
+                start.update(anchoredBy.get(prefix, ()))
+                anywhere.update(floatingBy.get(prefix, ()))
+            self.atStart[literal] = frozenset(start | anywhere)
+            self.anywhere[literal] = frozenset(anywhere)
+        self.prefilter = re.compile(trieRegex(literals)) if literals else None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def candidates(self, line, cands=None):
+        if cands is None:
+            cands = set()
+        cands |= self.always
+        if self.prefilter:
+            for m in self.prefilter.finditer(line):
+                cands |= self.atStart[m.group(1)] if m.start() == 0 else self.anywhere[m.group(1)]
+        return cands
+
+    # Candidates for each line of a chunk in one prefilter pass. text is '\n'.join(lines), starts are the offsets
+    # of the lines in it.
+    def chunkCandidates(self, text, starts, cands):
+        for c in cands:
+            c |= self.always
+        if not self.prefilter:
+            return cands
+        for m in self.prefilter.finditer(text):
+            start = m.start()
+            i = bisect.bisect_right(starts, start) - 1
+            cands[i] |= self.atStart[m.group(1)] if start == starts[i] else self.anywhere[m.group(1)]
+        return cands
+
+    def first(self, line, cands):
+        for rank in sorted(cands):
+            pattern, compiled = self.entries[rank]
+            m = compiled.match(line)
+            if m:
+                return pattern, m
+        return None, None
+
+    # Returns (pattern, match object) of the first pattern matching, or (None, None)
+    def match(self, line):
+        return self.first(line, self.candidates(line))
+
+    # Same as [self.match(line) for line in lines], with one prefilter pass over the whole chunk
+    def matchAll(self, lines):
+        text, starts = joinLines(lines)
+        cands = self.chunkCandidates(text, starts, [set() for _ in lines])
+        return [self.first(line, c) for line, c in zip(lines, cands)]
+
+
+def joinLines(lines):
+    starts = []
+    pos = 0
+    for line in lines:
+        starts.append(pos)
+        pos += len(line) + 1
+    return '\n'.join(lines), starts
+
+
+# A dict of pattern -> response that keeps a Matcher for its keys up to date as it's edited. Patterns are split
+# into shards, and an edit only recompiles the shard it touched. Patterns added with a group go into that group's
+# own shard, so a whole group can be switched off and on without recompiling anything.
+class Table(dict):
+    SHARD_SIZE = 64
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.rank = {}  # key -> insertion counter, so ranks follow dict order
+        self.nextRank = 0
+        self.shardOf = {}  # key -> shard id
+        self.shards = {}  # shard id -> set of keys
+        self.groups = {}  # shard id -> group name
+        self.disabled = set()  # group names
+        self.matchers = {}  # shard id -> Matcher, for clean shards only
+        self.nextShard = 0
+        self.openShard = None  # shard collecting ungrouped keys
+        self.version = 0  # bumped on every edit that can change what matches
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.added(key, None)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.removed(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.removed(key)
+        return key, value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    # Adds (or moves) key into the named group
+    def add(self, key, value, group=None):
+        if key in self and self.groups.get(self.shardOf[key]) != group:
+            del self[key]
+        if key not in self:
+            self.added(key, group)
+        super().__setitem__(key, value)
+
+    def enableGroup(self, group):
+        if group in self.disabled:
+            self.disabled.discard(group)
+            self.version += 1
+
+    def disableGroup(self, group):
+        if group not in self.disabled:
+            self.disabled.add(group)
+            self.version += 1
+
+    def removeGroup(self, group):
+        for shard, name in list(self.groups.items()):
+            if name == group:
+                for key in list(self.shards[shard]):
+                    del self[key]
+        self.disabled.discard(group)
+
+    def added(self, key, group):
+        if group is not None:
+            shard = ('group', group)
+            self.groups[shard] = group
+        else:
+            if self.openShard is None or len(self.shards[self.openShard]) >= self.SHARD_SIZE:
+                self.openShard = self.nextShard
+                self.nextShard += 1
+            shard = self.openShard
+        self.rank[key] = self.nextRank
+        self.nextRank += 1
+        self.shardOf[key] = shard
+        self.shards.setdefault(shard, set()).add(key)
+        self.matchers.pop(shard, None)
+        self.version += 1
+
+    def removed(self, key):
+        shard = self.shardOf.pop(key)
+        del self.rank[key]
+        self.shards[shard].discard(key)
+        if not self.shards[shard]:
+            del self.shards[shard]
+            self.groups.pop(shard, None)
+            if shard == self.openShard:
+                self.openShard = None
+        self.matchers.pop(shard, None)
+        self.version += 1
+
+    def activeMatchers(self):
+        out = []
+        for shard, keys in self.shards.items():
+            if self.groups.get(shard) in self.disabled:
+                continue
+            m = self.matchers.get(shard)
+            if m is None:
+                ordered = sorted(keys, key=self.rank.__getitem__)
+                m = self.matchers[shard] = Matcher(ordered, [self.rank[key] for key in ordered])
+            out.append(m)
+        return out
+
+    def first(self, line, matchers, cands):
+        best = None
+        for m in matchers:
+            mine = cands & m.entries.keys()
+            if best is not None:
+                mine = {rank for rank in mine if rank < best[0]}
+            for rank in sorted(mine):
+                pattern, compiled = m.entries[rank]
+                match = compiled.match(line)
+                if match:
+                    best = (rank, pattern, match)
+                    break
+        if best is None:
+            return None, None
+        return best[1], best[2]
+
+    # Returns (key, match object) of the first enabled key matching, or (None, None)
+    def match(self, line):
+        matchers = self.activeMatchers()
+        cands = set()
+        for m in matchers:
+            m.candidates(line, cands)
+        return self.first(line, matchers, cands)
+
+    def matchAll(self, lines):
+        matchers = self.activeMatchers()
+        text, starts = joinLines(lines)
+        cands = [set() for _ in lines]
+        for m in matchers:
+            m.chunkCandidates(text, starts, cands)
+        return [self.first(line, matchers, c) for line, c in zip(lines, cands)]
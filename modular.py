@@ -1,66 +1,123 @@
+import heapq
+import itertools
+import matcher
 import re
-import threading
 import time
+import traceback
+
+
+STACK_SEPARATOR = re.compile(r'(?<=[^;]);(?=[^;])')  # a lone ';', ';;' escapes it
+SPAM = re.compile(r'#(\d+) (.+)')
+HOOKS = ('trigger', 'alias', 'handleGmcp', 'quit')
+TIMER_MIN_PERIOD = 0.1
 
 
 def stack(line):
     assert('\n' not in line)
-    out = []
-    startmatch = 0
-    for i in range(1, len(line) - 1):
-        if line[i] == ';' and line[i-1] != ';' and line[i+1] != ';':
-            out.append(line[startmatch:i].replace(';;', ';'))
-            startmatch = i + 1
-    out.append(line[startmatch:].replace(';;', ';'))
-    return out
+    if ';' not in line:
+        return [line]
+    return [part.replace(';;', ';') for part in STACK_SEPARATOR.split(line)]
+
+
+# The timers dict, telling the scheduler about every edit
+class TimerTable(dict):
+    def __init__(self, onSet, onDel, timers):
+        super().__init__()
+        self.onSet = onSet
+        self.onDel = onDel
+        self.update(timers)
+
+    def __setitem__(self, name, timer):
+        super().__setitem__(name, timer)
+        self.onSet(name, timer)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.onDel(name)
+
+    def update(self, *args, **kwargs):
+        for name, timer in dict(*args, **kwargs).items():
+            self[name] = timer
+
+    def setdefault(self, name, timer=None):
+        if name not in self:
+            self[name] = timer
+        return self[name]
+
+    def pop(self, name, *default):
+        if name in self:
+            timer = self[name]
+            del self[name]
+            return timer
+        if default:
+            return default[0]
+        raise KeyError(name)
+
+    def clear(self):
+        for name in list(self):
+            del self[name]
 
 
 class TimerMixin(object):
-    def __init__(self):
-        self.previous_checkpoint = time.time()
-        self.stopflag = threading.Event()
-        self.timer_thread = threading.Thread(target=TimerMixin.timer_thread_fn, args=(self,))
-        self.timer_thread.start()
-
-    def timer_thread_fn(self):
-        while not self.stopflag.is_set():
-            now = time.time()
-            delta = now - self.previous_checkpoint
-            self.timeslice(delta)
-            self.previous_checkpoint = now
-            time.sleep(0.1)
-
-    def timeslice(self, delta):
-        def update(name, rem_time):
-            timer = self.timers[name]
-            self.timers[name] = (timer[0], timer[1], rem_time, timer[3])
-            return rem_time
-
-        # deep copy timers to permit editing timers inside timers (changes dict size)
-        tmp_timers = {}
-        for name, timer in self.timers.items():
-            tmp_timers[name] = timer
-
-        remove = []
-        try:
-            for name, timer in tmp_timers.items():
-                oneshot, period, remaining, fn = timer
-                remaining = update(name, remaining - delta)
-                if remaining < 0:
-                    if oneshot:
-                        remove.append(name)
-                    else:
-                        update(name, period)
-                    try:
-                        fn(self)
-                    except Exception as e:
-                        self.log(e)
-        except RuntimeError as e:
-            # RuntimeError: dictionary changed size during iteration
-            self.log(e)
-
-        for name in remove:
-            del self.timers[name]
+    # Timers are kept in a heap ordered by deadline, and the session's event loop is woken exactly when the
+    # earliest one is due. Rescheduling or deleting a timer leaves a stale heap entry behind, recognized by its
+    # generation number and skipped.
+    def __init__(self, loop):
+        self.loop = loop
+        self.timerHeap = []  # (deadline, generation, name)
+        self.timerGeneration = {}  # name -> generation of its live heap entry
+        self.timerCounter = itertools.count()
+        self.timer_handle = None
+        self.timerWake = None
+        self.timers = TimerTable(self.scheduleTimer, self.unscheduleTimer, self.timers)
+
+    def scheduleTimer(self, name, timer):
+        deadline = self.loop.time() + max(timer[2], 0)
+        generation = next(self.timerCounter)
+        self.timerGeneration[name] = generation
+        heapq.heappush(self.timerHeap, (deadline, generation, name))
+        if len(self.timerHeap) > 2 * len(self.timerGeneration) + 64:
+            self.timerHeap = [entry for entry in self.timerHeap if self.timerGeneration.get(entry[2]) == entry[1]]
+            heapq.heapify(self.timerHeap)
+        self.wakeAt(deadline)
+
+    def unscheduleTimer(self, name):
+        self.timerGeneration.pop(name, None)
+
+    def wakeAt(self, deadline):
+        if self.timer_handle is not None:
+            if self.timerWake <= deadline:
+                return
+            self.timer_handle.cancel()
+        self.timerWake = deadline
+        self.timer_handle = self.loop.call_at(deadline, self.runTimers)
+
+    def runTimers(self):
+        self.timer_handle = None
+        heap = self.timerHeap
+        now = self.loop.time()
+        while heap and heap[0][0] <= now:
+            deadline, generation, name = heapq.heappop(heap)
+            if self.timerGeneration.get(name) != generation:
+                continue
+            oneshot, period, remaining, fn = self.timers[name]
+            if oneshot:
+                del self.timers[name]
+            else:
+                nextDeadline = deadline + period
+                if nextDeadline <= now:  # fell behind, don't fire a burst to catch up
+                    nextDeadline = now + max(period, TIMER_MIN_PERIOD)
+                generation = next(self.timerCounter)
+                self.timerGeneration[name] = generation
+                heapq.heappush(heap, (nextDeadline, generation, name))
+            try:
+                fn(self)
+            except Exception as e:
+                self.log(e)
+        while heap and self.timerGeneration.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+        if heap:
+            self.wakeAt(heap[0][0])
 
     @staticmethod
     def mktimer(period, fn, oneshot=False):
@@ -75,28 +132,78 @@ class TimerMixin(object):
         return (True, delay, delay, fn)
 
     def quit(self):
-        self.stopflag.set()
-        self.timer_thread.join()
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        self.timerGeneration.clear()
+        self.timerHeap.clear()
 
     def setTimerRemaining(self, timer, remainingTime):
         self.timers[timer] = (self.timers[timer][0], self.timers[timer][1], remainingTime, self.timers[timer][3])
 
 
+# A module's method the client calls for every line/message, and how long it has spent in it
+class Hook(object):
+    __slots__ = ('module', 'name', 'fn', 'calls', 'seconds')
+
+    def __init__(self, module, name, fn):
+        self.module = module
+        self.name = name
+        self.fn = fn
+        self.calls = 0
+        self.seconds = 0.0
+
+
 class ModularClient(TimerMixin):
     def __init__(self, mud):
         # self.modules must be set up by child class
         self.mud = mud
+        self.stats = mud.stats
         self.state = {}
         self.gmcp = {}
-        self.aliases = {}
-        self.triggers = {}
+        self.aliases = matcher.Table()
+        self.triggers = matcher.Table()
         self.timers = self.getTimers()
-        TimerMixin.__init__(self)
+        TimerMixin.__init__(self, mud.loop)
         for m in self.modules.values():
             m.world = self
             self.aliases.update(m.getAliases())
             self.triggers.update(m.getTriggers())
             self.timers.update(m.getTimers())
+        self.buildHooks()
+
+    # Per-hook lists of the modules implementing it, in priority order. Call again after changing self.modules.
+    # Lines go to modules' alias() in priority order. Commands registered with getCommands() are only offered
+    # lines starting with their token, routed through a dict lookup on the first word.
+    def buildHooks(self):
+        self.hooks = {name: [] for name in HOOKS}
+        self.aliasRoutes = {}
+        for token, handler in self.getCommands().items():
+            self.aliasRoutes[token] = [Hook('client', token, handler)]
+        for modname, m in self.modules.items():
+            for token, handler in m.getCommands().items():
+                self.aliasRoutes.setdefault(token.lower(), list(self.hooks['alias'])).append(Hook(modname, token, handler))
+            for name in HOOKS:
+                if hasattr(m, name):
+                    hook = Hook(modname, name, getattr(m, name))
+                    self.hooks[name].append(hook)
+                    if name == 'alias':
+                        for route in self.aliasRoutes.values():
+                            route.append(hook)
+
+    def getCommands(self):
+        return {
+                '#hooks': self.showHooks,
+                }
+
+    def showHooks(self, line):
+        hooks = {id(hook): hook for hooks in list(self.hooks.values()) + list(self.aliasRoutes.values()) for hook in hooks}
+        out = ["{:<30} {:>10} {:>12} {:>10}".format('hook', 'calls', 'total ms', 'avg us')]
+        for hook in sorted(hooks.values(), key=lambda hook: -hook.seconds):
+            out.append("{:<30} {:>10} {:>12.1f} {:>10.1f}".format(
+                hook.module + '.' + hook.name, hook.calls, hook.seconds * 1000, hook.seconds * 1e6 / max(hook.calls, 1)))
+        self.log('\n'.join(out))
+        return True
 
     def getHostPort(self):
         for m in self.modules.values():
@@ -116,62 +223,105 @@ class ModularClient(TimerMixin):
         else:
             line = sublines[0]
 
-        if re.match(r'#\d+ .+', line):
-            match = re.match(r'#(\d+) (.+)', line)
-            times, cmd = match.groups()
+        spam = SPAM.match(line)
+        if spam:
+            times, cmd = spam.groups()
             for i in range(int(times)):
                 if not self.alias(cmd):
                     self.send(cmd)
             return True
 
-        for alias, action in self.aliases.items():
-            if re.match(alias, line):
-                if isinstance(action, str):
-                    self.send(action)
-                else:
-                    output = action(self, re.match(alias, line).groups())
-                    if output:  # might be for side effects
-                        self.send(output)
+        alias, match = self.aliases.match(line)
+        if alias is not None:
+            action = self.aliases[alias]
+            if isinstance(action, str):
+                self.send(action)
+            else:
+                output = action(self, match.groups())
+                if output:  # might be for side effects
+                    self.send(output)
+            return True
+
+        # If alias wants to signal that it consumed the command, return True -- it won't be sent to MUD then
+        # Otherwise, the line is sent to MUD
+        for hook in self.aliasRoutes.get(line.partition(' ')[0].lower(), self.hooks['alias']):
+            start = time.perf_counter()
+            consumed = hook.fn(line)
+            hook.seconds += time.perf_counter() - start
+            hook.calls += 1
+            if consumed:
                 return True
-        else:
-            for module in self.modules.values():
-                # If alias wants to signal that it consumed the command, return True -- it won't be sent to MUD then
-                # Otherwise, the line is sent to MUD
-                if hasattr(module, 'alias'):
-                    if module.alias(line):
-                        return True
         return False
 
+    def fireTrigger(self, trigger, match):
+        self.stats.count('trigger hits')
+        response = self.triggers[trigger]
+        if isinstance(response, str):
+            self.send(response)
+        else:
+            output = response(self, match.groups())
+            if output:  # might be for side effects
+                self.send(output)
+
     def trigger(self, raw):
+        start = time.perf_counter()
         stripped = self.mud.strip_ansi(raw).strip()
+        trigger, match = self.triggers.match(stripped)
+        self.stats.record('trigger match', time.perf_counter() - start)
+        if trigger is not None:
+            self.fireTrigger(trigger, match)
+        return self.moduleTriggers(raw, stripped)
 
-        for trigger, response in self.triggers.items():
-            if re.match(trigger, stripped):
-                if isinstance(response, str):
-                    self.send(response)
-                else:
-                    output = response(self, re.match(trigger, stripped).groups())
-                    if output:  # might be for side effects
-                        self.send(output)
-                break
+    # Like trigger(), for all complete lines of a received chunk at once. Returns the list of replacements.
+    def triggerLines(self, raws):
+        if not raws:
+            return []
+        start = time.perf_counter()
+        strippeds = [self.mud.strip_ansi(raw).strip() for raw in raws]
+        version = self.triggers.version
+        matches = self.triggers.matchAll(strippeds)
+        self.stats.record('trigger match', (time.perf_counter() - start) / len(raws), len(raws))
+        replacements = []
+        for i, (raw, stripped) in enumerate(zip(raws, strippeds)):
+            replacement = None
+            try:
+                if version != self.triggers.version:  # a trigger edited the triggers
+                    version = self.triggers.version
+                    matches[i:] = self.triggers.matchAll(strippeds[i:])
+                trigger, match = matches[i]
+                if trigger is not None:
+                    start = time.perf_counter()
+                    self.fireTrigger(trigger, match)
+                    self.stats.record('trigger fire', time.perf_counter() - start)
+                replacement = self.moduleTriggers(raw, stripped)
+            except Exception:
+                traceback.print_exc()
+            replacements.append(replacement)
+        return replacements
 
+    def moduleTriggers(self, raw, stripped):
         replacement = None
-        for module in self.modules.values():
-            if hasattr(module, 'trigger'):
-                repl = module.trigger(raw, stripped)
-                if replacement is None and repl is not None:  # modules come in order of priority, so first one wins
-                    replacement = repl
+        begin = time.perf_counter()
+        for hook in self.hooks['trigger']:
+            start = time.perf_counter()
+            repl = hook.fn(raw, stripped)
+            hook.seconds += time.perf_counter() - start
+            hook.calls += 1
+            if replacement is None and repl is not None:  # modules come in order of priority, so first one wins
+                replacement = repl
+        self.stats.record('module hooks', time.perf_counter() - begin)
         return replacement
 
     def handleGmcp(self, cmd, value):
-        for module in self.modules.values():
-            if hasattr(module, 'handleGmcp'):
-                module.handleGmcp(cmd, value)
+        for hook in self.hooks['handleGmcp']:
+            start = time.perf_counter()
+            hook.fn(cmd, value)
+            hook.seconds += time.perf_counter() - start
+            hook.calls += 1
 
     def quit(self):
-        for module in self.modules.values():
-            if hasattr(module, 'quit'):
-                module.quit()
+        for hook in self.hooks['quit']:
+            hook.fn()
         self.log("Stopping timers")
         TimerMixin.quit(self)
         self.log("Stopped timers")
@@ -179,6 +329,9 @@ class ModularClient(TimerMixin):
     def send(self, *args):
         self.mud.send(*args)
 
+    def send_paced(self, *args):
+        self.mud.send_paced(*args)
+
     def log(self, *args, **kwargs):
         self.mud.log(*args, **kwargs)
 
@@ -188,5 +341,19 @@ class ModularClient(TimerMixin):
     def getTimers(self):
         return {}
 
+    # (max commands in flight without a prompt back, min seconds between paced commands, seconds to wait for a prompt)
+    def getPacing(self):
+        return 1, 0, 5
+
+    # (bytes, seconds): how much of the output buffered while no frontend was connected to replay when one connects,
+    # and how old it may be (None for no limit)
+    def getReplay(self):
+        return 64 * 1024, None
+
+    # What to do with output for a frontend that can't keep up: 'spill' it to disk until the frontend catches up, or
+    # 'coalesce' it, skipping ahead to the newest output
+    def getSlowFrontendPolicy(self):
+        return 'spill'
+
 def getClass():
     return ModularClient
@@ -6,6 +6,9 @@ class BaseModule(object):
     def send(self, line):
         return self.mud.send(line)
 
+    def send_paced(self, line):
+        return self.mud.send_paced(line)
+
     def show(self, line):
         return self.mud.show(line)
 
@@ -18,6 +21,11 @@ class BaseModule(object):
     def getAliases(self):
         return {}
 
+    # Commands are first words of a line (like '#map') mapped to callables taking the whole line. Only lines starting
+    # with the command are offered to the callable; it returns True if it consumed the line.
+    def getCommands(self):
+        return {}
+
     # Timers are names mapped to tuples of (oneshot, period, remaining time until period boundary, callable)
     def getTimers(self):
         return {}
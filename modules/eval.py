@@ -3,7 +3,13 @@ from pprint import pformat
 
 
 class Eval(BaseModule):
-    def alias(self, line):
+    def getCommands(self):
+        return {
+                '#py': self.evaluate,
+                '#pye': self.evaluate,
+                }
+
+    def evaluate(self, line):
         if line.startswith('#py '):
             rest = line[4:]
             self.mud.log("\n" + pformat(eval(rest)))
@@ -1,24 +1,40 @@
 from modules.basemodule import BaseModule
-import subprocess
+from modules import logsearch
+from modules import logwriter
 
 
 class Logging(BaseModule):
     def __init__(self, mud, logfname):
         self.logfname = logfname
-        self.file = open(logfname, 'a', buffering=1)
+        self.writer = logwriter.acquire()
+        self.writer.open(logfname, open(logfname, 'ab'), logsearch.BlockIndexer(logfname))
+        self.searcher = logsearch.LogSearch(logfname)
         super().__init__(mud)
 
     def quit(self):
-        self.file.close()
+        self.writer.close(self.logfname)
+        logwriter.release()
 
-    def alias(self, line):
+    def getCommands(self):
+        return {
+                '#grep': self.grep,
+                '#logwriter': self.stats,
+                }
+
+    def grep(self, line):
         if line.startswith('#grep '):
-            arg = line[len('#grep '):]
-            grep = subprocess.Popen(['/bin/sh', '-c', 'tail -n10000 {} | grep -a {}'.format(self.logfname, arg)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = grep.communicate(timeout=5)
-            self.mud.log('\n' + out.decode('utf-8'))
+            self.writer.flush()
+            self.mud.log('\n' + logsearch.grep(self.searcher, line[len('#grep '):]))
             return True
-        self.file.write('> ' + line + '\n')
+
+    def stats(self, line):
+        records, size = self.writer.depth()
+        self.mud.log("Log writer: {} records ({} bytes) queued, {} bytes written in {} commits".format(
+            records, size, self.writer.bytesWritten, self.writer.commits))
+        return True
+
+    def alias(self, line):
+        self.writer.write(self.logfname, '> ' + line + '\n')
 
     def trigger(self, raw, stripped):
-        self.file.write(raw + '\n')
+        self.writer.write(self.logfname, raw + '\n')
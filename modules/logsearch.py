@@ -0,0 +1,468 @@
+import collections
+import mmap
+import os
+import re
+import struct
+import time
+import traceback
+import zlib
+
+import matcher
+
+BLOCK_SIZE = 256 * 1024  # a block is cut once it holds this many bytes,
+BLOCK_SECONDS = 60  # or once it spans this many seconds
+# offset, length, lines, first and last timestamp, size of the trigram bitmap that follows, number of MARKs after it
+RECORD = struct.Struct('<QIIddII')
+MARK = struct.Struct('<Id')  # where in the block a write starts, and when it was written
+
+
+def trigrams(data):
+    out = set()
+    for line in set(data.split(b'\n')):
+        out.update(zip(line, line[1:], line[2:]))
+    return out
+
+
+def trigramBit(trigram, bits):
+    a, b, c = trigram
+    return ((a << 16 | b << 8 | c) * 2654435761 & 0xffffffff) % bits
+
+
+# One bit per distinct trigram, sized so about a fifth of the bits end up set
+def makeBitmap(grams):
+    bits = 1024
+    while bits < 4 * len(grams):
+        bits *= 2
+    bitmap = bytearray(bits // 8)
+    for trigram in grams:
+        bit = trigramBit(trigram, bits)
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+    return bitmap
+
+
+# Whether the bitmap at data[offset:offset + size] has the bits of all the trigrams set
+def mayContain(data, offset, size, grams):
+    bits = size * 8
+    for trigram in grams:
+        bit = trigramBit(trigram, bits)
+        if not data[offset + (bit >> 3)] & (1 << (bit & 7)):
+            return False
+    return True
+
+
+# '90s', '15m', '2h', '3d' ago, or a date like '2024-05-01' or '2024-05-01 18:30'
+def parseTime(text, now=None):
+    now = time.time() if now is None else now
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([smhd])', text)
+    if m:
+        return now - float(m.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise ValueError("Can't make sense of time '{}'".format(text))
+
+
+# #grep [-n limit] [-s since] [-u until] pattern
+# Returns (pattern, since, until, limit)
+def parseQuery(arg):
+    since = until = None
+    limit = 50
+    while True:
+        m = re.match(r'-([nsu]) +("[^"]*"|\S+) +', arg)
+        if not m:
+            break
+        value = m.group(2).strip('"')
+        if m.group(1) == 'n':
+            limit = int(value)
+            if limit < 1:
+                raise ValueError("-n needs a limit of at least 1")
+        elif m.group(1) == 's':
+            since = parseTime(value)
+        else:
+            until = parseTime(value)
+        arg = arg[m.end():]
+    return arg, since, until, limit
+
+
+# Sidecar index of a log file, in logfname + '.idx': a RECORD, a trigram bitmap and the MARKs of the writes for
+# each block of lines. Blocks written before there was an index have no timestamps (0), which makes them older than
+# anything else.
+class BlockIndex(object):
+    def __init__(self, path):
+        self.path = path
+        # (offset, length, lines, first time, last time, bitmap offset in the index, bitmap size, number of marks)
+        self.blocks = []
+        self.parsed = 0  # bytes of the index file read so far
+
+    def load(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size < self.parsed:  # rebuilt from scratch
+            self.blocks = []
+            self.parsed = 0
+        if size == self.parsed:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.parsed)
+            data = f.read(size - self.parsed)
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            offset, length, lines, first, last, bitmapSize, marks = RECORD.unpack_from(data, pos)
+            size = RECORD.size + bitmapSize + marks * MARK.size
+            if pos + size > len(data):
+                break  # still being written
+            self.blocks.append((offset, length, lines, first, last, self.parsed + pos + RECORD.size, bitmapSize, marks))
+            pos += size
+        self.parsed += pos
+
+    def end(self):
+        if not self.blocks:
+            return 0
+        offset, length = self.blocks[-1][:2]
+        return offset + length
+
+    def lines(self):
+        return sum(block[2] for block in self.blocks)
+
+
+# Keeps the index of a plain log file up to date. Lives in the log writer thread: add() is called with every
+# chunk of whole lines written to the log.
+class BlockIndexer(object):
+    def __init__(self, logPath):
+        self.logPath = logPath
+        self.path = logPath + '.idx'
+        self.file = None
+        self.start = self.length = self.lines = 0
+        self.first = self.last = 0
+        self.grams = set()
+        self.marks = []  # (offset in the block, time) of each add()
+
+    # Indexes whatever the log has that the index doesn't
+    def open(self):
+        index = BlockIndex(self.path)
+        index.load()
+        size = os.path.getsize(self.logPath) if os.path.exists(self.logPath) else 0
+        end = index.end()
+        if end > size:  # the log was truncated or replaced
+            os.remove(self.path)
+            end = 0
+        self.file = open(self.path, 'ab')
+        self.file.truncate(index.parsed if end else 0)
+        self.start = end
+        if end < size:
+            with open(self.logPath, 'rb') as f:
+                f.seek(end)
+                while True:
+                    data = f.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    cut = data.rfind(b'\n') + 1
+                    if cut and cut < len(data):
+                        f.seek(cut - len(data), os.SEEK_CUR)
+                        data = data[:cut]
+                    self.add(data, 0)
+                    self.cut()
+        self.file.flush()
+
+    def add(self, data, now):
+        if self.length and (self.length >= BLOCK_SIZE or now - self.first >= BLOCK_SECONDS):
+            self.cut()
+        if not self.length:
+            self.first = now
+        self.last = now
+        self.marks.append((self.length, now))
+        self.length += len(data)
+        self.lines += data.count(b'\n')
+        self.grams |= trigrams(data)
+
+    def cut(self):
+        if not self.length:
+            return
+        start, self.start = self.start, self.start + self.length
+        self.file.write(self.record(start, self.length))
+
+    # The index entry of the block, which starts afresh
+    def record(self, start, length):
+        bitmap = makeBitmap(self.grams)
+        out = RECORD.pack(start, length, self.lines, self.first, self.last, len(bitmap), len(self.marks)) + bitmap
+        out += b''.join(MARK.pack(*mark) for mark in self.marks)
+        self.length = self.lines = 0
+        self.grams = set()
+        self.marks = []
+        return out
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.cut()
+        self.file.close()
+
+
+# A gzip log made of one gzip member per block, so every block can be decompressed on its own. zcat reads it like
+# any other gzip file. Its index (logfname + '.idx') has the offsets of the compressed members, and it's the log
+# writer that uses it in place of a file: it compresses, and indexes, in the writer thread.
+# Every flush() ends with a zlib sync flush, so after a crash the last member can be closed where it was cut off.
+class BlockGzipLog(BlockIndexer):
+    def __init__(self, logPath, level=9):
+        super().__init__(logPath)
+        self.log = open(logPath, 'ab')
+        self.level = level
+        self.compressor = None
+        self.ready = False
+
+    def open(self):
+        index = BlockIndex(self.path)
+        index.load()
+        size = os.path.getsize(self.logPath)
+        end = index.end()
+        if end > size:  # the log was truncated or replaced
+            os.remove(self.path)
+            index = BlockIndex(self.path)
+            end = 0
+        self.file = open(self.path, 'ab')
+        self.file.truncate(index.parsed)
+        if end < size:
+            self.recover(end)
+        self.log.seek(0, os.SEEK_END)
+        self.ready = True
+
+    # Indexes the members after the last indexed one as one block: a log from before blocks, or the member cut
+    # off by a crash. The latter is closed if it ends at a sync flush, dropped if it was cut off mid-write.
+    def recover(self, start):
+        lines = 0
+        grams = set()
+        good = pos = start  # end of the last complete member, end of what's been read
+        with open(self.logPath, 'rb') as f:
+            f.seek(start)
+            decompressor = zlib.decompressobj(31)
+            crc = size = 0
+            memberLines = 0
+            memberGrams = set()
+            tail = b''
+            broken = False
+            try:
+                while True:
+                    chunk = f.read(BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    tail = (tail + chunk)[-4:]
+                    while chunk:
+                        out = decompressor.decompress(chunk)
+                        crc = zlib.crc32(out, crc)
+                        size += len(out)
+                        memberLines += out.count(b'\n')
+                        memberGrams |= trigrams(out)
+                        if not decompressor.eof:
+                            pos += len(chunk)
+                            break
+                        pos += len(chunk) - len(decompressor.unused_data)
+                        chunk = decompressor.unused_data
+                        good = pos
+                        lines += memberLines
+                        grams |= memberGrams
+                        decompressor = zlib.decompressobj(31)
+                        crc = size = memberLines = 0
+                        memberGrams = set()
+            except zlib.error:  # garbage, leave it be
+                broken = True
+        if pos > good and not broken:
+            if tail == b'\x00\x00\xff\xff':
+                # an empty final block and the gzip trailer
+                self.log.seek(0, os.SEEK_END)
+                self.log.write(b'\x03\x00' + struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+                self.log.flush()
+                good = self.log.tell()
+                lines += memberLines
+                grams |= memberGrams
+            self.log.truncate(good)
+        if good > start:
+            bitmap = makeBitmap(grams)
+            self.file.write(RECORD.pack(start, good - start, lines, 0, 0, len(bitmap), 0) + bitmap)
+            self.file.flush()
+
+    def write(self, data):
+        if not self.ready:
+            self.open()
+        self.add(data, time.time())  # may close the previous block
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            self.start = self.log.tell()
+        self.log.write(self.compressor.compress(data))
+
+    def flush(self):
+        if not self.ready:
+            return
+        if self.compressor:
+            self.log.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.log.flush()
+        self.file.flush()
+
+    def cut(self):
+        if self.compressor is None:
+            return
+        self.log.write(self.compressor.flush())
+        self.compressor = None
+        self.file.write(self.record(self.start, self.log.tell() - self.start))
+
+    def close(self):
+        if self.ready:
+            self.cut()
+            self.file.close()
+        self.log.close()
+
+
+# Decompresses gzip members, for as long as there are complete ones (or the beginning of one)
+def gunzip(data):
+    out = []
+    while data:
+        decompressor = zlib.decompressobj(31)
+        try:
+            out.append(decompressor.decompress(data))
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            break
+        data = decompressor.unused_data
+    return b''.join(out)
+
+
+def lineAt(data, pos, start, end):
+    lineStart = data.rfind(b'\n', start, pos) + 1
+    if lineStart < start:
+        lineStart = start
+    lineEnd = data.find(b'\n', pos, end)
+    if lineEnd == -1:
+        lineEnd = end
+    return lineStart, lineEnd
+
+
+# Yields the lines of data[start:end] matching regex, in order. literal, if given, is bytes every match contains.
+def searchRange(data, start, end, regex, literal):
+    if literal:
+        pos = data.find(literal, start, end)
+        while pos != -1:
+            lineStart, lineEnd = lineAt(data, pos, start, end)
+            line = data[lineStart:lineEnd].decode('utf-8', 'replace')
+            if regex.search(line):
+                yield line
+            pos = data.find(literal, lineEnd, end)
+    else:
+        lines = data[start:end].decode('utf-8', 'replace').split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        for line in lines:
+            if regex.search(line):
+                yield line
+
+
+def readMarks(data, offset, count):
+    return [MARK.unpack_from(data, offset + i * MARK.size) for i in range(count)]
+
+
+# The parts of a block's lines, at buf[start:end], written between since and until (either may be None), going by
+# the marks of its writes. Without marks, that's all of it.
+def inTime(marks, start, end, since, until):
+    if not marks:
+        return [(start, end)]
+    ranges = []
+    for i, (pos, when) in enumerate(marks):
+        if (since is not None and when < since) or (until is not None and when > until):
+            continue
+        rangeStart = start + pos
+        rangeEnd = start + marks[i + 1][0] if i + 1 < len(marks) else end
+        if ranges and ranges[-1][1] == rangeStart:
+            ranges[-1] = (ranges[-1][0], rangeEnd)
+        else:
+            ranges.append((rangeStart, rangeEnd))
+    return ranges
+
+
+def compileQuery(pattern):
+    regex = re.compile(pattern)
+    literal, anchored = matcher.requiredLiteral(pattern)
+    literal = literal.encode('utf-8') if literal else None
+    grams = trigrams(literal) if literal else set()
+    return regex, literal, grams
+
+
+# Searches a plain log file through mmap, using its BlockIndex to skip blocks that can't match
+class LogSearch(object):
+    def __init__(self, logPath):
+        self.logPath = logPath
+        self.index = BlockIndex(logPath + '.idx')
+        self.blocksRead = 0
+
+    # Returns the last `limit` matching lines, oldest first
+    def search(self, pattern, since=None, until=None, limit=50):
+        regex, literal, grams = compileQuery(pattern)
+        self.index.load()
+        self.blocksRead = 0
+        try:
+            size = os.path.getsize(self.logPath)
+        except OSError:
+            return []
+        if not size:
+            return []
+        found = collections.deque()
+        with open(self.logPath, 'rb') as logFile, mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            idxData = b''
+            if self.index.blocks:
+                with open(self.index.path, 'rb') as idxFile:
+                    idxData = mmap.mmap(idxFile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # the tail not indexed yet was written just now
+                end = min(self.index.end(), size)
+                if until is None and end < size:
+                    found.extendleft(reversed(list(searchRange(*self.read(data, end, size), regex, literal))))
+                for offset, length, lines, first, last, bitmapOffset, bitmapSize, marks in reversed(self.index.blocks):
+                    if len(found) >= limit:
+                        break
+                    if since is not None and last < since:
+                        break
+                    if until is not None and first > until:
+                        continue
+                    if grams and not mayContain(idxData, bitmapOffset, bitmapSize, grams):
+                        continue
+                    self.blocksRead += 1
+                    buf, start, end = self.read(data, offset, min(offset + length, size))
+                    ranges = [(start, end)]
+                    if (since is not None and first < since) or (until is not None and last > until):
+                        # only part of the block is in the time range
+                        ranges = inTime(readMarks(idxData, bitmapOffset + bitmapSize, marks), start, end, since, until)
+                    for rangeStart, rangeEnd in reversed(ranges):
+                        found.extendleft(reversed(list(searchRange(buf, rangeStart, rangeEnd, regex, literal))))
+            finally:
+                if idxData:
+                    idxData.close()
+        return list(found)[-limit:] if limit else []
+
+    # Returns (buffer, start, end) holding the lines of the log's data[start:end]
+    def read(self, data, start, end):
+        return data, start, end
+
+
+# Searches a BlockGzipLog, decompressing only the blocks that may match
+class GzipLogSearch(LogSearch):
+    def read(self, data, start, end):
+        out = gunzip(data[start:end])
+        return out, 0, len(out)
+
+
+# What #grep shows
+def grep(searcher, arg):
+    try:
+        pattern, since, until, limit = parseQuery(arg)
+        start = time.perf_counter()
+        lines = searcher.search(pattern, since, until, limit)
+        took = time.perf_counter() - start
+    except (re.error, ValueError) as e:
+        return "grep: {}".format(e)
+    except Exception:
+        traceback.print_exc()
+        return "grep failed"
+    return '\n'.join(lines + ["({} matches in {:.1f} ms)".format(len(lines), took * 1000)])
@@ -0,0 +1,160 @@
+import threading
+import time
+import traceback
+
+FLUSH_BYTES = 64 * 1024  # commit as soon as this much is queued
+FLUSH_INTERVAL = 1.0  # otherwise commit at least this often
+
+
+# Writes log files from a thread of its own, so that logging costs the main loop no more than appending to a list.
+# Records are committed in batches: each file gets one write and one flush per commit. Compression of gzip files
+# happens in the writer thread too.
+# Files are opened (in binary mode) by the caller, so errors show up right away, and handed over with open(); from
+# then on only the writer thread touches them. So does the file's index, if it has one (see logsearch).
+# Text is written as UTF-8.
+class LogWriter(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []  # (name, text), text None meaning close, (file, index) meaning open
+        self.pendingBytes = 0
+        self.urgent = False
+        self.stopping = False
+        self.files = {}  # name -> (file object, index), writer thread only
+        self.queued = 0  # records ever queued
+        self.committed = 0  # of those, records on disk
+        self.commits = 0
+        self.bytesWritten = 0
+        self.thread = threading.Thread(target=self.run, name='logwriter', daemon=True)
+        self.thread.start()
+
+    def open(self, name, file, index=None):
+        with self.cond:
+            self.pending.append((name, (file, index)))
+            self.queued += 1
+            self.cond.notify()
+
+    def write(self, name, text):
+        with self.cond:
+            self.pending.append((name, text))
+            self.queued += 1
+            self.pendingBytes += len(text)
+            if self.pendingBytes >= FLUSH_BYTES:
+                self.cond.notify()
+
+    # Flushes what's queued for the file and closes it
+    def close(self, name):
+        with self.cond:
+            self.pending.append((name, None))
+            self.queued += 1
+            self.urgent = True
+            self.cond.notify()
+
+    # Commits everything queued and waits until it's on disk
+    def flush(self):
+        with self.cond:
+            self.urgent = True
+            self.cond.notify()
+            queued = self.queued
+            self.cond.wait_for(lambda: self.committed >= queued)
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending), self.pendingBytes
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.stopping)
+                # give the batch some time to grow
+                self.cond.wait_for(lambda: self.pendingBytes >= FLUSH_BYTES or self.urgent or self.stopping,
+                                   FLUSH_INTERVAL)
+                batch, self.pending = self.pending, []
+                self.pendingBytes = 0
+                self.urgent = False
+                stopping = self.stopping
+                queued = self.queued
+            self.commit(batch)
+            with self.cond:
+                self.committed = queued
+                self.cond.notify_all()
+            if stopping:
+                for name in list(self.files):
+                    self.closeFile(name)
+                return
+
+    def commit(self, batch):
+        parts = {}
+        for name, text in batch:
+            if isinstance(text, str):
+                parts.setdefault(name, []).append(text)
+            elif text is None:
+                self.writeOut(name, parts.pop(name, []))
+                self.closeFile(name)
+            else:
+                self.files[name] = text
+                file, index = text
+                if index:
+                    try:
+                        index.open()
+                    except Exception:
+                        traceback.print_exc()
+                        self.files[name] = file, None
+        for name, texts in parts.items():
+            self.writeOut(name, texts)
+        self.commits += 1
+
+    def writeOut(self, name, texts):
+        if name not in self.files:
+            return
+        file, index = self.files[name]
+        try:
+            if texts:
+                data = ''.join(texts).encode('utf-8')
+                file.write(data)
+                self.bytesWritten += len(data)
+                if index:
+                    index.add(data, time.time())
+            file.flush()
+            if index:
+                index.flush()
+        except Exception:
+            traceback.print_exc()
+
+    def closeFile(self, name):
+        if name not in self.files:
+            return
+        file, index = self.files.pop(name)
+        try:
+            file.close()
+            if index:
+                index.close()
+        except Exception:
+            traceback.print_exc()
+
+
+writer = None
+users = 0
+
+
+# The one writer all the logging modules share. It runs for as long as someone holds it.
+def acquire():
+    global writer, users
+    if writer is None:
+        writer = LogWriter()
+    users += 1
+    return writer
+
+
+def release():
+    global writer, users
+    users -= 1
+    if users <= 0 and writer is not None:
+        writer.stop()
+        writer = None
+        users = 0
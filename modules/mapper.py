@@ -1,5 +1,7 @@
 from modules.basemodule import BaseModule
+import array
 import collections
+import heapq
 import json
 import os
 import pprint
@@ -24,55 +26,383 @@ reverse = {
         'd': 'u'
         }
 
-# Room IDs are strings (JSON keys must be)
+# Interns strings (zones, terrains, exit directions) as small ints
+class Symbols(object):
+    def __init__(self):
+        self.names = []
+        self.numbers = {}
+
+    def __getitem__(self, number):
+        return self.names[number]
+
+    def number(self, name):
+        number = self.numbers.get(name)
+        if number is None:
+            number = self.numbers[name] = len(self.names)
+            self.names.append(name)
+        return number
+
+
+NO_EXITS = ((), ())
+INF = float('inf')
+FIND_LIMIT = 20  # rooms to show when nothing is called what #map find looks for
+COMPACT_MIN = 1024  # changed rooms to allow in the overlay before rebuilding the exit arrays
+# Movement points CoffeeMUD takes for entering a room, by terrain. Unknown terrains and stubs cost 1.
+TERRAIN_COSTS = {
+        'city': 1, 'stone': 1, 'wooden': 1, 'metal': 1, 'cave': 1, 'plains': 1, 'seaport': 1, 'air': 1,
+        'woods': 2, 'desert': 2, 'rocky': 2, 'gap': 2,
+        'hills': 3, 'jungle': 3, 'swamp': 3, 'watersurface': 3, 'cavelakesurface': 3,
+        'mountains': 4,
+        'underwater': 5,
+        }
+
+
+# What the weighted Map.findPath counts: an exit costs what entering its target room does by terrain, plus doorCost
+# for doors (exits like 'open n;n' that take more than one command), plus lenCost for each unit of the exit's len.
+# A plain exit is never taken where the room has a door the same way. Locked exits are passable only at a level of
+# at least the lock's; lock -1 (#map lock without a level) is for nobody, and neither is any lock if level is None.
+class Costs(object):
+    def __init__(self, level=None, terrains=TERRAIN_COSTS, doorCost=1, lenCost=0.25):
+        self.level = level
+        self.terrains = terrains
+        self.doorCost = doorCost
+        self.lenCost = lenCost
+
+    def __eq__(self, other):
+        return isinstance(other, Costs) and vars(self) == vars(other)
+
+    def mayPass(self, lock):
+        return self.level is not None and 0 <= lock <= self.level
+
+
+def isDoor(direction):
+    return ';' in direction or '\n' in direction
+
+
+# Trigrams of text, lowercased and, for matching whole words better, padded with spaces
+def trigrams(text, padded=True):
+    text = text.lower()
+    if padded:
+        text = ' ' + text + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def words(text):
+    return re.findall(r'\w+', text.lower())
+
+
+# Room names by trigram and by word. Many rooms share a name, so it's the names that are indexed, each with the
+# rooms that have it.
+class NameIndex(object):
+    def __init__(self):
+        self.rooms = {}  # name -> room numbers
+        self.trigrams = {}  # trigram -> names
+        self.words = {}  # word -> names
+        self.sizes = {}  # name -> how many trigrams it has
+
+    def add(self, name, idx):
+        rooms = self.rooms.get(name)
+        if rooms is None:
+            rooms = self.rooms[name] = set()
+            grams = trigrams(name)
+            self.sizes[name] = len(grams)
+            for gram in grams:
+                self.trigrams.setdefault(gram, set()).add(name)
+            for word in words(name):
+                self.words.setdefault(word, set()).add(name)
+        rooms.add(idx)
+
+    def remove(self, name, idx):
+        rooms = self.rooms[name]
+        rooms.discard(idx)
+        if rooms:
+            return
+        del self.rooms[name], self.sizes[name]
+        for index, keys in ((self.trigrams, trigrams(name)), (self.words, words(name))):
+            for key in keys:
+                index[key].discard(name)
+                if not index[key]:
+                    del index[key]
+
+    # The names text is part of, case and all
+    def containing(self, text):
+        grams = trigrams(text, False)
+        if not grams:
+            return [name for name in self.rooms if text in name]
+        found = sorted((self.trigrams.get(gram, set()) for gram in grams), key=len)
+        return [name for name in found[0].intersection(*found[1:]) if text in name]
+
+    # (score, name) for the names most like text: sharing trigrams counts, and so do words of text in the name
+    def like(self, text, limit):
+        grams = trigrams(text)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self.trigrams.get(gram, ()))
+        textWords = words(text)
+        scored = []
+        for name, count in shared.items():
+            score = count / (len(grams) + self.sizes[name] - count)
+            score += sum(1 for word in textWords if name in self.words.get(word, ()))
+            scored.append((score, name))
+        return heapq.nlargest(limit, scored)
+
+
+# Room IDs are strings (JSON keys must be). Inside, rooms are numbered densely, and everything about a room is kept
+# in arrays indexed by its number. Exits are in CSR form: room i's exits are exitDir/exitTgt[exitStart[i]:
+# exitStart[i + 1]], directions numbered in self.dirs and targets as room numbers. Rooms changed since the exit
+# arrays were last rebuilt keep their exits in self.overlay instead. Zones and terrains are numbered too; room data
+# that isn't just a zone and a terrain (stubs have {} or None) is kept as is in self.roomData. Exit data (lock, len,
+# draw) lives in self.exitData. Exits can lead to rooms not in the map yet: they get a number, but aren't present.
+# For searching backwards, revSrc/revDir[revStart[i]:revStart[i + 1]] are the exits into room i as of the last
+# rebuild, and self.added has the exits of rooms in the overlay by target.
 class Map(object):
     def __init__(self, serialized=None):
-        if serialized:
-            self.m = json.loads(serialized)
-            if 'areas' not in self.m:
-                self.m['areas'] = {}
-        else:
-            self.m = {'areas': {}, 'bookmarks': {}, 'rooms': {}}
+        m = json.loads(serialized) if serialized else {}
+        self.bookmarks = m.pop('bookmarks', {})
+        self.areas = m.pop('areas', {})
+        rooms = m.pop('rooms', {})
+        self.extra = m  # any other top-level keys, kept for serialize()
+        self.ids = []
+        self.numbers = {}
+        self.present = bytearray()
+        self.names = []
+        self.zone = array.array('i')  # -1 for none
+        self.terrain = array.array('i')
+        self.roomData = {}  # room number -> data, where it isn't just a zone and a terrain
+        self.zones = Symbols()
+        self.terrains = Symbols()
+        self.dirs = Symbols()
+        self.exitStart = array.array('i', [0])
+        self.exitDir = array.array('i')
+        self.exitTgt = array.array('i')
+        self.overlay = {}  # room number -> (directions, targets)
+        self.revStart = array.array('i', [0])
+        self.revSrc = array.array('i')
+        self.revDir = array.array('i')
+        self.added = {}  # room number -> [(source, direction)] from rooms in the overlay
+        self.exitData = {}  # room number -> {direction number: data}
+        self.watchers = []  # told edited(room number, targets it had) after each change to a room
+        self.zoneRooms = {}  # zone number -> room numbers
+        self.nameIndex = None  # made on the first search by name
+        self.load(rooms)
+
+    # Like addRoom() for every room, in one go, into an empty map
+    def load(self, rooms):
+        self.ids = list(rooms)
+        self.numbers = {num: idx for idx, num in enumerate(self.ids)}
+        self.present = bytearray(b'\x01') * len(self.ids)
+        self.names = [room['name'] for room in rooms.values()]
+        self.zone = array.array('i', [-1]) * len(self.ids)
+        self.terrain = array.array('i', [-1]) * len(self.ids)
+        number, direction = self.number, self.dirs.number
+        for idx, room in enumerate(rooms.values()):
+            self.setRoomData(idx, room['data'])
+            self.indexRoom(idx)
+            exits = room['exits']
+            dirs = [direction(d) for d in exits]
+            self.overlay[idx] = (dirs, [number(str(exit['tgt'])) for exit in exits.values()])
+            for d, exit in zip(dirs, exits.values()):
+                if 'data' in exit:
+                    self.exitData.setdefault(idx, {})[d] = exit['data']
+        self.compact()
 
     def serialize(self):
-        return json.dumps(self.m)
+        return json.dumps(self.toDict())
+
+    def toDict(self):
+        out = dict(self.extra)
+        out['bookmarks'] = self.bookmarks
+        out['rooms'] = {num: {'name': self.names[idx], 'data': self.roomDataOf(idx), 'exits': self.roomExits(idx)}
+                for idx, num in enumerate(self.ids) if self.present[idx]}
+        out['areas'] = self.areas
+        return out
 
     def getBookmarks(self):
-        return self.m['bookmarks']
+        return self.bookmarks
 
     def setBookmarks(self, bm):
-        self.m['bookmarks'] = bm
+        self.bookmarks = bm
+
+    # The number of room num, which needn't be in the map, or None if no exit leads there either
+    def index(self, num):
+        return self.numbers.get(str(num))
+
+    def number(self, num):
+        idx = self.numbers.get(num)
+        if idx is None:
+            idx = self.numbers[num] = len(self.ids)
+            self.ids.append(num)
+            self.present.append(0)
+            self.names.append(None)
+            self.zone.append(-1)
+            self.terrain.append(-1)
+        return idx
+
+    def rooms(self):
+        return (num for idx, num in enumerate(self.ids) if self.present[idx])
 
     def addRoom(self, num, name, data, exits):
-        num = str(num)
-        self.m['rooms'][num] = {
-                'name': name,
-                'data': data,
-                'exits': exits,
-                }
+        idx = self.number(str(num))
+        before = self.roomState(idx)
+        if self.present[idx]:
+            self.unindexRoom(idx)
+        self.present[idx] = 1
+        self.names[idx] = name
+        self.setRoomData(idx, data)
+        self.indexRoom(idx)
+        dirs, tgts = array.array('i'), array.array('i')
+        oldDirs, oldTgts = self.exitsOf(idx)
+        self.exitData.pop(idx, None)
+        for direction, exit in exits.items():
+            d = self.dirs.number(direction)
+            dirs.append(d)
+            tgts.append(self.number(str(exit['tgt'])))
+            if 'data' in exit:
+                self.exitData.setdefault(idx, {})[d] = exit['data']
+        # rooms are added on every room.info, mostly just as they were
+        if list(oldDirs) != list(dirs) or list(oldTgts) != list(tgts):
+            self.setExits(idx, dirs, tgts)
+        elif self.roomState(idx) == before:
+            return
+        self.edited(idx, oldTgts)
+
+    # Puts present room number idx in the zone and name indexes
+    def indexRoom(self, idx):
+        if self.zone[idx] >= 0:
+            self.zoneRooms.setdefault(self.zone[idx], set()).add(idx)
+        if self.nameIndex is not None and self.names[idx]:
+            self.nameIndex.add(self.names[idx], idx)
+
+    def unindexRoom(self, idx):
+        if self.zone[idx] >= 0:
+            self.zoneRooms[self.zone[idx]].discard(idx)
+        if self.nameIndex is not None and self.names[idx]:
+            self.nameIndex.remove(self.names[idx], idx)
+
+    def roomState(self, idx):
+        return (self.present[idx], self.names[idx], self.zone[idx], self.terrain[idx], self.roomData.get(idx),
+                self.exitData.get(idx))
+
+    def edited(self, idx, oldTgts):
+        for watcher in self.watchers:
+            watcher.edited(idx, oldTgts)
+
+    def setExits(self, idx, dirs, tgts):
+        if idx in self.overlay:
+            for d, t in zip(*self.overlay[idx]):
+                self.added[t].remove((idx, d))
+        self.overlay[idx] = (dirs, tgts)
+        for d, t in zip(dirs, tgts):
+            self.added.setdefault(t, []).append((idx, d))
+        if len(self.overlay) > max(COMPACT_MIN, len(self.ids) // 8):
+            self.compact()
+
+    def setRoomData(self, idx, data):
+        self.roomData.pop(idx, None)
+        zone = terrain = None
+        if isinstance(data, dict):
+            zone, terrain = data.get('zone'), data.get('terrain')
+        self.zone[idx] = self.zones.number(zone) if isinstance(zone, str) else -1
+        self.terrain[idx] = self.terrains.number(terrain) if isinstance(terrain, str) else -1
+        if not (self.zone[idx] >= 0 and self.terrain[idx] >= 0 and len(data) == 2):
+            self.roomData[idx] = data
+
+    # Rebuilds the exit arrays, taking in the overlay
+    def compact(self):
+        start, dirs, tgts = array.array('i', [0]), array.array('i'), array.array('i')
+        for idx in range(len(self.ids)):
+            roomDirs, roomTgts = self.exitsOf(idx)
+            dirs.extend(roomDirs)
+            tgts.extend(roomTgts)
+            start.append(len(dirs))
+        self.exitStart, self.exitDir, self.exitTgt = start, dirs, tgts
+        self.overlay = {}
+        self.added = {}
+        # the same exits by target
+        srcs = array.array('i')
+        for idx in range(len(self.ids)):
+            srcs.extend(array.array('i', [idx]) * (start[idx + 1] - start[idx]))
+        order = sorted(range(len(tgts)), key=tgts.__getitem__)
+        revSrc, revDir = array.array('i', map(srcs.__getitem__, order)), array.array('i', map(dirs.__getitem__, order))
+        revStart = array.array('i', [0]) * (len(self.ids) + 1)
+        for t in tgts:
+            revStart[t + 1] += 1
+        for idx in range(len(self.ids)):
+            revStart[idx + 1] += revStart[idx]
+        self.revStart, self.revSrc, self.revDir = revStart, revSrc, revDir
+
+    # (directions, targets) of room number idx
+    def exitsOf(self, idx):
+        changed = self.overlay.get(idx)
+        if changed is not None:
+            return changed
+        if idx + 1 < len(self.exitStart):
+            a, b = self.exitStart[idx], self.exitStart[idx + 1]
+            return self.exitDir[a:b], self.exitTgt[a:b]
+        return NO_EXITS
+
+    # (source, direction) of the exits into room number idx
+    def incoming(self, idx):
+        out = []
+        if idx + 1 < len(self.revStart):
+            overlay = self.overlay
+            for k in range(self.revStart[idx], self.revStart[idx + 1]):
+                if self.revSrc[k] not in overlay:
+                    out.append((self.revSrc[k], self.revDir[k]))
+        return out + self.added.get(idx, [])
+
+    def locked(self, idx, d):
+        data = self.exitData.get(idx)
+        return bool(data) and 'lock' in (data.get(d) or ())
+
+    # (direction, target) of the exits of room number idx that aren't locked
+    def openExits(self, idx):
+        dirs, tgts = self.exitsOf(idx)
+        data = self.exitData.get(idx)
+        if not data:
+            return zip(dirs, tgts)
+        return [(d, t) for d, t in zip(dirs, tgts) if 'lock' not in (data.get(d) or ())]
+
+    # Whether room number idx has been seen, not just heard of as an exit target
+    def explored(self, idx):
+        return self.present[idx] and (idx not in self.roomData or bool(self.roomData[idx]))
 
     def roomExists(self, num):
-        return num in self.m['rooms']
+        idx = self.index(num)
+        return idx is not None and bool(self.present[idx])
+
+    def presentIndex(self, num):
+        idx = self.index(num)
+        if idx is None or not self.present[idx]:
+            raise KeyError(num)
+        return idx
 
     def getRoomName(self, num):
-        num = str(num)
-        return self.m['rooms'][num]['name']
+        return self.names[self.presentIndex(num)]
 
     def getRoomData(self, num):
-        num = str(num)
-        if num not in self.m['rooms']:
+        idx = self.index(num)
+        if idx is None or not self.present[idx]:
             return {}
-        return self.m['rooms'][num]['data']
+        return self.roomDataOf(idx)
+
+    def roomDataOf(self, idx):
+        if idx in self.roomData:
+            return self.roomData[idx]
+        return {'zone': self.zones[self.zone[idx]], 'terrain': self.terrains[self.terrain[idx]]}
+
+    def zoneOf(self, idx):
+        return self.zones[self.zone[idx]] if self.zone[idx] >= 0 else None
 
     def addArea(self, area, room):
-        if area not in self.m['areas']:
-            self.m['areas'][area] = room
+        if area not in self.areas:
+            self.areas[area] = room
 
     def setAreaStart(self, area, room):
-        self.m['areas'][area] = room
+        self.areas[area] = room
 
     def getAreas(self):
-        return self.m['areas']
+        return self.areas
 
     def getRoomCoords(self, num):
         num = str(num)
@@ -80,66 +410,546 @@ class Map(object):
         return (0, 0, 0)
 
     def getRoomExits(self, num):
-        num = str(num)
-        if num not in self.m['rooms']:
+        idx = self.index(num)
+        if idx is None or not self.present[idx]:
             return {}
-        return self.m['rooms'][num]['exits']
+        return self.roomExits(idx)
+
+    def roomExits(self, idx):
+        data = self.exitData.get(idx, {})
+        exits = {}
+        for d, t in zip(*self.exitsOf(idx)):
+            exits[self.dirs[d]] = {'tgt': self.ids[t]}
+            if d in data:
+                exits[self.dirs[d]]['data'] = data[d]
+        return exits
+
+    # The direction number of exit direction of room number idx
+    def exitIndex(self, idx, direction):
+        d = self.dirs.numbers.get(direction)
+        if d is None or d not in self.exitsOf(idx)[0]:
+            raise KeyError(direction)
+        return d
 
     def setExitData(self, source, direction, data):
-        self.m['rooms'][source]['exits'][direction]['data'] = data
+        idx = self.presentIndex(source)
+        self.exitData.setdefault(idx, {})[self.exitIndex(idx, direction)] = data
+        self.edited(idx, ())
 
     def getExitData(self, num, direction):
-        num = str(num)
-        if 'data' not in self.m['rooms'][num]['exits'][direction]:
-            return {}
-        return self.m['rooms'][num]['exits'][direction]['data']
-
+        idx = self.presentIndex(num)
+        data = self.exitData.get(idx, {}).get(self.exitIndex(idx, direction))
+        return {} if data is None else data
+
+    def roomNames(self):
+        if self.nameIndex is None:
+            self.nameIndex = NameIndex()
+            for idx, name in enumerate(self.names):
+                if name and self.present[idx]:
+                    self.nameIndex.add(name, idx)
+        return self.nameIndex
+
+    # (id, name, zone) of the rooms with name in their names, in zone if given, sorted by zone and name
     def findRoomsByName(self, name, zone=None):
+        return self.roomsCalled(self.roomNames().containing(name), zone)
+
+    # Like findRoomsByName, for the rooms with the names most like text, best first
+    def searchRooms(self, text, zone=None, limit=FIND_LIMIT):
         out = []
-        for num in self.m['rooms']:
-            if 'name' in self.m['rooms'][num] and self.m['rooms'][num]['name'] and self.m['rooms'][num]['name'].find(name) != -1 and (not zone or self.m['rooms'][num]['data']['zone'] and zone == self.m['rooms'][num]['data']['zone'] == zone):
-                out.append((num, self.m['rooms'][num]['name'], self.m['rooms'][num]['data']['zone']))
-        return out
+        for score, name in self.roomNames().like(text, limit):
+            out += self.roomsCalled([name], zone)
+        return out[:limit]
+
+    def roomsCalled(self, names, zone):
+        z = self.zones.numbers.get(zone) if zone else None
+        if zone and z is None:
+            return []
+        found = []
+        for name in names:
+            for idx in self.nameIndex.rooms[name]:
+                if z is None or self.zone[idx] == z:
+                    found.append((self.zoneOf(idx) or '', name, idx))
+        found.sort()
+        return [(self.ids[idx], name, zoneName or None) for zoneName, name, idx in found]
 
     def findRoomsByZone(self, zone):
-        out = []
-        for num in self.m['rooms']:
-            if 'data' in self.m['rooms'][num] and self.m['rooms'][num]['data'] and 'zone' in self.m['rooms'][num]['data'] and self.m['rooms'][num]['data']['zone'] == zone:
-                out.append(num)
-        return out
+        z = self.zones.numbers.get(zone)
+        return [self.ids[idx] for idx in sorted(self.zoneRooms.get(z, ()))]
 
     def delRoom(self, room):
-        if room in self.m['rooms']:
-            del self.m['rooms'][room]
-
+        idx = self.index(room)
+        if idx is None or not self.present[idx]:
+            return
+        self.unindexRoom(idx)
+        self.present[idx] = 0
+        self.names[idx] = None
+        self.zone[idx] = self.terrain[idx] = -1
+        self.roomData.pop(idx, None)
+        self.exitData.pop(idx, None)
+        oldTgts = self.exitsOf(idx)[1]
+        self.setExits(idx, (), ())
+        self.edited(idx, oldTgts)
+
+    # The exit directions from here to there: the fewest, or with costs (see Costs) the cheapest. [] if here is
+    # there, None if there's no way.
+    def findPath(self, here, there, costs=None):
+        start, goal = self.index(here), self.index(there)
+        if start is None or goal is None:
+            return None
+        if start == goal:
+            return []
+        if costs is None:
+            meet, via = self.bfs(start, goal)
+        else:
+            meet, via = self.dijkstra(start, goal, self.costFunction(costs))
+        if meet is None:
+            return None
+        return self.route(via, meet)
+
+    # Searches from both ends a level at a time, always growing the smaller frontier. Returns the room where the
+    # searches met on a shortest path and the parent pointers of both: via[0][room] = (room before, direction),
+    # via[1][room] = (room after, direction).
+    def bfs(self, start, goal):
+        via = ({start: None}, {goal: None})
+        depth = ({start: 0}, {goal: 0})
+        frontiers = ([start], [goal])
+        while frontiers[0] and frontiers[1]:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            mine, theirs = via[side], via[1 - side]
+            level = depth[side][frontiers[side][0]] + 1
+            best, meet = None, None
+            grown = []
+            for room in frontiers[side]:
+                if side == 0:
+                    edges = self.openExits(room)
+                else:
+                    edges = [(d, src) for src, d in self.incoming(room) if not self.locked(src, d)]
+                for d, other in edges:
+                    if other in mine:
+                        continue
+                    mine[other] = (room, d)
+                    depth[side][other] = level
+                    grown.append(other)
+                    if other in theirs and (best is None or depth[1 - side][other] < best):
+                        best, meet = depth[1 - side][other], other
+            if meet is not None:
+                return meet, via
+            frontiers = (grown, frontiers[1]) if side == 0 else (frontiers[0], grown)
+        return None, via
+
+    # Dijkstra from both ends, stopping once the two queues together can't beat the best meeting so far. The map
+    # has no coordinates to steer an A* by.
+    def dijkstra(self, start, goal, cost):
+        via = ({start: None}, {goal: None})
+        dist = ({start: 0}, {goal: 0})
+        queues = ([(0, start)], [(0, goal)])
+        best, meet = INF, None
+        while queues[0] and queues[1] and queues[0][0][0] + queues[1][0][0] < best:
+            side = 0 if len(queues[0]) <= len(queues[1]) else 1
+            mine, theirs = dist[side], dist[1 - side]
+            d0, room = heapq.heappop(queues[side])
+            if d0 > mine[room]:
+                continue
+            if side == 0:
+                edges = ((t, d, cost(room, d, t)) for d, t in zip(*self.exitsOf(room)))
+            else:
+                edges = ((src, d, cost(src, d, room)) for src, d in self.incoming(room))
+            for other, d, w in edges:
+                if w is None or d0 + w >= mine.get(other, best):
+                    continue
+                mine[other] = d0 + w
+                via[side][other] = (room, d)
+                heapq.heappush(queues[side], (d0 + w, other))
+                if other in theirs and d0 + w + theirs[other] < best:
+                    best, meet = d0 + w + theirs[other], other
+        return meet, via
+
+    # Dijkstra over the whole map: the cheapest costs from room number root to every room, or with backward from
+    # every room to root, and (dist, via, how) arrays: via has the room before (after) each on the way, -1 where
+    # there's no way, and how the exit between them
+    def shortestPaths(self, root, cost, backward=False):
+        dist = array.array('d', [INF]) * len(self.ids)
+        via = array.array('i', [-1]) * len(self.ids)
+        how = array.array('i', [-1]) * len(self.ids)
+        dist[root], via[root] = 0, root
+        queue = [(0, root)]
+        while queue:
+            d0, room = heapq.heappop(queue)
+            if d0 > dist[room]:
+                continue
+            if backward:
+                edges = ((src, d, cost(src, d, room)) for src, d in self.incoming(room))
+            else:
+                edges = ((t, d, cost(room, d, t)) for d, t in zip(*self.exitsOf(room)))
+            for other, d, w in edges:
+                if w is not None and d0 + w < dist[other]:
+                    dist[other], via[other], how[other] = d0 + w, room, d
+                    heapq.heappush(queue, (d0 + w, other))
+        return dist, via, how
+
+    # What exit direction d from room src to tgt costs, None if there's no such exit or it can't be taken
+    def weight(self, cost, src, d, tgt):
+        if not any(e == d and t == tgt for e, t in zip(*self.exitsOf(src))):
+            return None
+        return cost(src, d, tgt)
+
+    # A function giving what taking exit direction d from room src to tgt costs, or None if it can't be taken
+    def costFunction(self, costs):
+        terrainCost = [costs.terrains.get(name, 1) for name in self.terrains.names]
+        door = [isDoor(name) for name in self.dirs.names]
+        doors = {d for d, isdoor in enumerate(door) if isdoor}
+        exitsOf, terrain, exitData = self.exitsOf, self.terrain, self.exitData
+
+        def cost(src, d, tgt):
+            if door[d]:
+                c = costs.doorCost
+            else:
+                c = 0
+                dirs, tgts = exitsOf(src)
+                if not doors.isdisjoint(dirs) and any(door[e] and t == tgt for e, t in zip(dirs, tgts)):
+                    return None
+            c += terrainCost[terrain[tgt]] if terrain[tgt] >= 0 else 1
+            data = exitData.get(src)
+            exit = data and data.get(d)
+            if exit:
+                if 'lock' in exit and not costs.mayPass(exit['lock']):
+                    return None
+                c += costs.lenCost * exit.get('len', 0)
+            return c
+        return cost
+
+    def route(self, via, meet):
+        path = []
+        room = meet
+        while via[0][room] is not None:
+            room, d = via[0][room]
+            path.append(self.dirs[d])
+        path.reverse()
+        room = meet
+        while via[1][room] is not None:
+            room, d = via[1][room]
+            path.append(self.dirs[d])
+        return path
+
+HOT = 2  # times a room has to be gone to before it gets trees of its own
+MAX_HOT = 16
+
+
+# Shortest-path trees for the weighted findPath, rooted at bookmarks, area starts and rooms often gone to: one
+# from each root, to route away from it, and one to it, to route there. With a tree, a route is a walk along its
+# via pointers. Trees are built when first needed. The map tells the cache about every edited room, and only the
+# trees that the edit could have made wrong are dropped, to be rebuilt when next needed. Other routes go to a
+# ZoneRouter.
+class PathCache(object):
+    def __init__(self, m, costs):
+        self.map = m
+        self.costs = costs
+        self.trees = {}  # (root room number, backward) -> (dist, via, how)
+        self.wanted = collections.Counter()  # room number -> times gone to, until it's hot
+        self.hot = collections.OrderedDict()  # the MAX_HOT rooms gone to most recently of those gone to HOT times
+        self.router = None  # for the other routes, made when first needed
+        self.refresh()
+        m.watchers.append(self)
+
+    def close(self):
+        self.map.watchers.remove(self)
+        if self.router:
+            self.router.close()
+
+    # The cost function numbers terrains and directions, so remake it when new ones show up
+    def refresh(self):
+        self.symbols = len(self.map.terrains.names), len(self.map.dirs.names)
+        self.cost = self.map.costFunction(self.costs)
+
+    def isRoot(self, idx):
+        num = self.map.ids[idx]
+        return idx in self.hot or num in self.map.bookmarks.values() or num in self.map.areas.values()
+
+    # Counts idx as gone to once more, giving it trees of its own when it's been HOT times
+    def want(self, idx):
+        if idx in self.hot:
+            self.hot.move_to_end(idx)
+            return
+        self.wanted[idx] += 1
+        if self.wanted[idx] >= HOT:
+            del self.wanted[idx]
+            self.hot[idx] = True
+            if len(self.hot) > MAX_HOT:
+                old, _ = self.hot.popitem(last=False)
+                self.trees.pop((old, False), None)
+                self.trees.pop((old, True), None)
+
+    def tree(self, root, backward):
+        if self.symbols != (len(self.map.terrains.names), len(self.map.dirs.names)):
+            self.refresh()
+            self.trees = {}
+        tree = self.trees.get((root, backward))
+        if tree is None:
+            tree = self.trees[root, backward] = self.map.shortestPaths(root, self.cost, backward)
+        return tree
 
-    def isLocked(self, exit):
-        if 'data' not in exit:
-            return False
-        if 'lock' not in exit['data']:
-            return False
-        return True  # TODO: check level
+    def findPath(self, here, there):
+        start, goal = self.map.index(here), self.map.index(there)
+        if start is None or goal is None:
+            return None
+        if start == goal:
+            return []
+        self.want(goal)
+        if self.isRoot(goal):
+            dist, via, how = self.tree(goal, True)
+            return self.walk(via, how, start, goal)
+        if self.isRoot(start):
+            dist, via, how = self.tree(start, False)
+            path = self.walk(via, how, goal, start)
+            return path and path[::-1]
+        if self.router is None:
+            self.router = ZoneRouter(self.map, self.costs)
+        return self.router.findPath(here, there)
+
+    def walk(self, via, how, room, root):
+        if room >= len(via) or via[room] == -1:
+            return None
+        path = []
+        while room != root:
+            path.append(self.map.dirs[how[room]])
+            room = via[room]
+        return path
+
+    def edited(self, idx, oldTgts):
+        if self.symbols != (len(self.map.terrains.names), len(self.map.dirs.names)):
+            self.refresh()
+        for key in [key for key, tree in self.trees.items() if self.stale(tree, key[1], key[0], idx, oldTgts)]:
+            del self.trees[key]
+
+    # Whether a change to room x (its exits, their data, or its terrain, which is what exits into it cost) can have
+    # made the tree wrong: some exit of or into x is now a cheaper way than the tree's, or some exit of the tree
+    # is gone or costs something else now
+    def stale(self, tree, backward, root, x, oldTgts):
+        dist, via, how = tree
+        m, cost = self.map, self.cost
+
+        def at(array, i, default):
+            return array[i] if i < len(array) else default
+
+        def wrong(src, tgt):  # the tree's exit from src to tgt
+            w = m.weight(cost, src, how[src if backward else tgt], tgt)
+            return w is None or dist[src if backward else tgt] != dist[tgt if backward else src] + w
+
+        dx = at(dist, x, INF)
+        dirs, tgts = m.exitsOf(x)
+        for d, t in zip(dirs, tgts):
+            w = cost(x, d, t)
+            if w is None:
+                continue
+            if backward and w + at(dist, t, INF) < dx or not backward and dx + w < at(dist, t, INF):
+                return True
+        for s, d in m.incoming(x):
+            w = cost(s, d, x)
+            if w is None:
+                continue
+            if backward and w + dx < at(dist, s, INF) or not backward and at(dist, s, INF) + w < dx:
+                return True
+        if backward:
+            if x != root and at(via, x, -1) != -1 and wrong(x, via[x]):
+                return True
+            return any(s != root and at(via, s, -1) == x and wrong(s, x) for s, d in m.incoming(x))
+        if x != root and at(via, x, -1) != -1 and wrong(via[x], x):
+            return True
+        return any(t != root and at(via, t, -1) == x and wrong(x, t) for t in set(tgts) | set(oldTgts))
+
+
+# Routes on two levels, so that long routes don't have to search the whole map. A zone's portals are its rooms with
+# exits to or from other zones. Each portal links to the portals it can reach inside its zone, with the exits and
+# what they cost, and across to other zones. A route is searched for inside the zones at its ends and on the much
+# smaller graph of portals in between. Rooms without a zone (stubs) go with a zone leading to them. Edits make the
+# zones they touch dirty, and dirty zones are redone before the next route.
+class ZoneRouter(object):
+    def __init__(self, m, costs):
+        self.map = m
+        self.costs = costs
+        self.zoneOf = array.array('i')  # room number -> zone key, as the router last saw it
+        self.rooms = collections.defaultdict(set)  # zone key -> room numbers
+        self.portals = {}  # zone key -> room numbers
+        self.links = {}  # portal -> [(portal, exits to it, cost)], to portals of its zone and across to others
+        self.into = collections.defaultdict(dict)  # portal -> {(portal, exits from it): cost}, the links backward
+        self.dirty = set()
+        self.refresh()
+        self.sync()
+        m.watchers.append(self)
+
+    def close(self):
+        self.map.watchers.remove(self)
+
+    def refresh(self):
+        self.symbols = len(self.map.terrains.names), len(self.map.dirs.names)
+        self.cost = self.map.costFunction(self.costs)
+
+    def zoneKey(self, idx):
+        zone = self.map.zone[idx]
+        if zone < 0:
+            # otherwise every room next to a stub would be a portal
+            zones = [self.map.zone[src] for src, d in self.map.incoming(idx) if self.map.zone[src] >= 0]
+            zone = min(zones) if zones else -2 - idx
+        return zone
+
+    # Takes in the rooms numbered since last time
+    def sync(self):
+        for idx in range(len(self.zoneOf), len(self.map.ids)):
+            z = self.zoneKey(idx)
+            self.zoneOf.append(z)
+            self.rooms[z].add(idx)
+            self.dirty.add(z)
+
+    def edited(self, idx, oldTgts):
+        self.sync()
+        self.rekey(idx)
+        self.dirty.add(self.zoneOf[idx])
+        # exits into it may cost something else now
+        self.dirty.update(self.zoneOf[src] for src, d in self.map.incoming(idx))
+        for t in set(oldTgts) | set(self.map.exitsOf(idx)[1]):
+            self.rekey(t)
+            self.dirty.add(self.zoneOf[t])
+
+    def rekey(self, idx):
+        old, new = self.zoneOf[idx], self.zoneKey(idx)
+        if old == new:
+            return
+        self.rooms[old].discard(idx)
+        self.rooms[new].add(idx)
+        self.zoneOf[idx] = new
+        self.dirty.update((old, new))
+        self.dirty.update(self.zoneOf[src] for src, d in self.map.incoming(idx))
+        self.dirty.update(self.zoneOf[t] for t in self.map.exitsOf(idx)[1])
+
+    # Rooms can move between dirty zones, so clear them all before repairing any
+    def clear(self, z):
+        for p in self.portals.pop(z, ()):
+            for q, steps, w in self.links.pop(p):
+                del self.into[q][p, steps]
+
+    def repair(self, z):
+        if not self.rooms[z]:
+            del self.rooms[z]
+            return
+        zoneOf, m = self.zoneOf, self.map
+        portals = [idx for idx in self.rooms[z] if any(zoneOf[t] != z for t in m.exitsOf(idx)[1])
+                or any(zoneOf[src] != z for src, d in m.incoming(idx))]
+        isPortal = set(portals)
+        for p in portals:
+            dist, via = self.local(p, z)
+            links = self.links[p] = []
+            for q in portals:
+                steps = self.steps(via, q, p, isPortal) if q in dist and q != p else None
+                if steps is not None:
+                    links.append((q, steps, dist[q]))
+            for d, t in zip(*m.exitsOf(p)):
+                w = self.cost(p, d, t)
+                if zoneOf[t] != z and w is not None:
+                    links.append((t, (d,), w))
+            for q, steps, w in links:
+                self.into[q][p, steps] = w
+        self.portals[z] = portals
+
+    # The exits from start to room along via, or None if the way passes another portal: that portal's links go
+    # on from there, no need to keep this one too
+    def steps(self, via, room, start, portals):
+        steps = []
+        while room != start:
+            if portals is not None and room in portals and steps:
+                return None
+            room, d = via[room]
+            steps.append(d)
+        return tuple(reversed(steps))
+
+    # Dijkstra inside zone z from room start, or backward to it: ({room: cost}, {room: (room before or after, exit)})
+    def local(self, start, z, backward=False):
+        zoneOf, m, cost = self.zoneOf, self.map, self.cost
+        dist, via = {start: 0}, {start: None}
+        queue = [(0, start)]
+        while queue:
+            d0, room = heapq.heappop(queue)
+            if d0 > dist[room]:
+                continue
+            if backward:
+                edges = ((src, d, cost(src, d, room)) for src, d in m.incoming(room) if zoneOf[src] == z)
+            else:
+                edges = ((t, d, cost(room, d, t)) for d, t in zip(*m.exitsOf(room)) if zoneOf[t] == z)
+            for other, d, w in edges:
+                if w is not None and d0 + w < dist.get(other, INF):
+                    dist[other], via[other] = d0 + w, (room, d)
+                    heapq.heappush(queue, (d0 + w, other))
+        return dist, via
 
     def findPath(self, here, there):
-        here = str(here)
-        there = str(there)
-        visited = set()
-        paths = {here: []}
-        roomq = collections.deque()
-        roomq.append(here)
-        while roomq:
-            room = roomq.popleft()
-            if room not in visited:  # A given room might end up in the queue through different paths
-                ex = self.m['rooms'][room]['exits']
-                for exDir in ex:
-                    if self.isLocked(ex[exDir]):
-                        continue
-                    tgt = ex[exDir]['tgt']
-                    paths[tgt] = paths[room] + [exDir]
-                    roomq.append(tgt)
-                if room == there:
-                    return paths[there]
-            visited.add(room)
+        start, goal = self.map.index(here), self.map.index(there)
+        if start is None or goal is None:
+            return None
+        if start == goal:
+            return []
+        if self.symbols != (len(self.map.terrains.names), len(self.map.dirs.names)):
+            self.refresh()
+            self.dirty.update(self.rooms)
+        self.sync()
+        for z in self.dirty:
+            self.clear(z)
+        for z in self.dirty:
+            self.repair(z)
+        self.dirty = set()
+
+        zoneOf, m = self.zoneOf, self.map
+        distS, viaS = self.local(start, zoneOf[start])
+        distT, viaT = self.local(goal, zoneOf[goal], True)
+        # then Dijkstra from both ends on the portals, like Map.dijkstra
+        g = ({}, {})
+        via = ({}, {})  # portal -> (portal before or after, exits between)
+        queues = ([], [])
+        for side, dist, z in ((0, distS, zoneOf[start]), (1, distT, zoneOf[goal])):
+            for p in self.portals.get(z, ()):
+                if p in dist:
+                    g[side][p], via[side][p] = dist[p], None
+                    queues[side].append((dist[p], p))
+            heapq.heapify(queues[side])
+        best, meet = distS.get(goal, INF), None
+        for p in g[0]:
+            if p in g[1] and g[0][p] + g[1][p] < best:
+                best, meet = g[0][p] + g[1][p], p
+        while queues[0] and queues[1] and queues[0][0][0] + queues[1][0][0] < best:
+            side = 0 if len(queues[0]) <= len(queues[1]) else 1
+            mine, theirs = g[side], g[1 - side]
+            d0, p = heapq.heappop(queues[side])
+            if d0 > mine[p]:
+                continue
+            links = self.links[p] if side == 0 else [(q, steps, w) for (q, steps), w in self.into[p].items()]
+            for q, steps, w in links:
+                if d0 + w < mine.get(q, INF):
+                    mine[q], via[side][q] = d0 + w, (p, steps)
+                    heapq.heappush(queues[side], (d0 + w, q))
+                    if q in theirs and d0 + w + theirs[q] < best:
+                        best, meet = d0 + w + theirs[q], q
+        if best == INF:
+            return None
+        if meet is None:
+            return [m.dirs[d] for d in self.steps(viaS, goal, start, None)]
+        hops = []
+        p = meet
+        while via[0][p] is not None:
+            p, steps = via[0][p]
+            hops.append(steps)
+        path = list(self.steps(viaS, p, start, None))
+        for steps in reversed(hops):
+            path += steps
+        p = meet
+        while via[1][p] is not None:
+            p, steps = via[1][p]
+            path += steps
+        return [m.dirs[d] for d in path] + self.walk(viaT, p, goal)
+
+    def walk(self, via, room, end):
+        path = []
+        while room != end:
+            room, d = via[room]
+            path.append(self.map.dirs[d])
+        return path
 
 
 def assemble(cmds1, mode="go"):
@@ -196,6 +1006,15 @@ def assemble(cmds1, mode="go"):
     return ';'.join(out)
 
 
+# What to draw an exit as: its direction, also for doors like 'open door;n'. None for the rest.
+def drawDirection(name):
+    if name in ['n', 'e', 's', 'w', 'u', 'd', 'ne', 'se', 'sw', 'nw']:
+        return name
+    if re.match(r'open .+;[neswud]+', name):
+        return drawDirection(re.match(r'open .+;(.+)', name).group(1))
+    return None
+
+
 class Mapper(BaseModule):
     def help(self, args):
         strs = ["Commands:"]
@@ -249,14 +1068,31 @@ class Mapper(BaseModule):
         if here == there:
             self.log("Already there!")
             return ''
-        then = time.time()
-        raw = self.m.findPath(here, there)
+        then = time.perf_counter()
+        raw = self.pathCache().findPath(here, there)
+        took = time.perf_counter() - then
+        self.world.stats.record('map path', took)
         if raw:
             path = assemble(raw, mode)
-            self.log("{} (found in {} ms)".format(path, (time.time() - then)*1000))
+            self.log("{} (found in {:.1f} ms)".format(path, took * 1000))
             return path
         else:
-            self.log("Path not found in {} ms".format((time.time() - then)*1000))
+            self.log("Path not found in {:.1f} ms".format(took * 1000))
+
+    # Paths count movement points and let us through locks at our level
+    def costs(self):
+        try:
+            return Costs(self.world.gmcp['char']['status']['level'])
+        except KeyError:
+            return Costs()
+
+    def pathCache(self):
+        costs = self.costs()
+        if self.paths is None or self.paths.map is not self.m or self.paths.costs != costs:
+            if self.paths is not None:
+                self.paths.close()
+            self.paths = PathCache(self.m, costs)
+        return self.paths
 
     def path(self, there, mode='go'):
         return self.path2(self.current(), there, mode)
@@ -294,9 +1130,6 @@ class Mapper(BaseModule):
             columns, lines = 60, 100  # shutil.get_terminal_size((21, 22))
 
         def adjustExit(x, y, d, prev):
-            m = re.match(r'open .+;(.+)', d)
-            if m:
-                return adjustExit(x, y, m.group(1), prev)
             if d == 'n':
                 return x, y-1, '│', '↑', '║'
             if d == 'w':
@@ -331,16 +1164,17 @@ class Mapper(BaseModule):
         # The only room coordinates that matter are the start room's -- the rest get calculated by tracing paths.
         startX, startY, startZ = (0, 0, 0)  # self.m.getRoomCoords(self.current())
         centerX, centerY = (columns-1)//2, (lines-1)//2
-        data = self.m.getRoomData(self.current())
-        area = data['zone']
+        m = self.m
+        start = m.index(self.current())
+        area = m.zone[start]
 
         roomq = collections.deque()
-        roomq.append((centerX, centerY, self.current()))
+        roomq.append((centerX, centerY, start))
 
         visited = set()
+        directions = {}  # direction number -> what to draw it as
 
-        def getExitLen(source, to):
-            exitData = self.getExitData(source, to)
+        def getExitLen(exitData):
             if not exitData or 'len' not in exitData:
                 return 0
             return int(exitData['len'] * 2)
@@ -354,29 +1188,27 @@ class Mapper(BaseModule):
         while roomq:
             drawX, drawY, room = roomq.popleft()
             if room not in visited:  # A given room might end up in the queue through different paths
-                mapX, mapY, mapZ = self.m.getRoomCoords(room)
                 visited.add(room)
                 # It's possible to keep walking through z layers and end up back on z=initial, which might produce nicer maps -- but we'll have to walk the _whole_ map, or bound by some range.
                 out[drawY][drawX] = '█'
                 coordCache[room] = (drawX, drawY)
                 # out[drawY][drawX] = str(count % 10)
                 # count += 1
-                exits = self.m.getRoomExits(room)
-                for d, tgt in exits.items():
-                    tgt = tgt['tgt']
-                    if d in ['n', 'e', 's', 'w', 'u', 'd', 'ne', 'se', 'sw', 'nw'] or re.match(r'open .+;[neswud]+', d):
-                        dataD = self.m.getRoomData(tgt)
-                        exists = False
-                        nextArea = None
-                        if dataD:
-                            exists = True
-                            nextArea = dataD['zone'] if 'zone' in dataD else None
+                roomExitData = m.exitData.get(room, {})
+                for dirNr, tgt in zip(*m.exitsOf(room)):
+                    if dirNr not in directions:
+                        directions[dirNr] = drawDirection(m.dirs[dirNr])
+                    d = directions[dirNr]
+                    if d:
+                        exists = m.explored(tgt)
+                        nextArea = m.zone[tgt] if exists else None
                         sameAreas = self.drawAreas or nextArea == area
+                        exitData = roomExitData.get(dirNr) or {}
 
                         if not exists or not sameAreas:
                             exitLen = 1
                         else:
-                            exitLen = getExitLen(room, d) + 1
+                            exitLen = getExitLen(exitData) + 1
 
                         exX = drawX
                         exY = drawY
@@ -386,7 +1218,6 @@ class Mapper(BaseModule):
                         for _ in range(exitLen + 1):  # exitlen for the exit, +1 for the target room
                             roomX, roomY, _, _, _ = adjustExit(roomX, roomY, d, ' ')
 
-                        exitData = self.m.getExitData(room, d)
                         if 'draw' in exitData and not exitData['draw']:
                             nexX, nexY, _, _, _ = adjustExit(exX, exY, d, out[drawY][drawX])
                             out[nexY][nexX] = '.'
@@ -593,9 +1424,11 @@ class Mapper(BaseModule):
             print("Created a new map")
 
     def find(self, args):
-        res = self.world.state['map-find-result'] = self.m.findRoomsByName(' '.join(args))
-        res.sort(key=lambda x: x[1])
-        res.sort(key=lambda x: x[2])
+        res = self.m.findRoomsByName(' '.join(args))
+        if not res:
+            res = self.m.searchRooms(' '.join(args))
+            self.show("No room is called that. Closest:\n")
+        self.world.state['map-find-result'] = res
         count = 1
         for nr, name, area in res:
             self.show("{count}\t{nr}\t{name}\t\t{area}\n".format(count=count, nr=nr, name=name, area=area))
@@ -607,36 +1440,30 @@ class Mapper(BaseModule):
     def unmapped(self, unvisited, inArea, one):
         if 'visited' not in self.world.state:
             self.world.state['visited'] = set()
+        visitedIds = self.world.state['visited']
+        m = self.m
         out = []  # A set would probably be smaller, but a list is in the order of closeness.
-        visited = set()
+        start = m.index(self.current())
+        seen = set([start])  # prevent enqueuing the same room a zillon times
         roomq = collections.deque()
-        roomq_check = set([self.current()])  # prevent enqueuing the same room a zillon times
-        roomq.append(self.current())
-        visited.add(self.current())
-        startArea = self.currentArea()
+        roomq.append(start)
+        startArea = m.zone[start]
         while roomq:
             room = roomq.popleft()
-            roomq_check.remove(room)
-            visited.add(room)
-            exits = self.m.getRoomExits(room)
-            for d, tgt in exits.items():
-                tgt = tgt['tgt']
-                edata = self.m.getExitData(room, d)
-                rdata = self.m.getRoomData(tgt)
-                if 'lock' not in edata:
-                    if not rdata:  # unexplored
-                        if one:
-                            return [tgt]
-                        else:
-                            out.append(tgt)
+            for d, tgt in m.openExits(room):
+                if not m.explored(tgt):
+                    if one:
+                        return [m.ids[tgt]]
                     else:
-                        sameZone = not inArea or rdata['zone'] == startArea
-                        if (unvisited and tgt not in self.world.state['visited'] and sameZone):
-                            out.append(tgt)
-                        else:
-                            if tgt not in visited and sameZone and tgt not in roomq_check:
-                                roomq_check.add(tgt)
-                                roomq.append(tgt)
+                        out.append(m.ids[tgt])
+                else:
+                    sameZone = not inArea or m.zone[tgt] == startArea
+                    if (unvisited and m.ids[tgt] not in visitedIds and sameZone):
+                        out.append(m.ids[tgt])
+                    else:
+                        if tgt not in seen and sameZone:
+                            seen.add(tgt)
+                            roomq.append(tgt)
         return list(dict.fromkeys(out))  # dedupe
 
     def autoVisit(self, args=None):
@@ -684,6 +1511,7 @@ class Mapper(BaseModule):
         super().__init__(mud)
         self.drawAreas = drawAreas
         self.spacesInRun = spacesInRun
+        self.paths = None
         self.load([mapfname])
 
         self.commands = {
@@ -714,7 +1542,7 @@ class Mapper(BaseModule):
                 'dec': self.dec,
                 'delexits': self.delExits,
                 'delzone': self.delZone,
-                'dump': lambda args: self.log(self.m.m),
+                'dump': lambda args: self.log(self.m.toDict()),
                 'startroom': self.startRoom,
                 'nodraw': self.noDraw,
                 'draw': lambda args: self.show(self.draw(int(args[0]), int(args[0]))),
@@ -724,11 +1552,13 @@ class Mapper(BaseModule):
         self.exitKw = None
         self.exitFrom = None
 
-    def alias(self, line):
-        words = line.split(' ')
+    def getCommands(self):
+        return {
+                '#map': self.command,
+                }
 
-        if words[0].lower() != '#map':
-            return
+    def command(self, line):
+        words = line.split(' ')
 
         if len(words) == 1:
             self.show(self.draw())
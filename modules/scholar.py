@@ -41,28 +41,27 @@ skills_by_level = {
         29: ['mherb herb'],
         }
 
-def write(mud, lag=1):
+def write(mud):
     if mud.gmcp['room']['info']['num'] != 1741703288:
         mud.log("Not running Scholar script - must be in Pecking Place")
         return
 
     def end(finalStr):
-        mud.log("Removing write triggers")
+        mud.log("Disabling write triggers")
         mud.send(finalStr)
-        lagSend(mud, 1, 'sleep')
-        # del mud.triggers['You are now in Add Text mode.']
-        # del mud.triggers['Menu ...A.D.L.I.E.R.S.Q.W.:']
-        # del mud.triggers['Quit without saving .N.y..']
+        mud.send_paced('sleep')
+        mud.triggers.disableGroup('scholar-write')
 
-    mud.log("Adding write triggers")
-    mud.triggers['You are now in Add Text mode.'] = '\n'
-    mud.triggers['Menu ...A.D.L.I.E.R.S.Q.W.:'] = 'q'
-    mud.triggers['Quit without saving .N.y..'] = lambda mud, groups: end('y')
-    mud.triggers['Enter the name of the chapter:'] = '\nsleep'
-    mud.triggers['Enter an empty line to exit.'] = '\nblarg'
+    mud.log("Enabling write triggers")
+    mud.triggers.add('You are now in Add Text mode.', '\n', group='scholar-write')
+    mud.triggers.add('Menu ...A.D.L.I.E.R.S.Q.W.:', 'q', group='scholar-write')
+    mud.triggers.add('Quit without saving .N.y..', lambda mud, groups: end('y'), group='scholar-write')
+    mud.triggers.add('Enter the name of the chapter:', '\nsleep', group='scholar-write')
+    mud.triggers.add('Enter an empty line to exit.', '\nblarg', group='scholar-write')
+    mud.triggers.enableGroup('scholar-write')
 
-    lagSend(mud, lag, 'stand')
-    lagSend(mud, lag + 1, 'write book "1111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111"')
+    mud.send_paced('stand')
+    mud.send_paced('write book "1111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111"')
 
 def practiceOne(mud):
     level = mud.level() - 1
@@ -74,28 +73,19 @@ def practiceTwo(mud):
     level = mud.level() - 1
     practiceImpl(mud, level-1, 0, -2)
 
-def lagSend(mud, lag, cmd):
-    mud.log("Enqueueing " + cmd + " @ " + str(lag))
-    def logAndSend(cmd):
-        mud.log("laggy send " + cmd)
-        mud.send(cmd)
-    mud.timers["lagsend_" + cmd] = mud.mkdelay(lag, lambda m, cmd=cmd: logAndSend(cmd))
-
 def practiceImpl(mud, begin, end, step):
     if mud.gmcp['room']['info']['num'] != 1741703288:
         mud.log("Not running Scholar script - must be in Pecking Place")
         return
 
     out = []
-    lag = 1
     mud.send("stand")
 
     for i in range(begin, end, step):
         if i in skills_by_level:
             for skill in skills_by_level[i]:
-                lagSend(mud, lag, skill)
-                lag += 1
-    write(mud, lag)
+                mud.send_paced(skill)
+    write(mud)
     return
 
 def learnFrom(mud, matches):
@@ -163,7 +153,7 @@ class Scholar(BaseModule):
             "You don't seem to know (.+).": tryAgainTeaching,
             ".+ has not learned the pre-requisites to (.+) yet.": doneTeaching,
             "You teach .+ '(.+)'": doneTeaching,
-            "You attempt to write on .*, but mess up.": lambda mud, groups: write(mud, 1),
+            "You attempt to write on .*, but mess up.": lambda mud, groups: write(mud),
             'You are hungry.': 'sta\neat bread\nsleep',
             'You are thirsty.': 'stand\ndrink sink\ndrink sink\ndrink sink\ndrink sink\nsleep',
             }
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import random
+import sys
+import telnet
+import time
+import zlib
+
+DIRECTIONS = {'n': 'north', 'e': 'east', 's': 'south', 'w': 'west', 'u': 'up', 'd': 'down',
+        'ne': 'northeast', 'nw': 'northwest', 'se': 'southeast', 'sw': 'southwest'}
+SHORT = {name: short for short, name in DIRECTIONS.items()}
+MAX_MOVES = 5000
+FLOOD_BATCH = 100  # lines per write when flooding as fast as the client reads
+TICK = 0.01  # how often a rate-limited flood writes
+MOBS = ['an orc', 'a goblin shaman', 'the town guard', 'a giant rat', 'a skeletal warrior']
+VERBS = ['hits', 'slashes', 'pierces', 'crushes', 'misses']
+ITEMS = ['a long sword', 'a leather cap', 'a loaf of bread', 'a waterskin', 'a pair of iron boots', 'a torch']
+
+
+# A stand-in for the real MUDs, for load testing pycat without bothering them. It walks the rooms of a pycat map
+# file, says what CoffeeMUD would over GMCP, and floods text on demand. Commands:
+#   n, north, ... and the map's own exits   move, if the map has that exit
+#   run 3n 2e s    several moves at once, as the mapper sends them (go works too)
+#   look, recall, goto <room>, rest, quit
+#   flood combat|list|rooms <lines> [lines per second]   rooms wanders about; the default rate is the server's
+class MudServer(object):
+    def __init__(self, mapfname, start=None, rate=0, mccp=False):
+        with open(mapfname) as f:
+            m = json.load(f)
+        self.rooms = m['rooms']
+        self.bookmarks = m['bookmarks']
+        if start is None:
+            start = self.bookmarks.get('recall', next(iter(self.rooms)))
+        self.start = self.bookmarks.get(start, start)
+        self.rate = rate
+        self.mccp = mccp
+        self.server = None
+        self.players = []
+
+    async def listen(self, host, port):
+        self.server = await asyncio.start_server(self.connected, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def connected(self, reader, writer):
+        player = Player(self, reader, writer)
+        self.players.append(player)
+        try:
+            await player.run()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.players.remove(player)
+            player.close()
+
+    def close(self):
+        self.server.close()
+        for player in self.players:
+            player.close()
+
+    def roomInfo(self, nr):
+        room = self.rooms.get(nr, {})
+        data = room.get('data') or {}
+        return {
+                'num': int(nr),
+                'id': nr,
+                'name': room.get('name') or 'An unexplored room',
+                'zone': data.get('zone', 'Unknown'),
+                'terrain': data.get('terrain', 'unknown'),
+                'exits': {d.upper(): int(e['tgt']) for d, e in room.get('exits', {}).items() if d in DIRECTIONS},
+                'coord': {'cont': 0, 'id': 0, 'x': -1, 'y': -1},
+                'desc': '',
+                'details': '',
+                }
+
+
+class Player(object):
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.parser = telnet.TelnetParser(self.iac, self.subnegotiation)
+        self.gmcp = False
+        self.ttype = None
+        self.compressor = None
+        self.room = server.start
+        self.hp = self.mana = 100
+        self.moves = MAX_MOVES
+        self.flooding = None
+
+    async def run(self):
+        offers = telnet.IAC + telnet.WILL + telnet.TTYPE + telnet.IAC + telnet.WILL + telnet.GMCP
+        if self.server.mccp:
+            offers += telnet.IAC + telnet.WILL + telnet.COMPRESS2
+        self.write(offers)
+        self.text("Welcome to the pycat test MUD, {} rooms to walk.".format(len(self.server.rooms)))
+        self.look()
+        self.prompt()
+        while True:
+            data = await self.reader.read(4096)
+            if not data:
+                return
+            for line in self.parser.feed(data):
+                if not self.command(line.decode('iso-8859-1').strip()):
+                    await self.writer.drain()
+                    return
+            await self.writer.drain()
+
+    def close(self):
+        if self.flooding:
+            self.flooding.cancel()
+        self.writer.close()
+
+    def write(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.writer.write(data)
+
+    def text(self, text):
+        self.write(text.replace('\n', '\r\n').encode('iso-8859-1') + b'\r\n')
+
+    def sendGmcp(self, key, value):
+        if self.gmcp:
+            self.write(telnet.IAC + telnet.SB + telnet.GMCP + telnet.escape(
+                (key + ' ' + json.dumps(value)).encode('iso-8859-1')) + telnet.IAC + telnet.SE)
+
+    def prompt(self):
+        self.write('<{}hp {}m {}mv> '.format(self.hp, self.mana, self.moves).encode('iso-8859-1') + telnet.IAC + telnet.GA)
+
+    def iac(self, cmd, option):
+        if cmd == telnet.DO and option == telnet.GMCP:
+            self.gmcp = True
+        elif cmd == telnet.DO and option == telnet.COMPRESS2 and self.server.mccp and not self.compressor:
+            self.write(telnet.IAC + telnet.SB + telnet.COMPRESS2 + telnet.IAC + telnet.SE)
+            self.compressor = zlib.compressobj()
+
+    def subnegotiation(self, data):
+        if data[:1] == telnet.TTYPE:
+            self.ttype = data[2:].decode('iso-8859-1')
+        elif data[:1] == telnet.GMCP:
+            request = data[1:].decode('iso-8859-1')
+            if request == 'request room':
+                self.sendGmcp('room.info', self.server.roomInfo(self.room))
+            elif request == 'request char':
+                self.sendChar()
+
+    def sendChar(self):
+        self.sendGmcp('char.base', {'name': 'Tester', 'perlevel': 1000})
+        self.sendGmcp('char.maxstats', {'maxhp': 100, 'maxmana': 100, 'maxmoves': MAX_MOVES})
+        self.sendGmcp('char.status', {'level': 1, 'tnl': 1000, 'pos': 'Standing', 'fatigue': 0})
+        self.sendVitals()
+
+    def sendVitals(self):
+        self.sendGmcp('char.vitals', {'hp': self.hp, 'mana': self.mana, 'moves': self.moves})
+
+    # Returns False to hang up
+    def command(self, line):
+        words = line.split()
+        cmd = words[0].lower() if words else ''
+        exits = self.server.rooms.get(self.room, {}).get('exits', {})
+        if not words:
+            pass
+        elif cmd in DIRECTIONS or cmd in SHORT or line in exits:
+            self.move(SHORT.get(cmd, cmd) if line not in exits else line)
+        elif cmd in ('run', 'go'):
+            for step in runSteps(words[1:]):
+                if not self.move(step):
+                    break
+        elif cmd in ('l', 'look'):
+            self.look()
+        elif cmd == 'recall':
+            self.enter(self.server.start)
+        elif cmd == 'goto' and len(words) == 2:
+            nr = self.server.bookmarks.get(words[1], words[1])
+            if nr in self.server.rooms:
+                self.enter(nr)
+            else:
+                self.text("No such room.")
+        elif cmd in ('rest', 'sleep'):
+            self.hp = self.mana = 100
+            self.moves = MAX_MOVES
+            self.text("You rest and feel refreshed.")
+            self.sendVitals()
+        elif cmd in ('open', 'unlock', 'lock', 'close'):
+            self.text("Ok.")
+        elif cmd == 'flood' and len(words) in (3, 4) and words[1] in FLOODS and words[2].isdigit():
+            if self.flooding:
+                self.flooding.cancel()
+            rate = float(words[3]) if len(words) == 4 else self.server.rate
+            self.flooding = asyncio.ensure_future(self.flood(words[1], int(words[2]), rate))
+            return True
+        elif cmd == 'quit':
+            self.text("Goodbye.")
+            return False
+        else:
+            self.text("Huh?")
+        self.prompt()
+        return True
+
+    def move(self, direction):
+        exits = self.server.rooms.get(self.room, {}).get('exits', {})
+        if direction not in exits:
+            self.text("You can't go that way.")
+            return False
+        if not self.moves:
+            self.text("You are too exhausted.")
+            return False
+        self.moves -= 1
+        self.enter(exits[direction]['tgt'])
+        self.sendVitals()
+        return True
+
+    def enter(self, nr):
+        self.room = nr
+        self.look()
+        self.sendGmcp('room.info', self.server.roomInfo(nr))
+
+    def look(self):
+        info = self.server.roomInfo(self.room)
+        self.text("{}\nExits: {}".format(info['name'],
+            ' '.join(DIRECTIONS[d.lower()] for d in info['exits']) or 'none'))
+
+    async def flood(self, kind, count, rate):
+        start = time.monotonic()
+        lines = FLOODS[kind](self)
+        batch = max(1, int(rate * TICK)) if rate else FLOOD_BATCH
+        sent = 0
+        while sent < count:
+            if rate:
+                due = start + sent / rate
+                if due > time.monotonic():
+                    await asyncio.sleep(due - time.monotonic())
+            for i in range(min(batch, count - sent)):
+                next(lines)
+            sent += min(batch, count - sent)
+            await self.writer.drain()
+        took = time.monotonic() - start
+        self.text("Flooded {} lines in {:.3f} s, {:.0f} lines/s".format(count, took, count / max(took, 1e-9)))
+        self.prompt()
+        self.flooding = None
+
+
+def combat(player):
+    while True:
+        mob = random.choice(MOBS)
+        verb = random.choice(VERBS)
+        if verb == 'misses':
+            player.text("{} misses you.".format(mob.capitalize()))
+        else:
+            player.hp = max(player.hp - 1, 1)
+            player.text("{} {} you with a {} blow! [{}]".format(mob.capitalize(), verb,
+                random.choice(['weak', 'solid', 'devastating']), random.randint(1, 30)))
+        yield
+        player.text("You slash {} very hard. [{}]".format(mob, random.randint(1, 30)))
+        player.sendVitals()
+        yield
+
+
+def listing(player):
+    nr = 0
+    while True:
+        nr += 1
+        player.text("[{:4}] {:<40} {:>6} gold  level {:>3}  {}".format(nr, random.choice(ITEMS),
+            random.randint(1, 99999), random.randint(1, 100), 'x' * random.randint(0, 40)))
+        yield
+
+
+def wander(player):
+    while True:
+        exits = [d for d in player.server.rooms.get(player.room, {}).get('exits', {}) if d in DIRECTIONS]
+        if exits:
+            player.move(random.choice(exits))
+        else:
+            player.enter(player.server.start)
+        yield
+
+
+FLOODS = {'combat': combat, 'list': listing, 'rooms': wander}
+
+
+# Turns "3n 2e s" into n n n e e s
+def runSteps(words):
+    steps = []
+    for word in words:
+        count = word.rstrip('nsewud')
+        direction = word[len(count):]
+        steps += [direction] * (int(count) if count.isdigit() else 1)
+    return steps
+
+
+def main():
+    args = sys.argv[1:]
+    options = {'--port': '4444', '--map': 'coffee.map', '--start': None, '--rate': '0'}
+    mccp = '--mccp' in args
+    if mccp:
+        args.remove('--mccp')
+    while len(args) >= 2 and args[0] in options:
+        options[args[0]] = args[1]
+        args = args[2:]
+    if args:
+        print("Usage: {} [--port port] [--map file] [--start room or bookmark] [--rate lines/s] [--mccp]".format(sys.argv[0]))
+        exit(1)
+
+    loop = asyncio.new_event_loop()
+    server = MudServer(options['--map'], options['--start'], float(options['--rate']), mccp)
+    port = loop.run_until_complete(server.listen('localhost', int(options['--port'])))
+    print("Serving {} rooms on localhost port {}".format(len(server.rooms), port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
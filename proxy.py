@@ -1,93 +1,380 @@
 #!/usr/bin/env python3
 
-import queue
+import asyncio
+import collections
+import functools
 import os
 import socket
-import sys
-import threading
+import struct
+import tempfile
+import time
 
-from select import select
+MEMORY_LIMIT = 1024 * 1024  # output kept in memory while no client is connected, the rest goes to disk
+DISK_LIMIT = 64 * 1024 * 1024  # beyond this, the oldest output is dropped
+SEGMENT_SIZE = 4 * 1024 * 1024
+REPLAY_BYTES = 64 * 1024  # how much of it a client gets when it connects
+HIGH_WATERMARK = 256 * 1024  # output queued for a client that isn't reading it fast enough
+LOW_WATERMARK = 64 * 1024
+SPILL, COALESCE = 'spill', 'coalesce'  # what to do about a client over the high watermark
+PRIMARY, OBSERVER = 'primary', 'observer'  # only the primary client's input goes to the session
+SPILLED = struct.Struct('<dI')  # time, length
 
 
-# returns anonymous pipes (readableFromClient, writableToClient)
-def proxy(bindAddr, listenPort):
+# Output waiting for a client to connect. Newest output stays in memory, up to memoryLimit bytes; older output is
+# spilled to unlinked temporary files, up to diskLimit bytes, and dropped beyond that. With no diskLimit, it's a
+# plain ring of the newest output.
+class FrontendBuffer(object):
+    def __init__(self, memoryLimit=MEMORY_LIMIT, diskLimit=DISK_LIMIT, spillDir=None):
+        self.memoryLimit = memoryLimit
+        self.diskLimit = diskLimit
+        self.spillDir = spillDir
+        self.chunks = collections.deque()  # (time, data)
+        self.memoryBytes = 0
+        self.segments = collections.deque()  # [file, size on disk, bytes of output, read offset], oldest first
+        self.diskBytes = 0  # not read back yet
+        self.total = 0  # bytes buffered since the last clear()
+        self.dropped = 0  # of those, bytes lost
+
+    def __len__(self):
+        return self.total
+
+    def append(self, data):
+        self.chunks.append((time.time(), data))
+        self.memoryBytes += len(data)
+        self.total += len(data)
+        while self.memoryBytes > self.memoryLimit and len(self.chunks) > 1:
+            if self.diskLimit:
+                self.spill(*self.chunks.popleft())
+            else:
+                when, data = self.chunks.popleft()
+                self.memoryBytes -= len(data)
+                self.dropped += len(data)
+
+    def spill(self, when, data):
+        self.memoryBytes -= len(data)
+        if not self.segments or self.segments[-1][1] >= SEGMENT_SIZE:
+            self.segments.append([tempfile.TemporaryFile(dir=self.spillDir), 0, 0, 0])
+        segment = self.segments[-1]
+        segment[0].write(SPILLED.pack(when, len(data)) + data)
+        segment[1] += SPILLED.size + len(data)
+        segment[2] += len(data)
+        self.diskBytes += SPILLED.size + len(data)
+        while self.diskBytes > self.diskLimit and len(self.segments) > 1:
+            file, size, output, offset = self.segments.popleft()
+            file.close()
+            self.diskBytes -= size - offset
+            self.dropped += output
+
+    # The last maxBytes of output (starting at a line), leaving out what's older than since, followed by a note
+    # on what was left out
+    def replay(self, maxBytes=REPLAY_BYTES, since=None, note=True):
+        parts = []
+        size = 0
+        for when, data in self.newestFirst():
+            if size >= maxBytes or (since is not None and when < since):
+                break
+            parts.append(data)
+            size += len(data)
+        parts.reverse()
+        out = b''.join(parts)
+        if len(out) > maxBytes:
+            out = out[-maxBytes:]
+            out = out[out.find(b'\n') + 1:]
+        if note and len(out) < self.total:
+            out += '--- Replayed the last {} of {} bytes of output ({} lost) ---\n'.format(
+                len(out), self.total, self.dropped).encode()
+        return out
+
+    def newestFirst(self):
+        for chunk in reversed(self.chunks):
+            yield chunk
+        for segment in reversed(self.segments):
+            yield from reversed(self.read(segment)[0])
+
+    # Returns the spilled (time, data) of a segment from its read offset on, up to maxBytes of output or a chunk
+    # more, and the offset after them
+    def read(self, segment, maxBytes=None):
+        file, size, output, offset = segment
+        file.flush()
+        file.seek(offset)
+        spilled = []
+        got = 0
+        while offset < size and (maxBytes is None or got < maxBytes):
+            when, length = SPILLED.unpack(file.read(SPILLED.size))
+            spilled.append((when, file.read(length)))
+            offset += SPILLED.size + length
+            got += length
+        file.seek(0, os.SEEK_END)
+        return spilled, offset
+
+    # Removes and returns the oldest output, at least maxBytes of it if there's that much, and no more than a
+    # chunk beyond that
+    def take(self, maxBytes):
+        out = []
+        size = 0
+        while size < maxBytes and self.segments:
+            segment = self.segments[0]
+            spilled, offset = self.read(segment, maxBytes - size)
+            taken = sum(len(data) for when, data in spilled)
+            out.extend(data for when, data in spilled)
+            self.diskBytes -= offset - segment[3]
+            segment[2] -= taken
+            segment[3] = offset
+            size += taken
+            if offset == segment[1]:
+                self.segments.popleft()
+                segment[0].close()
+        while size < maxBytes and self.chunks:
+            when, data = self.chunks.popleft()
+            self.memoryBytes -= len(data)
+            out.append(data)
+            size += len(data)
+        self.total -= size
+        return out
+
+    def clear(self):
+        for segment in self.segments:
+            segment[0].close()
+        self.segments.clear()
+        self.chunks.clear()
+        self.memoryBytes = self.diskBytes = self.total = self.dropped = 0
+
+
+# A connected frontend. Its socket is non-blocking: whatever it won't take right away is queued, and sent as it
+# becomes writable. Once more than HIGH_WATERMARK bytes are queued, the policy decides:
+#   SPILL: further output waits in a FrontendBuffer (so on disk, mostly) until the queue is down to LOW_WATERMARK
+#   COALESCE: the queue is cut down to its newest LOW_WATERMARK bytes, so the client skips ahead to live output
+class Client(object):
+    def __init__(self, loop, sock, policy=SPILL, addr=None):
+        self.loop = loop
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.policy = policy
+        self.addr = addr
+        self.role = OBSERVER
+        self.warned = False
+        self.input = bytearray()  # the start of a line typed
+        self.cursor = 0  # where in the session's output this client's live output started
+        self.queue = collections.deque()  # bytes or memoryviews, oldest first
+        self.queued = 0
+        self.backlog = None  # FrontendBuffer, while spilling
+        self.skipped = 0
+        self.writing = False
+
+    def send(self, data):
+        if self.backlog is not None:
+            self.backlog.append(data)
+            return
+        if not self.queue:
+            data = self.write(data)
+            if not data:
+                return
+        self.queue.append(data)
+        self.queued += len(data)
+        if self.queued > HIGH_WATERMARK:
+            self.overflow()
+        if not self.writing:
+            self.loop.add_writer(self.sock, self.drain)
+            self.writing = True
+
+    # Returns what the socket didn't take
+    def write(self, data):
+        try:
+            n = self.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        except OSError:  # the reader will notice it's gone
+            return None
+        if n < len(data):
+            return memoryview(data)[n:]
+        return None
+
+    def overflow(self):
+        if self.policy == SPILL:
+            self.backlog = FrontendBuffer()
+            return
+        # the oldest chunk may be partly on the wire already, keep it whole
+        head = self.queue.popleft()
+        rest = b''.join(self.queue)
+        if len(rest) <= LOW_WATERMARK:
+            self.queue.appendleft(head)
+            return
+        tail = rest[-LOW_WATERMARK:]
+        tail = tail[tail.find(b'\n') + 1:]
+        self.skipped += len(rest) - len(tail)
+        marker = '\n--- Skipped {} bytes of output, you were falling behind ---\n'.format(len(rest) - len(tail))
+        self.queue.clear()
+        self.queue.extend([head, marker.encode(), tail])
+        self.queued = sum(len(data) for data in self.queue)
+
+    def drain(self):
+        while self.queue:
+            data = self.queue.popleft()
+            self.queued -= len(data)
+            rest = self.write(data)
+            if rest:
+                self.queue.appendleft(rest)
+                self.queued += len(rest)
+                break
+        if self.backlog is not None and self.queued < LOW_WATERMARK:
+            for data in self.backlog.take(HIGH_WATERMARK - LOW_WATERMARK):
+                self.queue.append(data)
+                self.queued += len(data)
+            if not self.backlog.chunks and not self.backlog.segments:
+                if self.backlog.dropped:
+                    self.queue.append('\n--- Lost {} bytes of output, you were falling behind ---\n'.format(
+                        self.backlog.dropped).encode())
+                self.backlog.clear()
+                self.backlog = None
+        if not self.queue and self.writing:
+            self.loop.remove_writer(self.sock)
+            self.writing = False
+
+    def close(self):
+        self.loop.remove_reader(self.sock)
+        if self.writing:
+            self.loop.remove_writer(self.sock)
+            self.writing = False
+        if self.backlog is not None:
+            self.backlog.clear()
+        self.sock.close()
+
+
+# Returns a Proxy listening on bindAddr, listenPort. It calls onInput(line) with every line (bytes, without the
+# newline) the primary client sends; output goes to the clients with write().
+# replay is (bytes, seconds): how much of the output buffered while no client was connected to send when one
+# connects, and how old it may be (None for no limit)
+def proxy(bindAddr, listenPort, loop, onInput, replay=(REPLAY_BYTES, None), policy=SPILL):
     sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((bindAddr, listenPort))
     sock.listen(5)
-    socketToPipeR, socketToPipeW = os.pipe()
-    pipeToSocketR, pipeToSocketW = os.pipe()
-    stop = threading.Event()
-
-    return socketToPipeR, pipeToSocketW, stop, lambda: serve(socketToPipeW, pipeToSocketR, sock, stop)
-
-
-def serve(socketToPipeW, pipeToSocketR, sock, stop):
-    socketToPipeW = os.fdopen(socketToPipeW, 'wb')
-
-    clientSocket = None
-    clientSockets = []
-    addr = None
-
-    pipeToSocketBuffer = []
-
-    while not stop.is_set():
-        fds, _, _ = select([sock, pipeToSocketR] + clientSockets, [], [])
-        for fd in fds:
-            if fd == sock:
-                print("new client")
-                if clientSocket:
-                    print("booting old client")
-                    clientSocket.sendall(b"Superseded. Bye!")
-                    clientSocket.close()
-                clientSocket, addr = sock.accept()
-                clientSockets = [clientSocket]
-                for item in pipeToSocketBuffer:
-                    clientSocket.sendall(item)
-                pipeToSocketBuffer = []
-            elif fd == clientSocket:
-                data = fd.recv(4096)
-                if not data:  # disconnect
-                    clientSocket.close()
-                    clientSocket = None
-                    clientSockets = []
-                    print("socket disconnected")
-                else:
-                    socketToPipeW.write(data)  # TODO: partial writes?
-                    socketToPipeW.flush()
-            elif fd == pipeToSocketR:
-                data = os.read(pipeToSocketR, 4096)
-                if not data:
-                    print("EOF from pipe")
-                    break
-                if clientSocket:
-                    clientSocket.sendall(data)  # TODO: partial writes?
-                else:
-                    pipeToSocketBuffer.append(data)
-    print("Gracefully shutting down in serve")
+    sock.setblocking(False)
+    return Proxy(loop, sock, onInput, replay, policy)
 
 
-if __name__ == "__main__":
-    def echo(socketToPipeR, pipeToSocketW, stopFlag):
-        pipeToSocketW = os.fdopen(pipeToSocketW, 'wb')
+# Runs on the session's event loop instead of a thread of its own.
+# Any number of clients can be connected. The output goes to all of them, as the same bytes objects, each client
+# queueing them on its own. The newest client gets to send input (it's the primary), the others are observers,
+# until they send '#primary' to take over again. A client can also step down with '#observe'. With no primary,
+# whoever sends something first gets the role.
+class Proxy(object):
+    def __init__(self, loop, sock, onInput, replay=(REPLAY_BYTES, None), policy=SPILL):
+        self.loop = loop
+        self.sock = sock
+        self.onInput = onInput
+        self.clients = []
+        self.primary = None
+        self.output = 0  # bytes of output so far
+        self.buffer = FrontendBuffer()  # output while no client is connected
+        self.recent = FrontendBuffer(replay[0], 0)  # the newest output, for observers joining
+        self.replay = replay
+        self.policy = policy
+        self.stopped = False
+
+    def start(self):
+        self.loop.add_reader(self.sock, self.accept)
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.loop.remove_reader(self.sock)
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self.primary = None
+        self.sock.close()
+        self.buffer.clear()
+        print("Gracefully shutting down in serve")
+
+    def accept(self):
+        sock, addr = self.sock.accept()
+        print("new client", addr)
+        client = Client(self.loop, sock, self.policy, addr)
+        self.clients.append(client)
+        self.loop.add_reader(sock, functools.partial(self.fromClient, client))
+        maxBytes, maxAge = self.replay
+        since = None if maxAge is None else time.time() - maxAge
+        if self.buffer:
+            client.send(self.buffer.replay(maxBytes, since))
+            self.buffer.clear()
+        elif self.recent:
+            client.send(self.recent.replay(maxBytes, since, note=False))
+        client.cursor = self.output
+        self.makePrimary(client)
+
+    def makePrimary(self, client):
+        if self.primary is client:
+            return
+        if self.primary:
+            self.primary.role = OBSERVER
+            self.primary.warned = False
+            self.primary.send(b"--- Another frontend took over input. Send #primary to take it back. ---\n")
+        self.primary = client
+        client.role = PRIMARY
+
+    def fromClient(self, client):
         try:
-            while not stopFlag.is_set():
-                data = os.read(socketToPipeR, 4096)
-                print(b"Got %d, sleeping" % (len(data)))
-                import time
-                time.sleep(1)
-                print(b"Echoing %d" % (len(data)))
-                pipeToSocketW.write(data)
-                pipeToSocketW.flush()
-        except KeyboardInterrupt:
-            stopFlag.set()
-        print("Gracefully shutting down in echo")
-
-    socketToPipeR, pipeToSocketW, stopFlag, work = proxy('::1', 1234)
-    echoThr = threading.Thread(target=echo, args=[socketToPipeR, pipeToSocketW, stopFlag])
-    echoThr.start()
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:  # disconnect
+            self.clients.remove(client)
+            client.close()
+            if self.primary is client:
+                self.primary = None
+            print("socket disconnected", client.addr)
+            return
+        # lines only, so that '#primary' and the like can be told apart
+        client.input += data
+        end = client.input.rfind(b'\n') + 1
+        if not end:
+            return
+        lines = bytes(client.input[:end]).split(b'\n')[:-1]
+        del client.input[:end]
+        for line in lines:
+            command = line.strip()
+            if command == b'#primary':
+                self.makePrimary(client)
+            elif command == b'#observe':
+                if self.primary is client:
+                    self.primary = None
+                client.role = OBSERVER
+            else:
+                if self.primary is None:
+                    self.makePrimary(client)
+                if self.primary is client:
+                    self.onInput(line)
+                elif not client.warned:
+                    client.warned = True
+                    client.send(b"--- You're observing, input is ignored. Send #primary to take over. ---\n")
+
+    def write(self, data):
+        if not data:
+            return
+        self.output += len(data)
+        self.recent.append(data)
+        if not self.clients:
+            self.buffer.append(data)
+        for client in self.clients:
+            client.send(data)
+
+
+if __name__ == "__main__":
+    loop = asyncio.new_event_loop()
+
+    def echo(line):
+        print(b"Got %d, echoing in 1s" % (len(line)))
+        loop.call_later(1, prx.write, line + b'\n')
+
+    prx = proxy('::1', 1234, loop, echo)
+    prx.start()
     try:
-        work()
+        loop.run_forever()
     except KeyboardInterrupt:
-        stopFlag.set()
-    echoThr.join()
+        pass
+    prx.stop()
+    print("Gracefully shutting down in echo")
@@ -1,84 +1,112 @@
 #!/usr/bin/env python3
 
 from proxy import proxy
-from select import select
+import asyncio
 import importlib
 import json
-import os
 import pprint
 import re
+import recording
+import sendqueue
+import socket
+import stats
 import sys
-import telnetlib
-import threading
+import telnet
+import time
 import traceback
-telnetlib.GMCP = b'\xc9'
+
+PROMPT_DELAY = 0.1  # seconds to wait for the rest of an unterminated line before treating it as a prompt
 
 
 class Session(object):
-    def __init__(self, world_module, port, arg):
+    # record is the path to record the session to (see recording), if any
+    def __init__(self, world_module, port, arg, record=None):
         self.mud_encoding = 'iso-8859-1'
         self.client_encoding = 'utf-8'
+        # MUD I/O, the frontend proxy, timers and GMCP all share this one loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
         self.world_module = world_module
         self.arg = arg
+        self.recvBuffer = bytearray(65536)
+        self.parser = telnet.TelnetParser(self.iac, self.subnegotiation)
+        self.partialShown = 0  # how much of the parser's partial line the frontend has already seen
+        self.promptHandle = None
+        self.received = []  # (lines before it, prompt) for each GA/EOR so far in the current chunk
+        self.stats = stats.Stats()
+        self.recorder = recording.Recorder(record) if record else None
         self.world = world_module.getClass()(self, self.arg)
         try:
-            self.socketToPipeR, self.pipeToSocketW, self.stopFlag, runProxy = proxy('::1', port)
-            self.pipeToSocketW = os.fdopen(self.pipeToSocketW, 'wb')
-            self.proxyThread = threading.Thread(target=runProxy)
-            self.proxyThread.start()
+            # the frontends connect straight to this loop
+            self.proxy = proxy('::1', port, self.loop, self.handle_from_frontend,
+                    self.world.getReplay(), self.world.getSlowFrontendPolicy())
+            self.proxy.start()
             host_port = self.world.getHostPort()
             self.log("Connecting")
             self.telnet = self.connect(*host_port)
+            self.outgoing = sendqueue.SendQueue(self.loop, self.write_to_mud, lambda: self.world.getPacing())
             self.log("Connected")
         except:
             self.log("Shutting down")
-            self.stopFlag.set()
+            self.proxy.stop()
             self.world.quit()
             raise
 
-    def join(self):
-        self.thr.join()
+    def stop(self):
+        self.outgoing.close()
+        self.proxy.stop()
+        self.world.quit()
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+        self.loop.stop()
 
     def log(self, *args, **kwargs):
         if len(args) == 1 and type(args[0]) == str:
             line = args[0]
         else:
             line = pprint.pformat(args)
-        self.pipeToSocketW.write("---------\n".encode(self.client_encoding))
-        self.pipeToSocketW.write(line.encode(self.client_encoding))
-        self.pipeToSocketW.write(b"\n")
-        self.pipeToSocketW.flush()
+        self.proxy.write(("---------\n" + line + "\n").encode(self.client_encoding))
 
     def strip_ansi(self, line):
         return re.sub(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]', '', line)
 
     def gmcpOut(self, msg):
-        self.telnet.sock.sendall(telnetlib.IAC + telnetlib.SB + telnetlib.GMCP + msg.encode(self.mud_encoding) + telnetlib.IAC + telnetlib.SE)
+        self.outgoing.send(telnet.IAC + telnet.SB + telnet.GMCP + telnet.escape(msg.encode(self.mud_encoding)) + telnet.IAC + telnet.SE, 0)
 
-    def iac(self, sock, cmd, option):
-        if cmd == telnetlib.WILL:
-            if option == telnetlib.GMCP:
+    def iac(self, cmd, option):
+        if cmd == telnet.WILL:
+            if option == telnet.GMCP:
                 self.log("Enabling GMCP")
-                sock.sendall(telnetlib.IAC + telnetlib.DO + option)
+                self.outgoing.send(telnet.IAC + telnet.DO + option, 0)
                 self.gmcpOut('Core.Hello { "client": "Cizra", "version": "1" }')
                 supportables = ['char 1', 'char.base 1', 'char.maxstats 1', 'char.status 1', 'char.statusvars 1', 'char.vitals 1', 'char.worth 1', 'comm 1', 'comm.tick 1', 'group 1', 'room 1', 'room.info 1']
                 self.gmcpOut('Core.Supports.Set ' + str(supportables).replace("'", '"'))
                 self.gmcpOut('request room')
                 self.gmcpOut('request char')
-            elif option == telnetlib.TTYPE:
+            elif option == telnet.COMPRESS2:
+                self.log("Enabling MCCP2")
+                self.outgoing.send(telnet.IAC + telnet.DO + option, 0)
+            elif option == telnet.TTYPE:
                 self.log("Sending terminal type 'Cizra'")
-                sock.sendall(telnetlib.IAC + telnetlib.DO + option +
-                        telnetlib.IAC + telnetlib.SB + telnetlib.TTYPE + telnetlib.BINARY + b'Cizra' + telnetlib.IAC + telnetlib.SE)
+                self.outgoing.send(telnet.IAC + telnet.DO + option +
+                        telnet.IAC + telnet.SB + telnet.TTYPE + telnet.BINARY + b'Cizra' + telnet.IAC + telnet.SE, 0)
 
             else:
-                sock.sendall(telnetlib.IAC + telnetlib.DONT + option)
-        elif cmd == telnetlib.SE:
-            data = self.telnet.read_sb_data()
-            if data and data[0] == ord(telnetlib.GMCP):
-                try:
-                    self.handleGmcp(data[1:].decode(self.mud_encoding))
-                except Exception as e:
-                    traceback.print_exc()
+                self.outgoing.send(telnet.IAC + telnet.DONT + option, 0)
+        elif cmd == telnet.GA or cmd == telnet.EOR:
+            # handle_received() handles the lines before the prompt, then the prompt, then the rest of the chunk
+            self.received.append((self.parser.takeLines(), self.parser.takePartial()))
+
+    def subnegotiation(self, data):
+        if data[:1] == telnet.GMCP:
+            start = time.perf_counter()
+            try:
+                self.handleGmcp(data[1:].decode(self.mud_encoding))
+            except Exception as e:
+                traceback.print_exc()
+            self.stats.record('gmcp', time.perf_counter() - start)
+            self.stats.count('gmcp messages')
 
     def handleGmcp(self, data):
         # this.that {JSON blob}
@@ -103,74 +131,142 @@ class Session(object):
         self.world.handleGmcp(whole_key, val)
 
     def connect(self, host, port):
-        t = telnetlib.Telnet()
-        t.set_option_negotiation_callback(self.iac)
-        # t.set_debuglevel(1)
-        t.open(host, int(port))
-        return t
+        return socket.create_connection((host, int(port)))
 
+    def write_to_mud(self, data):
+        if self.recorder:
+            self.recorder.record(recording.OUTBOUND, data)
+        self.telnet.sendall(data)
+
+    # Commands sent in the same loop iteration go out in one write
     def send(self, line):
         print("> ", line)
-        self.telnet.write((line + '\n').encode(self.mud_encoding))
+        self.stats.count('sends')
+        self.outgoing.send(telnet.escape((line + '\n').encode(self.mud_encoding)), line.count('\n') + 1)
 
-    def handle_from_telnet(self):
-        try:
-            data = self.telnet.read_very_eager()
-        except:
-            self.log("EOF on telnet")
-            self.stopFlag.set()
-            self.world.quit()
-            raise
+    # Waits for the MUD to catch up before sending, as set by the world's getPacing()
+    def send_paced(self, line):
+        print("paced> ", line)
+        self.stats.count('paced sends')
+        self.outgoing.sendPaced(telnet.escape((line + '\n').encode(self.mud_encoding)), line.count('\n') + 1)
+
+    def decode(self, data):
         try:
-            data = data.decode(self.mud_encoding)
+            return data.decode(self.mud_encoding)
         except UnicodeError as e:
             print("Unicode error:", e)
             print("Data was:", data)
-            data = ''
+            return ''
+
+    def handle_from_telnet(self):
+        start = time.perf_counter()
+        try:
+            n = self.telnet.recv_into(self.recvBuffer)
+        except OSError as e:
+            n = 0
+        if not n:
+            self.log("EOF on telnet")
+            self.stop()
+            return
+        if self.recorder:
+            self.recorder.record(recording.INBOUND, self.recvBuffer[:n])
+        self.handle_received(n, start)
+
+    # Handles the n bytes read into self.recvBuffer, at time start
+    def handle_received(self, n, start):
+        if self.promptHandle:
+            self.promptHandle.cancel()
+            self.promptHandle = None
 
-        if not data:
-            _ = self.telnet.read_sb_data()
+        last = self.parser.feed(self.recvBuffer, n)
+        received, self.received = self.received, []
+        received.append((last, None))
+        received = [([self.decode(line) for line in lines], prompt) for lines, prompt in received]
+        parsed = time.perf_counter()
+        self.stats.record('telnet parse', parsed - start)
+        self.stats.count('bytes in', n)
+        nlines = sum(len(lines) for lines, prompt in received)
+        self.stats.count('lines in', nlines)
         prn = []
-        for line in data.split('\n'):
+        for lines, prompt in received:
+            self.handle_lines(lines, prn)
+            if prompt is not None:
+                shown, self.partialShown = self.partialShown, 0
+                prn.append(self.prompt(prompt, shown))
+        triggered = time.perf_counter()
+
+        # Show an unterminated line (most likely a prompt) right away, but only fire triggers on it once it's
+        # complete, or once the MUD goes quiet or marks it as a prompt with GA/EOR.
+        partial = self.parser.partial()
+        if len(partial) > self.partialShown:
+            prn.append(self.decode(partial[self.partialShown:]))
+            self.partialShown = len(partial)
+        if partial:
+            self.promptHandle = self.loop.call_later(PROMPT_DELAY, self.handle_prompt)
+        self.proxy.write(''.join(prn).encode(self.mud_encoding))
+        end = time.perf_counter()
+        self.stats.record('frontend write', end - triggered)
+        # from the socket read to the frontend, for the chunk and for each of its lines
+        self.stats.record('chunk', end - start)
+        if nlines:
+            self.stats.record('line', end - start, nlines)
+
+    # Fires triggers on complete lines, adds what the frontend has yet to see of them to prn
+    def handle_lines(self, lines, prn):
+        if not lines:
+            return
+        start = time.perf_counter()
+        replacements = []
+        try:
+            replacements = self.world.triggerLines([line.strip() for line in lines if line])
+        except Exception as e:
+            traceback.print_exc()
+        self.stats.record('triggers', time.perf_counter() - start)
+        replacements = iter(replacements)
+        for line in lines:
+            shown, self.partialShown = self.partialShown, 0
             if line:
-                replacement = None
-                try:
-                    replacement = self.world.trigger(line.strip())
-                except Exception as e:
-                    traceback.print_exc()
-                if replacement is not None:
+                replacement = next(replacements, None)
+                if replacement is not None and not shown:
                     line = replacement
-            prn.append(line)
-        self.pipeToSocketW.write('\n'.join(prn).encode(self.mud_encoding))
-        self.pipeToSocketW.flush()
+            prn.append(line[shown:] + '\n')
+
+    # The MUD went quiet after an unterminated line
+    def handle_prompt(self):
+        self.promptHandle = None
+        partial = self.parser.takePartial()
+        shown, self.partialShown = self.partialShown, 0
+        text = self.prompt(partial, shown)
+        if text:
+            self.proxy.write(text.encode(self.mud_encoding))
+
+    # Fires triggers on a prompt, returns what the frontend has yet to see of it
+    def prompt(self, partial, shown):
+        self.outgoing.ack()
+        if not partial:
+            return ''
+        line = self.decode(partial)
+        start = time.perf_counter()
+        try:
+            self.world.trigger(line.strip())
+        except Exception as e:
+            traceback.print_exc()
+        self.stats.record('prompt triggers', time.perf_counter() - start)
+        return line[shown:]
 
 
     def show(self, line):
-        self.pipeToSocketW.write(line.encode(self.client_encoding))
-        self.pipeToSocketW.flush()
+        self.proxy.write(line.encode(self.client_encoding))
 
 
-    def handle_from_pipe(self):
-        data = b''  # to handle partial lines
-        try:
-            data += os.read(self.socketToPipeR, 4096)
-            lines = data.split(b'\n')
-            if lines[-1] != '':  # received partial line, don't process
-                data = lines[-1]
-            else:
-                data = b''
-            lines = lines[:-1]  # chop off either the last empty line, or the partial line
-
-            for line in lines:
-                line = line.decode(self.client_encoding)
-                if line[-1] == '\r':
-                    line = line[:-1]
-                self.handle_output_line(line)
-        except EOFError:
-            self.log("EOF in pipe")
-            self.stopFlag.set()
-            self.world.quit()
-            raise
+    # A whole line typed in the primary frontend
+    def handle_from_frontend(self, line):
+        if self.recorder:
+            self.recorder.record(recording.INPUT, line)
+        line = line.decode(self.client_encoding, 'replace')
+        if line.endswith('\r'):
+            line = line[:-1]
+        self.handle_output_line(line)
 
 
     def handle_output_line(self, data):
@@ -188,8 +284,35 @@ class Session(object):
             except Exception:
                 traceback.print_exc()
             return
+        elif data == '#mccp':
+            self.log("MCCP2 {}: {} bytes on the wire, {} bytes decoded ({:.1f}x)".format(
+                'active' if self.parser.compressed() else 'inactive',
+                self.parser.wireBytes,
+                self.parser.decodedBytes,
+                self.parser.decodedBytes / max(self.parser.wireBytes, 1)))
+            return
+        elif data == '#stats' or data == '#stats reset':
+            if data == '#stats reset':
+                self.stats.reset()
+            self.log("{}\ntelnet: {} bytes on the wire, {} decoded; {} commands sent in {} writes".format(
+                self.stats.report(), self.parser.wireBytes, self.parser.decodedBytes,
+                self.outgoing.commands, self.outgoing.writes))
+            return
+        elif data == '#clients':
+            for client in self.proxy.clients:
+                self.log("{} {}: {} bytes behind{}, joined at output byte {} of {}".format(
+                    client.role, client.addr, client.queued, ', spilling' if client.backlog is not None else '',
+                    client.cursor, self.proxy.output))
+            return
+        elif data == '#queue' or data == '#queue clear':
+            if data == '#queue clear':
+                self.log("Dropped {} paced commands".format(self.outgoing.clear()))
+            self.log("{} paced commands queued, {} in flight; {} commands sent in {} writes".format(
+                len(self.outgoing.paced), self.outgoing.inFlight, self.outgoing.commands, self.outgoing.writes))
+            return
         else:
             handled = False
+            start = time.perf_counter()
             try:
                 handled = self.world.alias(data)
             except Exception as e:
@@ -197,35 +320,41 @@ class Session(object):
             else:
                 if not handled:
                     self.send(data)
+            self.stats.record('alias', time.perf_counter() - start)
 
 
+    def handle_exception(self, loop, context):
+        self.log("Exception in run():", context.get('exception', context['message']))
+        self.stop()
+
     def run(self):
+        self.loop.set_exception_handler(self.handle_exception)
+        self.loop.add_reader(self.telnet, self.handle_from_telnet)
         try:
-            while True:
-                fds, _, _ = select([self.telnet.get_socket(), self.socketToPipeR], [], [])
-                for fd in fds:
-                    if fd == self.telnet.get_socket():
-                        self.handle_from_telnet()
-                    elif fd == self.socketToPipeR:
-                        self.handle_from_pipe()
-        except Exception as e:
-            self.log("Exception in run():", e)
+            self.loop.run_forever()
         finally:
             self.log("Closing")
+            self.loop.remove_reader(self.telnet)
             self.telnet.close()
 
 
 def main():
-    if len(sys.argv) < 3 or len(sys.argv) > 4:
-        print("Usage: {} worldmodule (without .py) port [arg]".format(sys.argv[0]))
+    args = sys.argv[1:]
+    record = None
+    if '--record' in args[:-1]:
+        idx = args.index('--record')
+        record = args[idx + 1]
+        del args[idx:idx + 2]
+    if len(args) < 2 or len(args) > 3:
+        print("Usage: {} [--record file] worldmodule (without .py) port [arg]".format(sys.argv[0]))
         exit(1)
 
-    world_module = importlib.import_module(sys.argv[1])
-    port = int(sys.argv[2])
-    arg = sys.argv[3] if len(sys.argv) == 4 else None
-    ses = Session(world_module, port, arg)
+    world_module = importlib.import_module(args[0])
+    port = int(args[1])
+    arg = args[2] if len(args) == 3 else None
+    ses = Session(world_module, port, arg, record)
     ses.run()
 
 
-assert(__name__ == '__main__')
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import gzip
+import struct
+import time
+
+INBOUND, OUTBOUND, INPUT = range(3)  # bytes from the MUD, bytes to the MUD, a line typed in the frontend
+EVENT = struct.Struct('<dBI')  # seconds since the recording started, kind, length of the data that follows
+
+
+# Writes a session's raw traffic to a gzipped file, stamped with monotonic time
+class Recorder(object):
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wb', compresslevel=6)
+        self.start = time.monotonic()
+
+    def record(self, kind, data):
+        self.file.write(EVENT.pack(time.monotonic() - self.start, kind, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+# Yields (seconds, kind, data) for the events of a recording. A recording cut short by a crash ends early.
+def read(path):
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                header = f.read(EVENT.size)
+                if len(header) < EVENT.size:
+                    return
+                seconds, kind, length = EVENT.unpack(header)
+                data = f.read(length)
+            except EOFError:
+                return
+            if len(data) < length:
+                return
+            yield seconds, kind, data
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import importlib
+import pycat
+import recording
+import sys
+import time
+
+GRACE = 0.5  # seconds to let timers and paced commands run after the last recorded event
+
+
+# Stands in for the MUD socket, keeping what the session writes
+class Sink(object):
+    def __init__(self):
+        self.sent = bytearray()
+        self.writes = 0
+
+    def sendall(self, data):
+        self.sent += data
+        self.writes += 1
+
+    def close(self):
+        pass
+
+
+# Feeds a recording (see pycat --record) to a world, without the network. The chunks arrive just as they were
+# read from the MUD, either at the original pace or as fast as the session can take them. Frontends can still
+# connect to watch.
+class ReplaySession(pycat.Session):
+    def __init__(self, world_module, path, arg, port=0, fast=False):
+        self.events = list(recording.read(path))
+        self.fast = fast
+        super().__init__(world_module, port, arg)
+
+    def connect(self, host, port):
+        return Sink()
+
+    def run(self):
+        self.loop.set_exception_handler(self.handle_exception)
+        self.started = time.monotonic()
+        self.lines = 0
+        if self.fast:
+            self.loop.call_soon(self.fastReplay, 0, 0.0)
+        else:
+            start = self.loop.time()
+            for seconds, kind, data in self.events:
+                self.loop.call_at(start + seconds, self.replayEvent, kind, data)
+            self.loop.call_at(start + (self.events[-1][0] if self.events else 0) + GRACE, self.finish)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.log("Closing")
+
+    def replayEvent(self, kind, data):
+        if kind == recording.INBOUND:
+            self.recvBuffer[:len(data)] = data
+            before = self.stats.counters['lines in']
+            self.handle_received(len(data), time.perf_counter())
+            self.lines += self.stats.counters['lines in'] - before
+        elif kind == recording.INPUT:
+            self.handle_output_line(data.decode(self.client_encoding, 'replace').rstrip('\r'))
+
+    def fastReplay(self, idx, last):
+        if idx >= len(self.events):
+            self.loop.call_later(GRACE, self.finish)
+            return
+        seconds, kind, data = self.events[idx]
+        # the MUD went quiet here, so the prompt timer would have fired
+        if self.promptHandle and seconds - last >= pycat.PROMPT_DELAY:
+            self.promptHandle.cancel()
+            self.handle_prompt()
+        self.replayEvent(kind, data)
+        self.loop.call_soon(self.fastReplay, idx + 1, seconds)
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        inbound = sum(len(data) for seconds, kind, data in self.events if kind == recording.INBOUND)
+        expected = b''.join(data for seconds, kind, data in self.events if kind == recording.OUTBOUND)
+        print(self.stats.report())
+        print("{} bytes, {} lines in {:.3f} s: {:.0f} lines/s, {:.0f} KB/s".format(
+            inbound, self.lines, elapsed, self.lines / max(elapsed, 1e-9), inbound / 1024 / max(elapsed, 1e-9)))
+        print(describeDivergence(expected, bytes(self.telnet.sent)))
+        self.stop()
+
+
+# Compares what was sent to the MUD in the recording with what was sent on replay
+def describeDivergence(expected, actual):
+    if expected == actual:
+        return "Sent the same {} bytes as the recording".format(len(actual))
+    at = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+    return "Sent {} bytes, the recording {}; they differ from byte {}: recorded {!r}, replayed {!r}".format(
+        len(actual), len(expected), at, expected[at:at + 40], actual[at:at + 40])
+
+
+def main():
+    args = sys.argv[1:]
+    fast = '--fast' in args
+    if fast:
+        args.remove('--fast')
+    port = 0
+    if '--port' in args[:-1]:
+        idx = args.index('--port')
+        port = int(args[idx + 1])
+        del args[idx:idx + 2]
+    if len(args) < 2 or len(args) > 3:
+        print("Usage: {} [--fast] [--port port] worldmodule (without .py) recording [arg]".format(sys.argv[0]))
+        exit(1)
+
+    world_module = importlib.import_module(args[0])
+    # the world logs under its arg, so keep the real logs out of it
+    arg = args[2] if len(args) == 3 else 'replay'
+    ses = ReplaySession(world_module, args[1], arg, port, fast)
+    ses.run()
+
+
+if __name__ == '__main__':
+    main()
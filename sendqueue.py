@@ -0,0 +1,92 @@
+import collections
+
+
+# Outgoing side of the MUD connection. Everything sent during one loop iteration goes out in a single write.
+# Paced commands additionally wait for the MUD to catch up: no more than maxInFlight commands without a prompt
+# back, and at least minSpacing seconds apart. Only paced commands count as in flight, so plain sends never hold
+# them up. pacing() returns (maxInFlight, minSpacing, ackTimeout); it's asked anew every time, so the world can
+# change its policy on the fly. If no prompt arrives within ackTimeout seconds, the commands in flight are written
+# off.
+class SendQueue(object):
+    def __init__(self, loop, write, pacing):
+        self.loop = loop
+        self.write = write
+        self.pacing = pacing
+        self.buffer = bytearray()
+        self.flushHandle = None
+        self.paced = collections.deque()  # (data, number of commands)
+        self.inFlight = 0  # paced commands sent without a prompt back yet
+        self.lastPaced = None
+        self.pumpHandle = None
+        self.ackHandle = None
+        self.commands = 0
+        self.writes = 0
+
+    # Queues data for the next write. commands is how many MUD commands it holds, ie. how many prompts to expect.
+    def send(self, data, commands=1):
+        self.buffer += data
+        if self.flushHandle is None:
+            self.flushHandle = self.loop.call_soon(self.flush)
+        self.commands += commands
+
+    def sendPaced(self, data, commands=1):
+        self.paced.append((data, commands))
+        self.pump()
+
+    def flush(self):
+        self.flushHandle = None
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            self.writes += 1
+            self.write(data)
+
+    # The MUD sent a prompt, so it has dealt with a command
+    def ack(self):
+        if self.inFlight:
+            self.inFlight -= 1
+        if not self.inFlight and self.ackHandle:
+            self.ackHandle.cancel()
+            self.ackHandle = None
+        self.pump()
+
+    def ackTimeout(self):
+        self.ackHandle = None
+        self.inFlight = 0
+        self.pump()
+
+    def pump(self):
+        if self.pumpHandle:
+            self.pumpHandle.cancel()
+            self.pumpHandle = None
+        maxInFlight, minSpacing, ackTimeout = self.pacing()
+        while self.paced and self.inFlight < maxInFlight:
+            now = self.loop.time()
+            if self.lastPaced is not None and now < self.lastPaced + minSpacing:
+                self.pumpHandle = self.loop.call_at(self.lastPaced + minSpacing, self.pump)
+                return
+            data, commands = self.paced.popleft()
+            self.lastPaced = now
+            self.send(data, commands)
+            self.inFlight += commands
+            if self.ackHandle:
+                self.ackHandle.cancel()
+            self.ackHandle = self.loop.call_later(ackTimeout, self.ackTimeout)
+
+    # Drops the paced commands not sent yet, returns how many there were
+    def clear(self):
+        dropped = len(self.paced)
+        self.paced.clear()
+        return dropped
+
+    def close(self):
+        try:
+            self.flush()
+        except OSError:  # the MUD already hung up
+            pass
+        for handle in (self.flushHandle, self.pumpHandle, self.ackHandle):
+            if handle:
+                handle.cancel()
+        self.flushHandle = self.pumpHandle = self.ackHandle = None
+        self.buffer.clear()
+        self.paced.clear()
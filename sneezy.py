@@ -182,8 +182,11 @@ class Sneezy(modular.ModularClient):
 
         self.aliases.update(ALIASES)
         self.triggers.update(TRIGGERS)
-        with open('passwords_sneezy.json', 'rb') as pws:
-            self.triggers.update(json.load(pws))
+        try:
+            with open('passwords_sneezy.json', 'rb') as pws:
+                self.triggers.update(json.load(pws))
+        except FileNotFoundError:
+            print("No passwords_sneezy.json, won't log in by itself")
         self.triggers["Type 'C' to connect with an existing character, or <enter> to see account menu."] = 'c\n' + name
         self.aliases['#autohone ([^,]+), (.+)'] = lambda mud, groups: self.startAutoHone(groups[0], groups[1])
         self.aliases['#killify'] = self.killify
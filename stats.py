@@ -0,0 +1,83 @@
+import collections
+import time
+
+SUB_BUCKET_BITS = 7  # values are kept to 1/64 precision
+
+
+# Latency histogram in the style of HdrHistogram: linear buckets for the first 128 microseconds, then 64 buckets for
+# every power of two. Recording is a couple of integer operations and a list increment.
+class Histogram(object):
+    def __init__(self):
+        self.counts = []
+        self.total = 0
+        self.seconds = 0.0
+        self.max = 0.0
+
+    def record(self, seconds, count=1):
+        us = int(seconds * 1e6)
+        if us < (1 << SUB_BUCKET_BITS):
+            idx = us
+        else:
+            shift = us.bit_length() - SUB_BUCKET_BITS
+            idx = (shift << (SUB_BUCKET_BITS - 1)) + (us >> shift)
+        if idx >= len(self.counts):
+            self.counts.extend([0] * (idx + 1 - len(self.counts)))
+        self.counts[idx] += count
+        self.total += count
+        self.seconds += seconds * count
+        if seconds > self.max:
+            self.max = seconds
+
+    # The highest value (in seconds) of the bucket holding the given fraction of the values
+    def percentile(self, fraction):
+        if not self.total:
+            return 0.0
+        wanted = fraction * self.total
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bucketTop(idx) / 1e6, self.max)
+        return self.max
+
+
+def bucketTop(idx):
+    half = 1 << (SUB_BUCKET_BITS - 1)
+    if idx < 2 * half:
+        return idx
+    shift = idx // half - 1
+    top = idx - shift * half
+    return ((top + 1) << shift) - 1
+
+
+# Named latency histograms and counters, for #stats
+class Stats(object):
+    def __init__(self):
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.since = time.monotonic()
+
+    def record(self, name, seconds, count=1):
+        self.histograms[name].record(seconds, count)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+        self.since = time.monotonic()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.since, 1e-9)
+        out = ["{:<20} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+            'stage', 'count', 'p50 us', 'p90 us', 'p99 us', 'max us', 'total ms')]
+        for name, h in sorted(self.histograms.items()):
+            out.append("{:<20} {:>9} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.0f} {:>10.1f}".format(
+                name, h.total, h.percentile(0.5) * 1e6, h.percentile(0.9) * 1e6, h.percentile(0.99) * 1e6,
+                h.max * 1e6, h.seconds * 1000))
+        out.append("{:<20} {:>9} {:>9}".format('counter', 'total', 'per s'))
+        for name, n in sorted(self.counters.items()):
+            out.append("{:<20} {:>9} {:>9.1f}".format(name, n, n / elapsed))
+        out.append("over {:.0f} s".format(elapsed))
+        return '\n'.join(out)
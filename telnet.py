@@ -0,0 +1,163 @@
+import zlib
+
+IAC = b'\xff'
+DONT = b'\xfe'
+DO = b'\xfd'
+WONT = b'\xfc'
+WILL = b'\xfb'
+SB = b'\xfa'
+GA = b'\xf9'
+NOP = b'\xf1'
+SE = b'\xf0'
+EOR = b'\xef'
+
+BINARY = b'\x00'
+TTYPE = b'\x18'
+COMPRESS2 = b'\x56'  # MCCP2
+GMCP = b'\xc9'
+
+_IAC = IAC[0]
+_NEGOTIATION = frozenset([DONT[0], DO[0], WONT[0], WILL[0]])
+
+# parser states
+_DATA, _IAC_SEEN, _OPTION, _SB_DATA, _SB_IAC = range(5)
+
+
+def escape(data):
+    return data.replace(IAC, IAC + IAC)
+
+
+class TelnetParser(object):
+    # Incremental telnet protocol parser. Feed it whatever recv() returned, it keeps its state (half-read IAC
+    # sequences, subnegotiations, partial lines) across calls.
+    #   onCommand(cmd, option) is called for IAC commands; option is None except for WILL/WONT/DO/DONT
+    #   onSubnegotiation(data) is called with the payload of IAC SB ... IAC SE
+    # An MCCP2 start (IAC SB COMPRESS2 IAC SE) switches the rest of the stream to zlib until the compressed
+    # stream ends.
+    def __init__(self, onCommand, onSubnegotiation):
+        self.onCommand = onCommand
+        self.onSubnegotiation = onSubnegotiation
+        self.state = _DATA
+        self.cmd = None
+        self.sb = bytearray()
+        self.text = bytearray()  # cooked data not yet returned as a complete line
+        self.decompressor = None
+        self.wireBytes = 0  # as received from the socket
+        self.decodedBytes = 0  # after decompression
+
+    # Returns the complete lines (without the '\n') found so far. Whatever follows the last newline stays in
+    # self.text until the rest of the line arrives, or until someone calls takePartial() for a prompt.
+    def feed(self, buf, end=None):
+        if end is None:
+            end = len(buf)
+        self.wireBytes += end
+        pos = 0
+        while pos < end:
+            if self.decompressor is None:
+                pos = self.parse(buf, pos, end)
+                continue
+            decompressor = self.decompressor
+            with memoryview(buf) as view:
+                out = decompressor.decompress(view[pos:end])
+            self.parse(out, 0, len(out))
+            if not decompressor.eof:
+                break
+            # the server ended compression, the rest is plain telnet again
+            self.decompressor = None
+            buf = decompressor.unused_data
+            pos, end = 0, len(buf)
+        return self.takeLines()
+
+    # Takes the complete lines, leaving what follows the last newline. Called for GA/EOR in the middle of feed(), it
+    # takes the lines before the prompt, so they can be handled before it.
+    def takeLines(self):
+        idx = self.text.rfind(b'\n')
+        if idx == -1:
+            return []
+        lines = bytes(self.text[:idx]).split(b'\n')
+        del self.text[:idx + 1]
+        return lines
+
+    def compressed(self):
+        return self.decompressor is not None
+
+    # Parses buf[pos:end], returns where it stopped: either end, or right after the start of a compressed stream
+    def parse(self, buf, pos, end):
+        start = pos
+        view = memoryview(buf)
+        while pos < end:
+            state = self.state
+            if state == _DATA:
+                idx = buf.find(IAC, pos, end)
+                if idx == -1:
+                    self.cook(view[pos:end])
+                    pos = end
+                    break
+                if idx > pos:
+                    self.cook(view[pos:idx])
+                self.state = _IAC_SEEN
+                pos = idx + 1
+            elif state == _IAC_SEEN:
+                c = buf[pos]
+                pos += 1
+                if c == _IAC:
+                    self.text.append(_IAC)
+                    self.state = _DATA
+                elif c in _NEGOTIATION:
+                    self.cmd = bytes([c])
+                    self.state = _OPTION
+                elif c == SB[0]:
+                    self.sb.clear()
+                    self.state = _SB_DATA
+                else:
+                    self.state = _DATA
+                    self.onCommand(bytes([c]), None)
+            elif state == _OPTION:
+                option = bytes([buf[pos]])
+                pos += 1
+                self.state = _DATA
+                self.onCommand(self.cmd, option)
+            elif state == _SB_DATA:
+                idx = buf.find(IAC, pos, end)
+                if idx == -1:
+                    self.sb += view[pos:end]
+                    pos = end
+                    break
+                self.sb += view[pos:idx]
+                self.state = _SB_IAC
+                pos = idx + 1
+            elif state == _SB_IAC:
+                c = buf[pos]
+                pos += 1
+                if c == _IAC:
+                    self.sb.append(_IAC)
+                    self.state = _SB_DATA
+                elif c == SE[0]:
+                    self.state = _DATA
+                    sb = bytes(self.sb)
+                    self.sb.clear()
+                    if sb == COMPRESS2:
+                        self.decompressor = zlib.decompressobj()
+                        break
+                    self.onSubnegotiation(sb)
+                else:  # broken subnegotiation, resync on data
+                    self.state = _DATA
+        view.release()
+        self.decodedBytes += pos - start
+        return pos
+
+    def cook(self, chunk):
+        start = len(self.text)
+        self.text += chunk
+        if b'\x00' in self.text[start:]:  # CR NUL
+            self.text[start:] = self.text[start:].replace(b'\x00', b'')
+
+    def partial(self):
+        return bytes(self.text)
+
+    # Takes what follows the last newline, leaving the complete lines before it for feed() or takeLines()
+    def takePartial(self):
+        idx = self.text.rfind(b'\n') + 1
+        out = bytes(self.text[idx:])
+        del self.text[idx:]
+        return out
@@ -1,5 +1,71 @@
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import socket
+import tempfile
+import types
 import unittest
+import matcher
 import modular
+import mudserver
+import proxy
+import pycat
+import re
+import recording
+import replay
+import sendqueue
+import stats
+import telnet
+import time
+import zlib
+from modules import logsearch
+from modules import logwriter
+from modules import mapper
+from modules.basemodule import BaseModule
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.stats = stats.Stats()
+        self.sent = []
+        self.logged = []
+
+    def send(self, line):
+        self.sent.append(line)
+
+    def log(self, *args):
+        self.logged.append(args)
+
+    def strip_ansi(self, line):
+        return line
+
+
+class Recorder(BaseModule):
+    def __init__(self, mud, seen):
+        super().__init__(mud)
+        self.seen = seen
+
+    def alias(self, line):
+        self.seen.append(line)
+
+
+class Owner(BaseModule):
+    def getCommands(self):
+        return {'#own': self.own}
+
+    def own(self, line):
+        return line.startswith('#own ')
+
+
+def makeClient(modules):
+    class Client(modular.ModularClient):
+        def __init__(self, mud):
+            self.modules = modules
+            super().__init__(mud)
+    return Client(FakeSession())
 
 
 class TestStack(unittest.TestCase):
@@ -8,6 +74,817 @@ class TestStack(unittest.TestCase):
         self.assertEqual(modular.stack('a;b;c'), ['a', 'b', 'c'])
         self.assertEqual(modular.stack('a;;b;c'), ['a;b', 'c'])
         self.assertEqual(modular.stack('a;;;b;c'), ['a;;b', 'c'])
+        self.assertEqual(modular.stack(';a;'), [';a;'])
+
+
+class TestAlias(unittest.TestCase):
+    def test_routing(self):
+        before, after = [], []
+        client = makeClient({'before': Recorder(None, before), 'owner': Owner(None), 'after': Recorder(None, after)})
+        client.aliases.update({'^sc$': 'score', 'k (.+)': lambda world, groups: 'kill ' + groups[0]})
+        self.assertTrue(client.alias('#own thing'))
+        self.assertFalse(client.alias('#own'))
+        self.assertTrue(client.alias('sc;k orc;#2 sc'))
+        self.assertFalse(client.alias('look'))
+        self.assertEqual(before, ['#own thing', '#own', 'look'])
+        self.assertEqual(after, ['#own', 'look'])
+        self.assertEqual(client.mud.sent, ['score', 'kill orc', 'score', 'score'])
+        self.assertEqual([(hook.module, hook.calls) for hook in client.hooks['alias']], [('before', 3), ('after', 2)])
+        self.assertTrue(client.alias('#hooks'))
+        client.quit()
+
+
+class TestTelnetParser(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        self.subnegotiations = []
+        self.parser = telnet.TelnetParser(lambda cmd, opt: self.commands.append((cmd, opt)), self.subnegotiations.append)
+
+    def test_partial_lines(self):
+        self.assertEqual(self.parser.feed(b'hello wor'), [])
+        self.assertEqual(self.parser.partial(), b'hello wor')
+        self.assertEqual(self.parser.feed(b'ld\r\nsecond\nprompt> '), [b'hello world\r', b'second'])
+        self.assertEqual(self.parser.takePartial(), b'prompt> ')
+        self.assertEqual(self.parser.partial(), b'')
+
+    def test_prompt_mid_chunk(self):
+        prompts = []
+        parser = telnet.TelnetParser(lambda cmd, opt: prompts.append(parser.takePartial()), None)
+        self.assertEqual(parser.feed(b'a\r\nb\r\nprompt\xff\xf9'), [b'a\r', b'b\r'])
+        self.assertEqual(parser.feed(b'one\r\ntwo> \xff\xf9three\n'), [b'one\r', b'three'])
+        self.assertEqual(prompts, [b'prompt', b'two> '])
+
+    def test_split_iac(self):
+        self.assertEqual(self.parser.feed(b'a\xff'), [])
+        self.assertEqual(self.parser.feed(b'\xfb'), [])
+        self.assertEqual(self.parser.feed(b'\xc9b\xff\xff\n'), [b'ab\xff'])
+        self.assertEqual(self.commands, [(telnet.WILL, telnet.GMCP)])
+
+    def test_subnegotiation(self):
+        buf = bytearray(b'x\xff\xfa\xc9room.info {}\xff\xf0y\xff\xf9\n')
+        self.assertEqual(self.parser.feed(buf[:8]), [])
+        self.assertEqual(self.parser.feed(buf[8:]), [b'xy'])
+        self.assertEqual(self.subnegotiations, [b'\xc9room.info {}'])
+        self.assertEqual(self.commands, [(telnet.GA, None)])
+
+    def test_mccp2(self):
+        compressor = zlib.compressobj()
+        stream = compressor.compress(b'zipped\n\xff\xfa\xc9char.vitals {}\xff\xf0more') + compressor.flush()
+        data = b'plain\n\xff\xfa\x56\xff\xf0' + stream + b'after\n'
+        self.assertEqual(self.parser.feed(data[:12]), [b'plain'])
+        self.assertTrue(self.parser.compressed())
+        self.assertEqual(self.parser.feed(data[12:]), [b'zipped', b'moreafter'])
+        self.assertFalse(self.parser.compressed())
+        self.assertEqual(self.subnegotiations, [b'\xc9char.vitals {}'])
+        self.assertEqual(self.parser.wireBytes, len(data))
+        self.assertEqual(self.parser.decodedBytes, 11 + 30 + 6)
+
+
+class TestTimers(unittest.TestCase):
+    def test_schedule(self):
+        client = makeClient({})
+        loop = client.mud.loop
+        fired = []
+        client.timers['late'] = client.mkdelay(0.06, lambda world: fired.append('late'))
+        client.timers['early'] = client.mkdelay(0.02, lambda world: fired.append('early'))
+        client.timers['cancelled'] = client.mkdelay(0.03, lambda world: fired.append('cancelled'))
+        client.timers['moved'] = client.mkdelay(0.03, lambda world: fired.append('moved'))
+        client.timers['tick'] = client.mktimernow(0.04, lambda world: fired.append('tick'))
+        del client.timers['cancelled']
+        client.setTimerRemaining('moved', 0.09)
+        loop.call_later(0.1, lambda: client.timers.pop('tick'))
+        loop.call_later(0.13, loop.stop)
+        loop.run_forever()
+        self.assertEqual(fired, ['tick', 'early', 'tick', 'late', 'tick', 'moved'])
+        self.assertEqual(set(client.timers), set())
+        self.assertIsNone(client.timer_handle)
+        client.quit()
+
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.written = []
+        self.policy = (1, 0, 5)
+        self.queue = sendqueue.SendQueue(self.loop, self.written.append, lambda: self.policy)
+
+    def tearDown(self):
+        self.queue.close()
+        self.loop.close()
+
+    def spin(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def test_coalesce(self):
+        for i in range(50):
+            self.queue.send(b'kick\n')
+        self.assertEqual(self.written, [])
+        self.spin()
+        self.assertEqual(self.written, [b'kick\n' * 50])
+        self.assertEqual((self.queue.commands, self.queue.inFlight), (50, 0))
+        # plain sends don't hold up paced ones
+        self.queue.sendPaced(b'look\n')
+        self.spin()
+        self.assertEqual(self.written[1:], [b'look\n'])
+        self.assertEqual(self.queue.inFlight, 1)
+
+    def test_paced(self):
+        self.policy = (2, 0, 5)
+        for cmd in (b'a\n', b'b\n', b'c\n', b'd\n'):
+            self.queue.sendPaced(cmd)
+        self.spin()
+        self.assertEqual(self.written, [b'a\nb\n'])
+        self.queue.ack()
+        self.spin()
+        self.assertEqual(self.written, [b'a\nb\n', b'c\n'])
+        self.assertEqual(self.queue.clear(), 1)
+
+    def test_spacing_and_timeout(self):
+        self.policy = (1, 0.03, 0.01)
+        self.queue.sendPaced(b'a\n')
+        self.queue.sendPaced(b'b\n')
+        self.loop.call_later(0.02, lambda: self.written.append('timeout'))
+        self.loop.call_later(0.05, self.loop.stop)
+        self.loop.run_forever()
+        # b is written off after 0.01s, but still has to wait for the spacing
+        self.assertEqual(self.written, [b'a\n', 'timeout', b'b\n'])
+
+    def test_close(self):
+        self.queue.send(b'quit\n')
+        self.queue.close()
+        self.assertEqual(self.written, [b'quit\n'])
+
+
+class TestLogWriter(unittest.TestCase):
+    def test_batches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain = os.path.join(tmp, 'plain.log')
+            compressed = os.path.join(tmp, 'compressed.log.gz')
+            writer = logwriter.acquire()
+            self.assertIs(logwriter.acquire(), writer)
+            writer.open(plain, open(plain, 'ab'))
+            writer.open(compressed, gzip.open(compressed, 'ab'))
+            for i in range(1000):
+                writer.write(plain, 'line {}\n'.format(i))
+                writer.write(compressed, 'line {}\n'.format(i))
+            writer.flush()
+            self.assertEqual(writer.depth(), (0, 0))
+            self.assertLess(writer.commits, 10)
+            with open(plain) as f:
+                self.assertEqual(len(f.readlines()), 1000)
+            writer.write(compressed, 'last\n')
+            writer.close(plain)
+            logwriter.release()
+            logwriter.release()
+            self.assertIsNone(logwriter.writer)
+            with gzip.open(compressed, 'rt') as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 1001)
+            self.assertEqual(lines[-1], 'last\n')
+
+
+class TestLogSearch(unittest.TestCase):
+    def setUp(self):
+        self.blockSize = logsearch.BLOCK_SIZE
+        logsearch.BLOCK_SIZE = 1024
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmp.name, 'test.log')
+
+    def tearDown(self):
+        logsearch.BLOCK_SIZE = self.blockSize
+        self.tmp.cleanup()
+
+    def test_search(self):
+        with open(self.log, 'w') as f:  # history from before there was an index
+            for i in range(500):
+                f.write('old line {}\n'.format(i))
+        writer = logwriter.acquire()
+        writer.open(self.log, open(self.log, 'ab'), logsearch.BlockIndexer(self.log))
+        for i in range(500):
+            writer.write(self.log, 'The orc hits you. ({})\n'.format(i))
+        writer.write(self.log, 'You are thirsty.\n')
+        writer.flush()
+
+        search = logsearch.LogSearch(self.log)
+        self.assertEqual(search.search('thirsty'), ['You are thirsty.'])
+        self.assertLess(search.blocksRead, 3)
+        self.assertEqual(search.search(r'old line 4\d\d$', limit=3), ['old line 497', 'old line 498', 'old line 499'])
+        self.assertEqual(len(search.search(r'\(\d+\)', limit=0)), 0)
+        self.assertEqual(len(search.search('line 1', limit=1000)), 111)
+        self.assertEqual(search.search('old line 7$', since=logsearch.parseTime('1h')), [])
+        self.assertEqual(search.search('hits you. .499', until=logsearch.parseTime('1h')), [])
+
+        writer.close(self.log)
+        logwriter.release()
+        # a fresh index matches the one built along the way
+        with open(self.log + '.idx', 'rb') as f:
+            built = f.read()
+        os.remove(self.log + '.idx')
+        indexer = logsearch.BlockIndexer(self.log)
+        indexer.open()
+        indexer.close()
+        index = logsearch.BlockIndex(self.log + '.idx')
+        index.load()
+        self.assertEqual(index.end(), os.path.getsize(self.log))
+        self.assertEqual(index.lines(), 1001)
+        self.assertLessEqual(len(built), os.path.getsize(self.log) // 2)
+
+    def test_time_range(self):
+        indexer = logsearch.BlockIndexer(self.log)
+        indexer.open()
+        with open(self.log, 'ab') as f:
+            for i in range(10):  # one block, written over ten seconds
+                data = 'tick {}\n'.format(i).encode()
+                f.write(data)
+                indexer.add(data, 1000 + i)
+        indexer.close()
+        search = logsearch.LogSearch(self.log)
+        self.assertEqual(search.search('tick', since=1003, until=1005), ['tick 3', 'tick 4', 'tick 5'])
+        self.assertEqual(search.search('tick', since=1008), ['tick 8', 'tick 9'])
+        self.assertEqual(search.search('tick', until=999.5), [])
+        self.assertEqual(search.blocksRead, 0)
+
+    def test_gzip(self):
+        log = self.log + '.gz'
+        with gzip.open(log, 'at') as f:  # the old format, one stream
+            for i in range(300):
+                f.write('old line {}\n'.format(i))
+        writer = logwriter.acquire()
+        writer.open(log, logsearch.BlockGzipLog(log))
+        for i in range(300):
+            writer.write(log, 'The orc hits you. ({})\n'.format(i))
+            if i % 40 == 39:  # blocks are cut between commits
+                writer.flush()
+        writer.write(log, 'You are thirsty.\n')
+        writer.flush()
+
+        search = logsearch.GzipLogSearch(log)
+        self.assertEqual(search.search('thirsty'), ['You are thirsty.'])
+        self.assertEqual(search.search('hits you. .29[89]'), ['The orc hits you. (298)', 'The orc hits you. (299)'])
+        self.assertEqual(search.search('old line 299'), ['old line 299'])
+        self.assertGreater(len(search.index.blocks), 3)
+        self.assertLess(search.blocksRead, 3)
+
+        # what a crash would leave behind: the last member isn't finished
+        crashed = self.log + '.crashed.gz'
+        shutil.copy(log, crashed)
+        shutil.copy(log + '.idx', crashed + '.idx')
+        writer.close(log)
+        logwriter.release()
+        recovered = logsearch.BlockGzipLog(crashed)
+        recovered.open()
+        recovered.close()
+        for path in (log, crashed):
+            with gzip.open(path, 'rt') as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 601)
+            self.assertEqual(lines[-1], 'You are thirsty.\n')
+            self.assertEqual(logsearch.GzipLogSearch(path).search('thirsty'), ['You are thirsty.'])
+
+    def test_query(self):
+        pattern, since, until, limit = logsearch.parseQuery('-n 5 -s 2h -u "2024-05-01 18:30" You are')
+        self.assertEqual((pattern, limit), ('You are', 5))
+        self.assertAlmostEqual(since, logsearch.parseTime('120m'), delta=1)
+        self.assertEqual(until, logsearch.parseTime('2024-05-01 18:30'))
+        self.assertRaises(ValueError, logsearch.parseQuery, '-n 0 You are')
+        self.assertEqual(logsearch.grep(None, '-n 0 You are'), 'grep: -n needs a limit of at least 1')
+
+
+class TestFrontendBuffer(unittest.TestCase):
+    def setUp(self):
+        self.segmentSize = proxy.SEGMENT_SIZE
+        proxy.SEGMENT_SIZE = 1000
+
+    def tearDown(self):
+        proxy.SEGMENT_SIZE = self.segmentSize
+
+    def test_spill(self):
+        buf = proxy.FrontendBuffer(memoryLimit=1000, diskLimit=3000)
+        for i in range(1000):
+            buf.append('line {}\n'.format(i).encode())
+        self.assertLessEqual(buf.memoryBytes, 1000)
+        self.assertLessEqual(buf.diskBytes, 3000)
+        self.assertEqual(len(buf), 8890)
+        out = buf.replay(100)
+        lines = out.decode().split('\n')
+        self.assertEqual(lines[0], 'line 989')  # starts at a whole line
+        self.assertEqual(lines[10], 'line 999')
+        self.assertTrue(lines[11].startswith('--- Replayed the last 99 of 8890 bytes'))
+        # everything that's left, from disk too
+        lines = buf.replay(10000).decode().split('\n')
+        self.assertLess(int(lines[0].split()[1]), 800)
+        self.assertEqual(lines[-2], '--- Replayed the last {} of 8890 bytes of output ({} lost) ---'.format(
+            8890 - buf.dropped, buf.dropped))
+
+    def test_take(self):
+        buf = proxy.FrontendBuffer(memoryLimit=100, diskLimit=100000)
+        lines = ['line {}\n'.format(i).encode() for i in range(500)]
+        for line in lines[:300]:
+            buf.append(line)
+        # spilled output comes back in pieces, not a whole segment at a time
+        out = buf.take(50)
+        self.assertLess(sum(map(len, out)), 50 + 9)
+        self.assertEqual(buf.segments[0][3], len(out) * proxy.SPILLED.size + sum(map(len, out)))
+        for line in lines[300:]:
+            buf.append(line)
+        while len(buf):
+            out += buf.take(50)
+        self.assertEqual(out, lines)
+        self.assertEqual((buf.diskBytes, buf.memoryBytes, len(buf.segments)), (0, 0, 0))
+
+    def test_since(self):
+        buf = proxy.FrontendBuffer(memoryLimit=10)
+        buf.append(b'old\n')
+        buf.chunks[0] = (0, b'old\n')
+        buf.spill(*buf.chunks.popleft())
+        buf.append(b'new\n')
+        self.assertEqual(buf.replay(since=1).split(b'\n')[0], b'new')
+        self.assertTrue(buf.replay().startswith(b'old\nnew\n'))
+        buf.clear()
+        self.assertEqual(buf.replay(), b'')
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.watermarks = proxy.HIGH_WATERMARK, proxy.LOW_WATERMARK
+        proxy.HIGH_WATERMARK, proxy.LOW_WATERMARK = 16384, 4096
+        self.loop = asyncio.new_event_loop()
+        self.ours, self.theirs = socket.socketpair()
+        self.theirs.setblocking(False)
+        self.lines = [('line %d\n' % i).encode() * 100 for i in range(2000)]
+
+    def tearDown(self):
+        proxy.HIGH_WATERMARK, proxy.LOW_WATERMARK = self.watermarks
+        self.theirs.close()
+        self.loop.close()
+
+    # Sends everything without ever blocking, then reads it all on the other end
+    def transfer(self, policy):
+        client = proxy.Client(self.loop, self.ours, policy)
+        peak = 0
+        for data in self.lines:
+            client.send(data)
+            peak = max(peak, client.queued)
+        self.assertLessEqual(peak, proxy.HIGH_WATERMARK + len(self.lines[0]))
+        received = bytearray()
+
+        def read():
+            try:
+                received.extend(self.theirs.recv(65536))
+            except BlockingIOError:
+                pass
+            if not client.queue and client.backlog is None:
+                self.loop.stop()
+        self.loop.add_reader(self.theirs, read)
+        self.loop.call_later(5, self.loop.stop)
+        self.loop.run_forever()
+        self.loop.remove_reader(self.theirs)
+        while True:
+            try:
+                data = self.theirs.recv(65536)
+            except BlockingIOError:
+                break
+            received.extend(data)
+        client.close()
+        return bytes(received), client
+
+    def test_spill(self):
+        received, client = self.transfer(proxy.SPILL)
+        self.assertEqual(received, b''.join(self.lines))
+
+    def test_coalesce(self):
+        received, client = self.transfer(proxy.COALESCE)
+        self.assertIn(b'--- Skipped', received)
+        self.assertGreater(client.skipped, 0)
+        self.assertTrue(received.endswith(self.lines[-1]))
+        self.assertLess(len(received), len(b''.join(self.lines)))
+
+
+class TestProxy(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.input = []
+        self.proxy = proxy.proxy('::1', 0, self.loop, self.input.append)
+        self.proxy.start()
+        self.port = self.proxy.sock.getsockname()[1]
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.loop.close()
+
+    def spin(self):
+        self.loop.call_later(0.05, self.loop.stop)
+        self.loop.run_forever()
+
+    def connect(self):
+        sock = socket.create_connection(('::1', self.port))
+        sock.settimeout(1)
+        self.spin()
+        return sock
+
+    def test_fanout(self):
+        self.proxy.write(b'while you were away\n')
+        first = self.connect()
+        self.assertEqual(first.recv(4096), b'while you were away\n')
+        second = self.connect()
+        self.assertEqual(second.recv(4096), b'while you were away\n')  # from the recent output
+        self.assertEqual([client.role for client in self.proxy.clients], [proxy.OBSERVER, proxy.PRIMARY])
+        self.assertIn(b'took over input', first.recv(4096))
+
+        self.proxy.write(b'You are thirsty.\n')
+        self.assertEqual(first.recv(4096), b'You are thirsty.\n')
+        self.assertEqual(second.recv(4096), b'You are thirsty.\n')
+
+        first.sendall(b'ignored\n')
+        second.sendall(b'drink wat')
+        self.spin()
+        self.assertIn(b"You're observing", first.recv(4096))
+        self.assertEqual(self.input, [])
+        second.sendall(b'er\n')
+        first.sendall(b'#primary\nsay hi\n')
+        self.spin()
+        self.assertEqual(self.input, [b'drink water', b'say hi'])
+        self.assertIs(self.proxy.primary, self.proxy.clients[0])
+
+        first.close()
+        self.spin()
+        self.assertEqual(len(self.proxy.clients), 1)
+        self.assertIsNone(self.proxy.primary)
+        second.sendall(b'look\n')
+        self.spin()
+        self.assertEqual(self.input[2:], [b'look'])
+        second.close()
+
+
+class TestStats(unittest.TestCase):
+    def test_histogram(self):
+        h = stats.Histogram()
+        for us in range(1, 10001):
+            h.record(us / 1e6)
+        self.assertEqual(h.total, 10000)
+        for fraction in (0.5, 0.9, 0.99):
+            self.assertAlmostEqual(h.percentile(fraction), fraction * 0.01, delta=fraction * 0.01 / 50)
+        self.assertEqual(h.percentile(1), 0.01)
+
+    def test_report(self):
+        client = makeClient({})
+        client.triggers['You are thirsty.'] = 'drink water'
+        client.triggerLines(['You are thirsty.', 'You are hungry.'])
+        self.assertEqual(client.stats.counters['trigger hits'], 1)
+        self.assertEqual(client.stats.histograms['trigger match'].total, 2)
+        self.assertEqual(client.stats.histograms['module hooks'].total, 2)
+        self.assertIn('trigger match', client.stats.report())
+        client.quit()
+
+
+class ReplayWorld(modular.ModularClient):
+    def __init__(self, mud, name):
+        self.modules = {}
+        super().__init__(mud)
+        self.aliases['^sc$'] = 'score'
+        self.triggers[r'^You are thirsty\.$'] = 'drink water'
+        self.triggers['^Exits: north$'] = 'north'
+
+    def getHostPort(self):
+        return 'localhost', 4000
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+        rec = recording.Recorder(self.path)
+        rec.record(recording.INBOUND, b'Hello\r\nYou are thi')
+        rec.record(recording.INBOUND, b'rsty.\r\n' + telnet.IAC + telnet.WILL + telnet.GMCP)
+        rec.record(recording.OUTBOUND, b'drink water\n')
+        rec.record(recording.INPUT, b'sc\r')
+        rec.record(recording.OUTBOUND, b'score\n')
+        rec.record(recording.INBOUND, b'Exits: nor')
+        rec.close()
+        # as if pycat died before closing it
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 4)
+        events = list(recording.read(self.path))
+        self.assertEqual([kind for seconds, kind, data in events], [0, 0, 1, 2, 1, 0])
+
+        ses = replay.ReplaySession(types.SimpleNamespace(getClass=lambda: ReplayWorld), self.path, None, fast=True)
+        ses.run()
+        ses.loop.close()
+        self.assertEqual(ses.lines, 2)
+        sent = bytes(ses.telnet.sent)
+        # the answer to GMCP comes first, then the same commands as in the recording
+        self.assertTrue(sent.startswith(telnet.IAC + telnet.DO + telnet.GMCP))
+        self.assertTrue(sent.endswith(b'drink water\nscore\n'))
+        self.assertIn('differ', replay.describeDivergence(b'drink water\nscore\n', sent))
+        self.assertEqual(replay.describeDivergence(b'look\n', b'look\n'), 'Sent the same 5 bytes as the recording')
+
+
+class TestSession(unittest.TestCase):
+    def test_prompt_mid_chunk(self):
+        triggered = []
+
+        class World(ReplayWorld):
+            def trigger(self, raw):
+                triggered.append(raw)
+                return super().trigger(raw)
+
+            def triggerLines(self, raws):
+                triggered.extend(raws)
+                return super().triggerLines(raws)
+
+        class Session(pycat.Session):
+            def connect(self, host, port):
+                return replay.Sink()
+
+        ses = Session(types.SimpleNamespace(getClass=lambda: World), 0, None)
+        written = []
+        ses.proxy.write = written.append
+        data = b'You hit.\r\n<10hp> \xff\xf9The orc arrives.\r\n'
+        ses.recvBuffer[:len(data)] = data
+        ses.handle_received(len(data), time.perf_counter())
+        self.assertEqual(b''.join(written), b'You hit.\r\n<10hp> The orc arrives.\r\n')
+        ses.stop()
+        ses.loop.close()
+        self.assertEqual(triggered, ['You hit.', '<10hp>', 'The orc arrives.'])
+
+
+class TestMudServer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.map')
+        with open(self.path, 'w') as f:
+            json.dump({'data': {}, 'areas': {}, 'bookmarks': {'recall': '1'}, 'rooms': {
+                '1': {'name': 'Start', 'data': {'zone': 'Z', 'terrain': 'city'}, 'exits': {'n': {'tgt': '2'}}},
+                '2': {'name': 'North', 'data': {'zone': 'Z', 'terrain': 'city'}, 'exits': {'s': {'tgt': '1'}}},
+                }}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_session(self):
+        loop = asyncio.new_event_loop()
+        server = mudserver.MudServer(self.path)
+        lines, gmcp = [], []
+        # prompts end in GA
+        parser = telnet.TelnetParser(lambda cmd, option: cmd == telnet.GA and parser.takePartial(), gmcp.append)
+
+        async def talk():
+            port = await server.listen('localhost', 0)
+            reader, writer = await asyncio.open_connection('localhost', port)
+            writer.write(telnet.IAC + telnet.DO + telnet.GMCP + b'n\r\nw\ns\nflood list 50\n')
+            while not any(line.startswith('Flooded') for line in lines):
+                lines.extend(line.decode().strip() for line in parser.feed(await reader.read(4096)))
+            writer.close()
+            server.close()
+        loop.run_until_complete(asyncio.wait_for(talk(), 5))
+        loop.close()
+        self.assertIn('North', lines)
+        self.assertIn("You can't go that way.", lines)
+        self.assertEqual(len([line for line in lines if line.startswith('[')]), 50)
+        rooms = [json.loads(msg[len(b'\xc9room.info '):]) for msg in gmcp if msg.startswith(b'\xc9room.info ')]
+        self.assertEqual([room['num'] for room in rooms], [2, 1])
+        self.assertEqual(rooms[0]['exits'], {'S': 1})
+        self.assertEqual(mudserver.runSteps(['3n', 'e', '2sw']), ['n', 'n', 'n', 'e', 'sw', 'sw'])
+
+
+class TestBench(unittest.TestCase):
+    def test_compare(self):
+        import bench  # brings in all of coffee
+        result = bench.measure(lambda ctx: 3, None, 2)
+        self.assertEqual((result['ops'], result['runs']), (3, 2))
+        baseline = {'results': {'a': {'us_per_op': 10.0}, 'b': {'us_per_op': 10.0}, 'c': {'us_per_op': 10.0}, 'gone': {'us_per_op': 1.0}}}
+        results = {'results': {'a': {'us_per_op': 12.0}, 'b': {'us_per_op': 10.5}, 'c': {'us_per_op': 5.0}, 'new': {'us_per_op': 1.0}}}
+        comparison = bench.compare(results, baseline)
+        self.assertEqual({name: verdict for name, (before, after, ratio, verdict) in comparison.items()},
+                {'a': 'slower', 'b': '', 'c': 'faster'})
+        self.assertIn('0.50x faster', bench.report(comparison))
+
+
+class TestMap(unittest.TestCase):
+    def setUp(self):
+        self.map = mapper.Map(json.dumps({'data': {}, 'areas': {'Z': '1'}, 'bookmarks': {'home': '1'}, 'rooms': {
+            '1': {'name': 'Start', 'data': {'zone': 'Z', 'terrain': 'city'}, 'exits': {'n': {'tgt': '2'}, 'e': {'tgt': '4'}}},
+            '2': {'name': 'North', 'data': {'zone': 'Z', 'terrain': 'city'},
+                'exits': {'s': {'tgt': '1'}, 'e': {'tgt': '3', 'data': {'lock': 5}}, 'open door;n': {'tgt': '5'}}},
+            '3': {'name': None, 'data': None, 'exits': {}},
+            '4': {'name': 'East', 'data': {'zone': 'Y', 'terrain': 'forest', 'note': 'x'}, 'exits': {'n': {'tgt': '3'}}},
+            }}))
+
+    def test_roundtrip(self):
+        m = mapper.Map(self.map.serialize())
+        self.assertEqual(json.loads(m.serialize()), json.loads(self.map.serialize()))
+        self.assertEqual(m.getRoomData('4'), {'zone': 'Y', 'terrain': 'forest', 'note': 'x'})
+        self.assertEqual(m.getRoomExits('2')['e'], {'tgt': '3', 'data': {'lock': 5}})
+        self.assertTrue(m.roomExists('3'))
+        self.assertFalse(m.roomExists('5'))  # only an exit leads there
+        self.assertEqual(m.getRoomData('5'), {})
+
+    def test_paths(self):
+        self.assertEqual(self.map.findPath('1', '3'), ['e', 'n'])  # the locked exit doesn't count
+        self.assertEqual(self.map.findPath('2', '5'), ['open door;n'])
+        self.assertIsNone(self.map.findPath('5', '1'))
+        self.assertEqual(self.map.findPath('1', '1'), [])
+
+    def test_edits(self):
+        exits = self.map.getRoomExits('4')
+        exits['w'] = {'tgt': '1'}
+        self.map.addRoom('4', 'East', self.map.getRoomData('4'), exits)
+        self.assertEqual(self.map.findPath('4', '2'), ['w', 'n'])
+        self.map.setExitData('4', 'w', {'len': 2})
+        self.assertEqual(self.map.getExitData('4', 'w'), {'len': 2})
+        self.assertEqual(self.map.getExitData('4', 'n'), {})
+        self.assertRaises(KeyError, self.map.getExitData, '4', 'e')
+        self.map.compact()
+        self.assertEqual(self.map.getRoomExits('4')['w'], {'tgt': '1', 'data': {'len': 2}})
+        self.map.delRoom('1')
+        self.assertFalse(self.map.roomExists('1'))
+        self.assertIsNone(self.map.findPath('4', '2'))
+        self.assertEqual(self.map.findRoomsByZone('Z'), ['2'])
+        self.assertEqual(self.map.findRoomsByName('th'), [('2', 'North', 'Z')])
+
+    def test_find(self):
+        self.map.addRoom('6', 'Northern Start', {'zone': 'Y', 'terrain': 'city'}, {})
+        self.assertEqual(self.map.findRoomsByName('rt'), [('6', 'Northern Start', 'Y'), ('2', 'North', 'Z'), ('1', 'Start', 'Z')])
+        self.assertEqual(self.map.findRoomsByName('Start', 'Z'), [('1', 'Start', 'Z')])
+        self.assertEqual(self.map.findRoomsByName('start'), [])
+        self.assertEqual(self.map.searchRooms('strat')[0], ('1', 'Start', 'Z'))
+        self.assertEqual(self.map.searchRooms('north start', limit=1), [('6', 'Northern Start', 'Y')])
+        self.map.addRoom('6', 'Southern End', {'zone': 'Z', 'terrain': 'city'}, {})
+        self.assertEqual(self.map.findRoomsByName('Start'), [('1', 'Start', 'Z')])
+        self.assertEqual(self.map.findRoomsByZone('Z'), ['1', '2', '6'])
+        self.map.delRoom('6')
+        self.assertEqual(self.map.findRoomsByName('End'), [])
+        self.assertEqual(self.map.findRoomsByZone('Z'), ['1', '2'])
+
+    def test_weighted_paths(self):
+        def room(terrain, **exits):
+            return {'name': terrain, 'data': {'zone': 'Z', 'terrain': terrain},
+                    'exits': {d.replace('_', ' ').replace('X', ';'): {'tgt': tgt} for d, tgt in exits.items()}}
+        # over the mountain is one step shorter than around it through the city
+        m = mapper.Map(json.dumps({'bookmarks': {}, 'areas': {}, 'rooms': {
+            '1': room('city', n='2', e='3'),
+            '2': room('mountains', e='5'),
+            '3': room('city', n='4'),
+            '4': room('city', n='6', open_eXe='7', e='7'),
+            '5': room('city', e='8'),
+            '6': room('city', e='8'),
+            '7': room('city', n='8'),
+            '8': room('city'),
+            }}))
+        self.assertEqual(m.findPath('1', '8'), ['n', 'e', 'e'])
+        self.assertEqual(m.findPath('1', '8', mapper.Costs()), ['e', 'n', 'n', 'e'])
+        # there's a door east of 4, so going that way takes opening it
+        self.assertEqual(m.findPath('4', '7', mapper.Costs()), ['open e;e'])
+        m.setExitData('6', 'e', {'lock': 10})
+        self.assertEqual(m.findPath('1', '8', mapper.Costs(level=9)), ['e', 'n', 'open e;e', 'n'])
+        self.assertEqual(m.findPath('1', '8', mapper.Costs(level=10)), ['e', 'n', 'n', 'e'])
+        m.setExitData('3', 'n', {'len': 8})
+        self.assertEqual(m.findPath('1', '8', mapper.Costs(level=10, lenCost=1)), ['n', 'e', 'e'])
+        self.assertIsNone(m.findPath('8', '1', mapper.Costs()))
+
+    def test_path_cache(self):
+        cache = mapper.PathCache(self.map, mapper.Costs())
+        self.assertEqual(cache.findPath('2', '1'), ['s'])  # to the home bookmark
+        self.assertEqual(cache.findPath('1', '5'), ['n', 'open door;n'])  # and from it
+        self.assertEqual(set(cache.trees), {(0, True), (0, False)})
+        self.map.addRoom('4', 'East', self.map.getRoomData('4'), self.map.getRoomExits('4'))
+        self.assertEqual(len(cache.trees), 2)
+        # only the way home went through there
+        self.map.setExitData('2', 's', {'lock': -1})
+        self.assertEqual(set(cache.trees), {(0, False)})
+        self.assertIsNone(cache.findPath('2', '1'))
+        self.assertEqual(cache.findPath('4', '3'), ['n'])
+        self.assertEqual(cache.findPath('4', '3'), ['n'])
+        self.assertIn((self.map.index('3'), True), cache.trees)
+        cache.close()
+        self.assertEqual(self.map.watchers, [])
+
+    def test_zone_router(self):
+        def room(zone, **exits):
+            return {'name': zone, 'data': {'zone': zone, 'terrain': 'city'}, 'exits': {d: {'tgt': t} for d, t in exits.items()}}
+        m = mapper.Map(json.dumps({'bookmarks': {}, 'areas': {}, 'rooms': {
+            '1': room('A', e='2', n='6'),
+            '2': room('A', e='3', w='1'),
+            '3': room('A', e='4', w='2'),
+            '4': room('B', e='5', w='3'),
+            '5': room('B', n='6', s='7', w='4'),
+            '6': room('C', s='1', e='5'),
+            '7': {'name': None, 'data': {}, 'exits': {}},
+            }}))
+        costs = mapper.Costs()
+        router = mapper.ZoneRouter(m, costs)
+
+        def walk(here, path):
+            if path is None:
+                return None
+            total, cost = 0, m.costFunction(costs)
+            for step in path:
+                there = m.getRoomExits(here)[step]['tgt']
+                total += cost(m.index(here), m.dirs.numbers[step], m.index(there))
+                here = there
+            return total, here
+
+        def check():  # ties can go either way, so compare what the routes cost
+            for here in '1234567':
+                for there in '1234567':
+                    self.assertEqual(walk(here, router.findPath(here, there)), walk(here, m.findPath(here, there, costs)))
+
+        check()
+        self.assertEqual(router.findPath('1', '5'), ['n', 'e'])
+        self.assertEqual(set(router.portals), {m.zones.number(zone) for zone in 'ABC'})  # 7 goes with B
+        m.delRoom('6')
+        self.assertEqual(router.findPath('1', '5'), ['e', 'e', 'e', 'e'])
+        m.addRoom('2', 'A', {'zone': 'B', 'terrain': 'mountains'}, m.getRoomExits('2'))
+        check()
+        self.assertEqual(router.findPath('1', '7'), ['e', 'e', 'e', 'e', 's'])
+
+
+class TestMatcher(unittest.TestCase):
+    patterns = [
+            r'^You are thirsty\.$',
+            r'You are done (.*)\.',
+            'You are done scrapping.',
+            '.* is DEAD!!!',
+            r'(Grumpy|Grumpier|Grumpiest) wants to teach you .*\.',
+            r'(\w+): A closed door',
+            '(?i)shout',
+            'You',
+            ]
+    lines = [
+            'You are thirsty.',
+            'You are thirsty. Very.',
+            'You are done scrapping.',
+            'You are done chopping.',
+            'The orc is DEAD!!!',
+            'Grumpier wants to teach you stuff.',
+            'north: A closed door',
+            'SHOUT',
+            'You see nothing.',
+            'Nothing here',
+            ]
+
+    def test_required_literal(self):
+        self.assertEqual(matcher.requiredLiteral(r'^You are thirsty\.$'), ('You are thirsty.', True))
+        self.assertEqual(matcher.requiredLiteral('.* is DEAD!!!'), (' is DEAD!!!', False))
+        self.assertEqual(matcher.requiredLiteral('(?i)shout'), (None, False))
+
+    def test_same_as_re_match(self):
+        m = matcher.Matcher(self.patterns)
+        expected = []
+        for line in self.lines:
+            for pattern in self.patterns:
+                if re.match(pattern, line):
+                    expected.append(pattern)
+                    break
+            else:
+                expected.append(None)
+        self.assertEqual([m.match(line)[0] for line in self.lines], expected)
+        self.assertEqual([pattern for pattern, _ in m.matchAll(self.lines)], expected)
+        self.assertEqual(m.match('north: A closed door')[1].groups(), ('north',))
+
+
+class TestTable(unittest.TestCase):
+    def test_order_and_edits(self):
+        table = matcher.Table({'You (.+)': 'a', 'You see': 'b'})
+        self.assertEqual(table.match('You see it')[0], 'You (.+)')
+        del table['You (.+)']
+        self.assertEqual(table.match('You see it')[0], 'You see')
+        table['You (.+)'] = 'c'  # re-added keys go last, like in a dict
+        table.update({'^You see it$': 'd'})
+        self.assertEqual(table.match('You see it')[0], 'You see')
+        self.assertEqual([key for key, _ in table.matchAll(['You see it', 'You go', 'Nope'])], ['You see', 'You (.+)', None])
+
+    def test_shards(self):
+        table = matcher.Table()
+        table.SHARD_SIZE = 2
+        for i in range(6):
+            table['line {}'.format(i)] = str(i)
+        table.activeMatchers()
+        compiled = dict(table.matchers)
+        del table['line 3']
+        table.activeMatchers()
+        changed = [shard for shard in compiled if compiled[shard] is not table.matchers.get(shard)]
+        self.assertEqual(changed, [table.shardOf['line 2']])
+
+    def test_groups(self):
+        table = matcher.Table({'You are': 'a'})
+        table.add('You are done', 'b', group='write')
+        table.add('^You are done!$', 'c', group='write')
+        self.assertEqual(table.match('You are done!')[0], 'You are')
+        del table['You are']
+        self.assertEqual(table.match('You are done!')[0], 'You are done')
+        table.disableGroup('write')
+        self.assertEqual(table.match('You are done!'), (None, None))
+        table.enableGroup('write')
+        self.assertEqual(table.match('You are done!')[0], 'You are done')
+        table.removeGroup('write')
+        self.assertEqual(len(table), 0)
 
 
 if __name__ == '__main__':